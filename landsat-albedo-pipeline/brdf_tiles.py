@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import uuid
+import fcntl
+import sqlite3
+import argparse
+import subprocess
+import logging, logging.config
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "landsat-data-access"))
+from scene_cache import link_or_copy
+
+from sin_tiles import scene_info, xml_tiles
+
+LOGGING = {
+    "version" : 1,
+    "disable_existing_loggers" : False,
+    "formatters" : {
+        "default" : {
+            "format" : "%(asctime)s %(levelname)s %(message)s",
+        },
+    },
+    "handlers" : {
+        "console" : {
+            "class" : "logging.StreamHandler",
+            "level" : "DEBUG",
+            "formatter" : "default",
+            "stream" : "ext://sys.stdout",
+        },
+    },
+    "root" : {
+        "handlers" : ["console"],
+        "level" : "DEBUG",
+    },
+}
+logging.config.dictConfig(LOGGING)
+logger = logging.getLogger('landsat-pipeline')
+
+# Files in the cache directory.
+CACHE_DB_FNAME = "mosaics.db"
+CACHE_LOCK_FNAME = "mosaics.lock"
+CACHE_OBJECTS_DNAME = "objects"
+CACHE_LOCKS_DNAME = "locks"
+
+def union_bounds(bounds_list):
+    """ Bounding box of several (west, east, north, south), or None if
+    one of them crosses the antimeridian. """
+    if any([b[0] > b[1] for b in bounds_list]):
+        return None
+    return (min([b[0] for b in bounds_list]), max([b[1] for b in bounds_list]),
+            max([b[2] for b in bounds_list]), min([b[3] for b in bounds_list]))
+
+
+class BrdfMosaicCache(object):
+    """ A directory of BRDF mosaics made by the subsetting program,
+    handed out as a hard link (or reflink, or copy) to the scenes they
+    serve instead of being made again.
+
+    A mosaic serves a target scene if it is of the same product, day
+    and tiles and was made for the same scenes, so it is the same file
+    as the subsetting program makes for them. Shared, a mosaic made for
+    a group of scenes of a day also serves the scenes it covers, with
+    a larger extent than their own subset.
+
+    The least recently used mosaics are evicted to keep the cache under
+    a quota of bytes. Only one process makes the mosaic of a product,
+    day and tile set at a time; the others wait for it and use it.
+    """
+    def __init__(self, cache_dir, quota=None):
+        self.cache_dir = cache_dir
+        self.quota = quota
+        self.objects_dir = os.path.join(cache_dir, CACHE_OBJECTS_DNAME)
+        self.locks_dir = os.path.join(cache_dir, CACHE_LOCKS_DNAME)
+        for d in (self.objects_dir, self.locks_dir):
+            if not os.path.exists(d):
+                os.makedirs(d)
+        self._lock_file = os.path.join(cache_dir, CACHE_LOCK_FNAME)
+        self._conn = sqlite3.connect(os.path.join(cache_dir, CACHE_DB_FNAME), timeout=600,
+                                     isolation_level=None)
+        with self._locked(self._lock_file):
+            self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS mosaics (
+             name TEXT PRIMARY KEY,
+             product TEXT,
+             date TEXT,
+             tiles TEXT,
+             west REAL,
+             east REAL,
+             north REAL,
+             south REAL,
+             scenes TEXT,
+             size INTEGER,
+             added REAL,
+             last_used REAL)""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS mosaics_key ON mosaics (product, date, tiles)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS mosaics_last_used ON mosaics (last_used)")
+
+
+    @contextmanager
+    def _locked(self, lock_file):
+        with open(lock_file, "a") as fobj:
+            fcntl.flock(fobj.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fobj.fileno(), fcntl.LOCK_UN)
+
+
+    def buildLock(self, product, date, tiles):
+        """ Lock held while the mosaic of a product, day and tile set is
+        looked up and made. """
+        return self._locked(os.path.join(self.locks_dir, "{0:s}.{1:s}.{2:s}.lock".format(product, date, tiles)))
+
+
+    def linkTo(self, product, date, tiles, bounds, scenes, local_path, shared=False):
+        """ Put a cached mosaic serving the scenes at `local_path`: one
+        made for the same scenes, or if `shared` one made for more
+        scenes or covering their bounding box.
+        :returns:
+            (bool) whether one was found.
+        """
+        with self._locked(self._lock_file):
+            recs = self._conn.execute("""
+            SELECT name, west, east, north, south, scenes, size FROM mosaics
+            WHERE product = ? AND date = ? AND tiles = ?
+            ORDER BY last_used DESC""", (product, date, tiles)).fetchall()
+            for name, west, east, north, south, cached_scenes, size in recs:
+                cached = os.path.join(self.objects_dir, name)
+                if not os.path.isfile(cached) or os.path.getsize(cached) != size:
+                    self._drop(name)
+                    continue
+                if json.loads(cached_scenes) == list(scenes) or shared and (
+                        set(scenes) <= set(json.loads(cached_scenes)) or (
+                            bounds is not None and west is not None and west <= bounds[0] and east >= bounds[1]
+                            and north >= bounds[2] and south <= bounds[3])):
+                    link_or_copy(cached, local_path)
+                    self._conn.execute("UPDATE mosaics SET last_used = ? WHERE name = ?", (time.time(), name))
+                    return True
+        return False
+
+
+    def store(self, product, date, tiles, bounds, scenes, local_path):
+        """ Add the mosaic at `local_path` made for the scenes, in the
+        order given to the subsetting program, and evict the least
+        recently used mosaics over the quota. """
+        name = "{0:s}.{1:s}.{2:s}.{3:s}{4:s}".format(product, date, tiles, uuid.uuid4().hex[0:8],
+                                                    os.path.splitext(local_path)[1])
+        cached = os.path.join(self.objects_dir, name)
+        link_or_copy(local_path, cached)
+        # Read-only, so the hard links out of the cache cannot be used
+        # to change the cached data in place.
+        os.chmod(cached, 0o444)
+        west, east, north, south = (None, None, None, None) if bounds is None else bounds
+        with self._locked(self._lock_file):
+            now = time.time()
+            self._conn.execute("""
+            INSERT INTO mosaics (name, product, date, tiles, west, east, north, south, scenes, size, added, last_used)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                               (name, product, date, tiles, west, east, north, south,
+                                json.dumps(list(scenes)), os.path.getsize(cached), now, now))
+            self._evict()
+
+
+    def _drop(self, name):
+        cached = os.path.join(self.objects_dir, name)
+        if os.path.isfile(cached):
+            os.remove(cached)
+        self._conn.execute("DELETE FROM mosaics WHERE name = ?", (name, ))
+
+
+    def _evict(self):
+        if self.quota is None:
+            return
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM mosaics").fetchone()[0]
+        if total <= self.quota:
+            return
+        for name, size in self._conn.execute("SELECT name, size FROM mosaics ORDER BY last_used").fetchall():
+            if total <= self.quota:
+                break
+            self._drop(name)
+            total -= size
+
+
+    def close(self):
+        self._conn.close()
+
+
+def run_subset(mos_exe, brdf_dir, product, out_path, xmls):
+    """ Mosaic and subset the BRDF of a product to cover the scenes of
+    the .xml files with the subsetting program. """
+    ret = subprocess.call([mos_exe, brdf_dir, product, out_path, str(len(xmls))] + list(xmls) + ["-f"])
+    if ret != 0:
+        if os.path.isfile(out_path):
+            os.remove(out_path)
+        raise RuntimeError("{0:s} failed to mosaic {1:s} for {2:s}".format(mos_exe, product, " ".join(xmls)))
+
+
+def subset_brdf(mos_exe, brdf_dir, product, out_path, xmls, group_xmls=None, cache=None):
+    """ Get the BRDF subset of a product for a target scene and its
+    helping scenes (.xml files, the target first) at `out_path`.
+
+    Without a cache, the subsetting program is run for these scenes.
+    With a cache, the mosaic made earlier for the same scenes is used
+    if there is one, or it is made and added to the cache, so the
+    subset is the same as without a cache.
+
+    If `group_xmls` is given, e.g. the other scenes of the day, mosaics
+    are shared: a cached mosaic of the same day and tiles that covers
+    the scenes is used, or one is made for them together with the
+    scenes of the group of the same day that need no more tiles. The
+    subset then covers the extent of all these scenes rather than only
+    the given ones; use it only with an albedo program known to give
+    the same result for a larger BRDF extent, within its memory.
+    :returns:
+        (str) "cache" if the mosaic came from the cache, "group" or
+        "scene" for a mosaic made for the group or only these scenes.
+    """
+    if cache is None:
+        run_subset(mos_exe, brdf_dir, product, out_path, xmls)
+        return "scene"
+
+    infos = [scene_info(x) for x in xmls]
+    date = infos[0][0]
+    hmin, hmax, vmin, vmax = xml_tiles(xmls)
+    tiles = "h{0:02d}-{1:02d}v{2:02d}-{3:02d}".format(hmin, hmax, vmin, vmax)
+    bounds = union_bounds([b for _, b in infos])
+    scenes = [os.path.basename(x) for x in xmls]
+
+    shared = group_xmls is not None
+    with cache.buildLock(product, date, tiles):
+        if cache.linkTo(product, date, tiles, bounds, scenes, out_path, shared=shared):
+            return "cache"
+
+        # The scenes of the day in the group that fit in the same tiles.
+        how = "scene"
+        names = set(scenes)
+        extra = []
+        for x in (group_xmls or []):
+            if os.path.basename(x) in names or not os.path.isfile(x):
+                continue
+            try:
+                x_date, x_bounds = scene_info(x)
+            except (ValueError, ET.ParseError):
+                continue
+            if x_date != date:
+                continue
+            x_hmin, x_hmax, x_vmin, x_vmax = xml_tiles([x])
+            if x_hmin >= hmin and x_hmax <= hmax and x_vmin >= vmin and x_vmax <= vmax:
+                names.add(os.path.basename(x))
+                extra.append((x, x_bounds))
+        if len(extra) > 0:
+            group_bounds = union_bounds([b for _, b in infos] + [b for _, b in extra])
+            group_tiles = "h{0:02d}-{1:02d}v{2:02d}-{3:02d}".format(*xml_tiles(list(xmls) + [x for x, _ in extra]))
+            if group_tiles == tiles:
+                xmls = list(xmls) + [x for x, _ in extra]
+                bounds = group_bounds
+                scenes = [os.path.basename(x) for x in xmls]
+                how = "group"
+
+        tmp = "{0:s}.{1:d}.tmp{2:s}".format(os.path.splitext(out_path)[0], os.getpid(), os.path.splitext(out_path)[1])
+        run_subset(mos_exe, brdf_dir, product, tmp, xmls)
+        cache.store(product, date, tiles, bounds, scenes, tmp)
+        os.rename(tmp, out_path)
+    return how
+
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description="Mosaic and subset the BRDF tiles of a product (e.g. MCD43A1) for a Landsat target scene and its helping scenes, like modis_sub2/viirs_sub2, but through a cache of the mosaics, optionally shared between the scenes of a day that need the same tiles.")
+
+    p.add_argument("xmls", metavar="XML", nargs="+", help="ESPA .xml files of the target scene and its helping scenes, the target first.")
+
+    p.add_argument("--mos_exe", dest="mos_exe", required=True, default=None, metavar="SUBSET_PROGRAM", help="Path to the BRDF subsetting program, modis_sub2 or viirs_sub2.")
+    p.add_argument("--bd", dest="brdf_dir", required=True, default=None, metavar="SOURCE_BRDF_DIRECTORY", help="Directory of the source BRDF tiles.")
+    p.add_argument("--product", dest="product", required=True, default=None, metavar="BRDF_PRODUCT", help="BRDF product, e.g. MCD43A1, MCD43A2, VNP43MA1 or VNP43MA2.")
+    p.add_argument("-o", "--output", dest="output", required=True, default=None, metavar="OUTPUT_FILE", help="Output BRDF subset file.")
+
+    p.add_argument("--cache", dest="cache_dir", required=False, default=None, metavar="CACHE_DIRECTORY", help="Directory of the cache of BRDF mosaics shared by the scenes. Default: no cache, make a subset for each scene.")
+    p.add_argument("--quota", dest="quota", required=False, type=float, default=None, metavar="GIGABYTES", help="Maximum size of the cache in GB; the least recently used mosaics are evicted beyond it. Default: no limit.")
+    p.add_argument("--group", dest="group", required=False, default=None, metavar="FILE_OF_XMLS", help="A text file of the .xml files of other scenes, one per line, e.g. all the scenes of the day, to share the mosaics with: a cached mosaic that covers the given scenes is used, or one is made for them together with the scenes of the file that need no more tiles. The output then covers the extent of all these scenes instead of only the given ones, unlike the subset of modis_sub2/viirs_sub2. Default: only use a mosaic made for the same scenes.")
+
+    cmdargs = p.parse_args()
+
+    return cmdargs
+
+
+def main(cmdargs):
+    group_xmls = None
+    if cmdargs.group is not None:
+        with open(cmdargs.group, "r") as fobj:
+            group_xmls = [line.strip() for line in fobj if len(line.strip()) > 0]
+    cache = None
+    if cmdargs.cache_dir is not None:
+        quota = None if cmdargs.quota is None else int(cmdargs.quota * 1024**3)
+        cache = BrdfMosaicCache(cmdargs.cache_dir, quota=quota)
+    try:
+        how = subset_brdf(cmdargs.mos_exe, cmdargs.brdf_dir, cmdargs.product, cmdargs.output,
+                          cmdargs.xmls, group_xmls=group_xmls, cache=cache)
+    except (RuntimeError, ValueError, OSError, ET.ParseError) as exc:
+        logger.error("BRDF subset of {0:s} failed: {1:s}".format(cmdargs.product, str(exc)))
+        return 2
+    finally:
+        if cache is not None:
+            cache.close()
+    logger.info("BRDF subset of {0:s} for {1:s} ({2:s}): {3:s}".format(cmdargs.product, cmdargs.xmls[0], how, cmdargs.output))
+    return 0
+
+if __name__ == "__main__":
+    cmdargs = getCmdArgs()
+    sys.exit(main(cmdargs))
@@ -120,6 +120,12 @@ fi
 if [[ ${SNOW} -eq 1 ]]; then
     GEN_ALBEDO_CMD="${GEN_ALBEDO_CMD} -s"
 fi
+# Record the stages done for each scene, so a rerun of the pipeline
+# skips the scenes already processed.
+STATE_DB=${OUTDIR}/.landsat_pipeline_state.db
+GEN_SR_CMD="${GEN_SR_CMD} --state=${STATE_DB}"
+GET_BRDF_CMD="${GET_BRDF_CMD} --state=${STATE_DB}"
+GEN_ALBEDO_CMD="${GEN_ALBEDO_CMD} --state=${STATE_DB}"
 
 DO_ARCH=0
 if [[ ! -z ${DATA_ARCH_SERVER} ]] || [[ ! -z ${DATA_ARCH_DIR} ]] || [[ ! -z ${DATA_ARCH_SERVER_USER} ]] || [[ ! -z ${PRIV_KEY_FILE} ]]; then
@@ -324,7 +330,7 @@ if [[ ${DO_ARCH} -eq 1 ]]; then
 #BSUB -J "${bjob_s06_name}"
 #BSUB -e ${LOG_DIR}/${bjob_s06_name}.%J.e
 #BSUB -o ${LOG_DIR}/${bjob_s06_name}.%J.o
-#BSUB -w "done(${bjob_s05_name})"
+#BSUB -w "ended(${bjob_s05_name})"
 #BSUB -n 1
 #BSUB -R "rusage[mem=64]"
 #BSUB -R "span[hosts=1]"
@@ -1,64 +1,104 @@
 #!/usr/bin/env python
 
+import os
+import sys
 import argparse
-import itertools
 
+import numpy as np
 import pandas as pd
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "landsat-data-access"))
+from scene_id import parse_scene_ids
+
+# WRS-2 paths and rows are numbered from 1.
+NUM_WRS_PATHS = 233
+NUM_WRS_ROWS = 248
+
+# Number of buffered scenes formatted and written at a time.
+WRITE_BLOCK = 256 * 1024
+
 def getCmdArgs():
     p = argparse.ArgumentParser(description="Add scenes in neighboring rows of scenes in a given scene ID list.")
 
-    p.add_argument("-l", "--list", dest="scn_list", required=True, default=None, metavar="CSV_OF_SCENE_LIST", help="A CSV file of scene list. It must have at least the first column as the list of scene IDs (e.g. LC80010042015211LGN01)")
+    p.add_argument("-l", "--list", dest="scn_list", required=True, default=None, metavar="CSV_OF_SCENE_LIST", help="A CSV file of scene list. It must have at least the first column as the list of scene IDs (e.g. LC80010042015211LGN01 or LC08_L1TP_001004_20150730_20170406_01_T2)")
 
-    p.add_argument("--lead", dest="nlead", required=False, default=1, metavar="NUM_OF_LEADING_ROWS_TO_BUFFER", help="Number of leading rows to buffer from a scene, e.g. 2 leading rows of path=18,row=30 will add two path/row pairs, (1) path=18,row=31, (2) path=18,row=32.")
-    p.add_argument("--trail", dest="ntrail", required=False, default=1, metavar="NUM_OF_TRAILING_ROWS_TO_BUFFER", help="Number of trailing rows to buffer from a scene, e.g. 2 leading rows of path=18,row=30 will add two path/row pairs, (1) path=18,row=29, (2) path=18,row=28.")
+    p.add_argument("--lead", dest="nlead", required=False, type=int, default=1, metavar="NUM_OF_LEADING_ROWS_TO_BUFFER", help="Number of leading rows to buffer from a scene, e.g. 2 leading rows of path=18,row=30 will add two path/row pairs, (1) path=18,row=31, (2) path=18,row=32. Rows past 248 are left out, as row 1 that follows along the orbit is on another path.")
+    p.add_argument("--trail", dest="ntrail", required=False, type=int, default=1, metavar="NUM_OF_TRAILING_ROWS_TO_BUFFER", help="Number of trailing rows to buffer from a scene, e.g. 2 leading rows of path=18,row=30 will add two path/row pairs, (1) path=18,row=29, (2) path=18,row=28. Rows before 1 are left out, as row 248 that precedes along the orbit is on another path.")
+    p.add_argument("--paths", dest="npaths", required=False, type=int, default=0, metavar="NUM_OF_PATHS_TO_BUFFER", help="Number of adjacent paths on each side of a scene to buffer on the same day, for each of its buffered rows, e.g. 1 adds path=17 and path=19 to path=18. Paths wrap around between 233 and 1. Default: 0.")
 
-    p.add_argument("-o", "--output", dest="output", required=True, default=None, metavar="OUTPUT_PRD_LIST", help="Name of output CSV file of the list of path,row,start_date,end_date, of the scenes after row buffering.")
+    p.add_argument("-o", "--output", dest="output", required=True, default=None, metavar="OUTPUT_PRD_LIST", help="Name of output CSV file of the list of path,row,start_date,end_date, of the scenes after row buffering, the given scenes included, in the order of date, path and row.")
 
     cmdargs = p.parse_args()
-    
+
     return cmdargs
 
-def scnIdToPathRowDay(scn_id):
-    path = int(scn_id[3:6])
-    row = int(scn_id[6:9])
-    year = int(scn_id[9:13])
-    doy = int(scn_id[13:16])
-    return path, row, year, doy
+
+def bufferRows(row, row_offsets):
+    # Rows at the offsets from each row (last axis), clipped to the rows
+    # of a path: row 248 continues into row 1 of another path along the
+    # orbit, so rows do not wrap around on the same path.
+    return np.clip(np.asarray(row, dtype=np.int64)[..., None] + np.asarray(row_offsets, dtype=np.int64), 1, NUM_WRS_ROWS)
+
+
+def bufferScenes(path, row, year, doy, row_offsets, path_offsets):
+    # Broadcast the offsets against the scenes and return the sorted
+    # unique keys of the buffered scenes, (year*1000+doy)*1e6 +
+    # path*1000 + row, i.e. in the order of date, path and row.
+    buf_row = bufferRows(row, row_offsets)[:, None, :]
+    path = path.astype(np.int64)[:, None, None]
+    day = (year.astype(np.int64) * 1000 + doy.astype(np.int64))[:, None, None]
+    buf_path = (path + np.asarray(path_offsets, dtype=np.int64)[None, :, None] - 1) % NUM_WRS_PATHS + 1
+    keys = day * 1000000 + buf_path * 1000 + buf_row
+    return np.unique(keys.ravel())
+
+
+def formatKeys(keys):
+    # Format the lines "path,row,date,date" of the keys of buffered
+    # scenes in one byte matrix, with the leading zeros of path and row
+    # masked out.
+    n = len(keys)
+    # Format each of the few distinct dates once.
+    days, day_idx = np.unique(keys // 1000000, return_inverse=True)
+    year_start = (days // 1000 - 1970).astype("datetime64[Y]").astype("datetime64[D]")
+    datestr = np.datetime_as_string(year_start + (days % 1000 - 1).astype("timedelta64[D]"), unit="D")
+    datechars = datestr.astype("S10").view(np.uint8).reshape(len(days), 10)[day_idx]
+
+    # Columns: 3 of path, ",", 3 of row, ",", 10 of date, ",", 10 of
+    # date, "\n".
+    chars = np.empty((n, 30), dtype=np.uint8)
+    mask = np.ones((n, 30), dtype=np.bool_)
+    for col, val in ((0, keys // 1000 % 1000), (4, keys % 1000)):
+        for k in range(3):
+            chars[:, col+k] = val // 10**(2-k) % 10 + ord("0")
+        mask[:, col] = val >= 100
+        mask[:, col+1] = val >= 10
+    chars[:, [3, 7, 18]] = ord(",")
+    chars[:, 8:18] = datechars
+    chars[:, 19:29] = datechars
+    chars[:, 29] = ord("\n")
+    return chars[mask].tobytes()
+
 
 def main(cmdargs):
     scn_csv = cmdargs.scn_list
     nlead = cmdargs.nlead
     ntrail = cmdargs.ntrail
+    npaths = cmdargs.npaths
     prd_csv = cmdargs.output
 
     out_header = ["path", "row", "start_date", "end_date"]
-    prd_header = ["path", "row", "year", "doy"]
     with open(prd_csv, "w") as out_fobj:
         out_fobj.write(",".join(out_header))
         out_fobj.write("\n")
         scn_df = pd.read_csv(scn_csv, usecols=[0])
-        scn_list = scn_df.iloc[:, 0].tolist()
-        prd_list = zip(*[scnIdToPathRowDay(scn) for scn in scn_list])
-        prd_dict = {nm:prd for nm, prd in zip(prd_header, prd_list)}
-        prd_df = pd.DataFrame(prd_dict)
-        # Add buffer rows
-        buf_row_add = range(-1*ntrail, nlead+1)
-        buf_row_add.remove(0)
-        buf_df_list = [prd_df.copy() for bra in buf_row_add]
-        for bra, bd in itertools.izip(buf_row_add, buf_df_list):
-            bd["row"] = bd["row"] + bra
-
-        all_prd_df = pd.concat([prd_df]+buf_df_list, axis=0)
-        all_prd_df = all_prd_df.drop_duplicates(prd_header, keep=False)
-        all_prd_df = all_prd_df.sort_values(["year", "doy", "path", "row"])
-        datestr = ["{0:04d}{1:03d}".format(getattr(row, "year"), getattr(row, "doy")) 
-                   for row in all_prd_df.itertuples()]
-        all_prd_df[out_header[2]] = pd.to_datetime(datestr, format="%Y%j")
-        all_prd_df[out_header[3]] = pd.to_datetime(datestr, format="%Y%j")
-
-        all_prd_df.to_csv(out_fobj, header=False, index=False, columns=out_header, 
-                          mode="a", date_format="%Y-%m-%d")
+        prd_df = parse_scene_ids(scn_df.iloc[:, 0])
+        # Add buffer rows, and paths
+        keys = bufferScenes(prd_df["path"].values, prd_df["row"].values,
+                            prd_df["year"].values, prd_df["doy"].values,
+                            np.arange(-1*ntrail, nlead+1), np.arange(-1*npaths, npaths+1))
+
+        for i in range(0, len(keys), WRITE_BLOCK):
+            out_fobj.write(formatKeys(keys[i:i+WRITE_BLOCK]).decode("ascii"))
 
 if __name__ == "__main__":
     cmdargs = getCmdArgs()
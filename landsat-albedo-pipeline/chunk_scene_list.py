@@ -2,68 +2,202 @@
 
 import argparse
 import os
+import sys
+import mmap
 
-import pandas as pd
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "landsat-data-access"))
+from scene_id import SCENE_ID_WIDTH, decode_id_chars
+
+# Bytes of the file scanned for line ends at a time, and lines decoded
+# at a time, to bound the memory of the temporary arrays.
+SCAN_BLOCK_BYTES = 64 * 1024 * 1024
+LINE_BLOCK = 256 * 1024
+
+NEWLINE = ord("\n")
 
 def getCmdArgs():
     p = argparse.ArgumentParser(description="Sort the scenes in a long list according to their year, DOY, path, and row, and then divide this scene list into chunks, i.e. multiple shorter lists of scene paths/rows and dates according to a given size.")
 
-    p.add_argument("-l", "--list", dest="scn_list", required=True, default=None, metavar="CSV_OF_SCENE_LIST", help="A CSV file of scene list. It must have at least the first column as the list of scene IDs (e.g. LC80010042015211LGN01)")
-    
+    p.add_argument("-l", "--list", dest="scn_list", required=True, default=None, metavar="CSV_OF_SCENE_LIST", help="A CSV file of scene list. It must have at least the first column as the list of scene IDs (e.g. LC80010042015211LGN01 or LC08_L1TP_001004_20150730_20170406_01_T2)")
+
     p.add_argument("--chunk", dest="chunk_size", type=int, required=True, default=None, metavar="CHUNK_SIZE", help="Chunk size, maximum number of scenes in an output smaller scene list.")
 
+    p.add_argument("--balance", dest="balance", required=False, choices=["count", "bytes", "locality"], default="count", help="How to divide the sorted list. 'count': chunks of CHUNK_SIZE scenes. 'bytes': as many chunks as with 'count', cut to hold about the same number of bytes of lines each. 'locality': chunks of at most CHUNK_SIZE scenes, cut where the path/row changes when possible, so the scenes of a path/row over the years stay together in one chunk (the scenes are sorted by path, row, year and DOY to cut the chunks, then by year, DOY, path and row in each chunk). Default: count.")
+
     p.add_argument("--od", dest="outdir", required=True, default=None, metavar="OUTPUT_DIR", help="Output directory to save all the divided CSV lists of scenes.")
 
     cmdargs = p.parse_args()
-    
+
     return cmdargs
 
 
-def scnIdToPathRowDay(scn_id):
-    path = int(scn_id[3:6])
-    row = int(scn_id[6:9])
-    year = int(scn_id[9:13])
-    doy = int(scn_id[13:16])
-    return path, row, year, doy
+def lineOffsets(buf):
+    # Returns (starts, ends) of the lines after the header, ends
+    # exclusive and without the line break; blank lines are skipped
+    # like by read_csv.
+    ends = []
+    for b in range(0, len(buf), SCAN_BLOCK_BYTES):
+        block = buf[b:b+SCAN_BLOCK_BYTES]
+        ends.append(np.flatnonzero(block == NEWLINE) + b)
+    ends = np.concatenate(ends) if len(ends) > 0 else np.zeros(0, dtype=np.int64)
+    if len(buf) > 0 and buf[-1] != NEWLINE:
+        ends = np.append(ends, len(buf))
+    starts = np.concatenate([[0], ends[:-1] + 1]).astype(np.int64)
+    # Drop "\r" of Windows line breaks.
+    has_cr = (ends > starts) & (buf[np.maximum(ends - 1, 0)] == ord("\r"))
+    ends = ends - has_cr
+    # The first line is the header.
+    starts, ends = starts[1:], ends[1:]
+    keep = np.zeros(len(starts), dtype=np.bool_)
+    for i in range(0, len(starts), LINE_BLOCK):
+        s, e = starts[i:i+LINE_BLOCK], ends[i:i+LINE_BLOCK]
+        # Lines of only blanks.
+        nonblank = np.zeros(len(s), dtype=np.bool_)
+        pos = s.copy()
+        while True:
+            inside = pos < e
+            if not inside.any():
+                break
+            c = buf[np.where(inside, pos, 0)]
+            nonblank |= inside & (c != ord(" ")) & (c != ord("\t"))
+            pos = np.where(inside & ~nonblank, pos + 1, e)
+        keep[i:i+LINE_BLOCK] = nonblank
+    return starts[keep], ends[keep]
+
+
+def sceneKeys(buf, starts, ends):
+    # Returns the decoded scene ID columns of the first field of the
+    # lines, gathered from the file without making Python strings.
+    cols = dict()
+    for i in range(0, len(starts), LINE_BLOCK):
+        s, e = starts[i:i+LINE_BLOCK], ends[i:i+LINE_BLOCK]
+        # Skip a quote around the ID.
+        s = s + ((s < e) & (buf[np.minimum(s, len(buf)-1)] == ord('"')))
+        chars = np.zeros((SCENE_ID_WIDTH, len(s)), dtype=np.uint8)
+        ended = np.zeros(len(s), dtype=np.bool_)
+        for k in range(SCENE_ID_WIDTH):
+            pos = s + k
+            ended |= pos >= e
+            c = buf[np.where(ended, 0, pos)]
+            ended |= (c == ord(",")) | (c == ord('"'))
+            chars[k] = np.where(ended, 0, c)
+        for nm, val in decode_id_chars(chars).items():
+            cols.setdefault(nm, []).append(val)
+    return dict((nm, np.concatenate(val)) for nm, val in cols.items())
+
+
+def chunkBounds(order_keys, groups, nbytes, chunksize, balance):
+    # Returns the first index of each chunk in the sorted lines and the
+    # end of the last one.
+    n = len(order_keys)
+    nchunks = max(1, (n + chunksize - 1) // chunksize)
+    if balance == "count" or n == 0:
+        bounds = list(range(0, n, chunksize)) + [n]
+    elif balance == "bytes":
+        cum = np.cumsum(nbytes)
+        targets = cum[-1] * np.arange(1, nchunks) / float(nchunks)
+        cuts = np.searchsorted(cum, targets, side="right")
+        bounds = [0] + sorted(set(cuts.tolist()) - set([0, n])) + [n]
+    elif balance == "locality":
+        # Positions where a new path/row starts.
+        group_starts = np.flatnonzero(np.concatenate([[True], groups[1:] != groups[:-1]]))
+        bounds = [0]
+        while bounds[-1] < n:
+            b = bounds[-1]
+            if b + chunksize >= n:
+                bounds.append(n)
+                continue
+            j = np.searchsorted(group_starts, b + chunksize, side="right") - 1
+            cut = group_starts[j]
+            bounds.append(cut if cut > b else b + chunksize)
+    else:
+        raise RuntimeError("Unknown chunk balancing {0:s}".format(balance))
+    return bounds
+
+
+def writeLines(buf, starts, ends, outfobj):
+    # Copy the lines as slices of the file, joining the runs of lines
+    # that follow each other in the file into one slice.
+    n = len(starts)
+    view = memoryview(buf)
+    # Lines ending with a plain "\n", which is copied with them.
+    plain = (ends < len(buf)) & (buf[np.minimum(ends, len(buf)-1)] == NEWLINE)
+    joins = np.zeros(n, dtype=np.bool_)
+    joins[1:] = plain[:-1] & plain[1:] & (starts[1:] == ends[:-1] + 1)
+    run_first = np.flatnonzero(~joins)
+    run_last = np.append(run_first[1:], n) - 1
+    for a, b, last_plain in zip(starts[run_first].tolist(), ends[run_last].tolist(), plain[run_last].tolist()):
+        if last_plain:
+            outfobj.write(view[a:b+1])
+        else:
+            outfobj.write(view[a:b])
+            outfobj.write(b"\n")
+    view.release()
 
 
 def main(cmdargs):
     scn_csv = cmdargs.scn_list
     chunksize = cmdargs.chunk_size
     outdir = cmdargs.outdir
+    balance = cmdargs.balance
 
-    scn_df = pd.read_csv(scn_csv, usecols=[0])
-    line_df = pd.read_table(scn_csv, delimiter='\n', memory_map=True)
-
-    scn_list = scn_df.iloc[:, 0].tolist()
-
-    prd_header = ["path", "row", "year", "doy"]
-    prd_list = zip(*[scnIdToPathRowDay(scn) for scn in scn_list])
-    prd_dict = {nm:prd for nm, prd in zip(prd_header, prd_list)}
-    prd_dict["line"] = line_df.iloc[:, 0].tolist()
-
-    prd_df = pd.DataFrame(prd_dict)
-    prd_df = prd_df.sort_values(["year", "doy", "path", "row"])
-
-    outdf_bidx = range(0, len(prd_df), chunksize) # inclusive
-    outdf_eidx = outdf_bidx[1:] + [len(prd_df)] # exclusive
-    nchunks = len(outdf_bidx)
-    ndigits = len(str(nchunks))
-
-    outcsv_base, _ = os.path.splitext(os.path.basename(scn_csv))
-    fmt_str = "{{0:s}}_{{1:0{0:d}d}}.csv".format(ndigits)
-    outcsv_list = [os.path.join(outdir, fmt_str.format(outcsv_base, i+1)) for i in range(nchunks)]
-
-    with open(scn_csv, "r") as scnfobj:
+    with open(scn_csv, "rb") as scnfobj:
         headerstr = scnfobj.readline().rstrip()
-
-    for obi, oei, ocsv in zip(outdf_bidx, outdf_eidx, outcsv_list):
-        with open(ocsv, "w") as outfobj:
-            outfobj.write(headerstr)
-            outfobj.write("\n")
-            for i in range(obi, oei):
-                outfobj.write(prd_df["line"].iloc[i])
-                outfobj.write("\n")    
+        if os.path.getsize(scn_csv) > 0:
+            mm = mmap.mmap(scnfobj.fileno(), 0, access=mmap.ACCESS_READ)
+            buf = np.frombuffer(mm, dtype=np.uint8)
+        else:
+            mm = None
+            buf = np.zeros(0, dtype=np.uint8)
+
+        try:
+            starts, ends = lineOffsets(buf)
+            cols = sceneKeys(buf, starts, ends)
+            if len(starts) > 0 and not cols["valid"].all():
+                bad = np.flatnonzero(~cols["valid"])
+                raise ValueError("{0:d} of {1:d} scene IDs in {2:s} cannot be decoded, e.g. on line {3:d}: {4:s}".format(
+                    len(bad), len(starts), scn_csv, int(np.count_nonzero(buf[:starts[bad[0]]] == NEWLINE)) + 1,
+                    buf[starts[bad[0]]:ends[bad[0]]].tobytes().decode("ascii", "replace")))
+
+            if len(starts) > 0:
+                path, row = cols["path"].astype(np.int64), cols["row"].astype(np.int64)
+                year, doy = cols["year"].astype(np.int64), cols["doy"].astype(np.int64)
+                date_key = (year * 1000 + doy) * 1000000 + path * 1000 + row
+            else:
+                path = row = date_key = np.zeros(0, dtype=np.int64)
+            if balance == "locality":
+                loc_key = (path * 1000 + row) * 10000000 + year * 1000 + doy if len(starts) > 0 else date_key
+                order = np.argsort(loc_key, kind="stable")
+            else:
+                order = np.argsort(date_key, kind="stable")
+            bounds = chunkBounds(date_key[order], (path * 1000 + row)[order], (ends - starts + 1)[order], chunksize, balance)
+
+            outdf_bidx = bounds[:-1] # inclusive
+            outdf_eidx = bounds[1:] # exclusive
+            nchunks = len(outdf_bidx)
+            ndigits = len(str(nchunks))
+
+            outcsv_base, _ = os.path.splitext(os.path.basename(scn_csv))
+            fmt_str = "{{0:s}}_{{1:0{0:d}d}}.csv".format(ndigits)
+            outcsv_list = [os.path.join(outdir, fmt_str.format(outcsv_base, i+1)) for i in range(nchunks)]
+
+            for obi, oei, ocsv in zip(outdf_bidx, outdf_eidx, outcsv_list):
+                idx = order[obi:oei]
+                if balance == "locality":
+                    # Back in the order of date, path and row.
+                    idx = idx[np.argsort(date_key[idx], kind="stable")]
+                with open(ocsv, "wb") as outfobj:
+                    outfobj.write(headerstr)
+                    outfobj.write(b"\n")
+                    if len(idx) > 0:
+                        writeLines(buf, starts[idx], ends[idx], outfobj)
+        finally:
+            # Drop the views of the map before closing it.
+            buf = None
+            if mm is not None:
+                mm.close()
 
 if __name__ == "__main__":
     cmdargs = getCmdArgs()
@@ -32,6 +32,37 @@ Options:
     If set, keep the temporary outputs from the albedo processing
     program. Default: delete them after successful processing.
 
+  --state="STATE_DB", optional
+    SQLite database of the stages done for each scene, see
+    state_store.py. If given, skip the target scene if its albedo is
+    recorded as done and the albedo files are unchanged, record this
+    run, and exit with 2 if the albedo fails.
+
+  --scene="SCENE_NAME", optional
+    Name of the target scene in STATE_DB. Default: the product ID of
+    target_xml.
+
+  --brdf_cache="BRDF_CACHE_DIRECTORY", optional
+    Directory of a cache of BRDF mosaics, see brdf_tiles.py. If given,
+    the BRDF subset made earlier for the same target and helping scenes
+    is linked instead of made again, so it only saves work when the
+    same scenes are processed again. The subsets stay in the cache when
+    the BRDF subset directory is removed. Default: mosaic and subset
+    the BRDF for each scene.
+
+  --brdf_cache_quota="GIGABYTES", optional
+    Maximum size of the BRDF cache; the least recently used mosaics are
+    evicted beyond it. Default: no limit.
+
+  --brdf_group="FILE_OF_XMLS", optional
+    A text file of the xml files of other scenes, one per line, e.g.
+    all the scenes of the day, to share the mosaics of the cache with.
+    The BRDF is mosaicked once for the scenes of the file that need no
+    more tiles than this scene, and the subset then covers the extent
+    of all of them rather than only of this scene and its helping
+    scenes. Only use it if the albedo program is known to give the same
+    albedo for a larger BRDF extent, within its memory.
+
 Arguments:
 
   target_xml, 
@@ -66,6 +97,14 @@ function echoStatStr ()
 {
     echo -e $(date +"%Y-%m-%d %T")" [STA] "'\033[0m'${1}'\033[0m'
 }
+function recordState ()
+{
+    if [[ ${1} -eq 0 ]]; then
+        ${STATE_CMD} --db ${STATE_DB} done ${SCENE} ${STAGE} --outputs "${STATE_OUTPUTS[@]}" || exit 2
+    else
+        ${STATE_CMD} --db ${STATE_DB} fail ${SCENE} ${STAGE} --message "Exit code ${1}"
+    fi
+}
 
 exe_dir=$(readlink -f ${0} | xargs dirname)
 
@@ -75,12 +114,18 @@ run_dir=$(pwd)
 
 MAX_NTILES=9
 
+STATE_CMD="python ${exe_dir}/state_store.py"
+SIN_TILES_CMD="python ${exe_dir}/sin_tiles.py"
+BRDF_TILES_CMD="python ${exe_dir}/brdf_tiles.py"
+STAGE="gen-landsat-albedo"
+STATE_OUTPUTS=()
+
 SNOW=0
 BRDF="MODIS"
 OUTFMT="hdf"
 KEEP_T=0
 KEEP_B=0
-OPTS=`getopt -o s --long od:,snow,brdf:,bd:,of:,keep_t,keep_b -n "${0}" -- "$@"`
+OPTS=`getopt -o s --long od:,snow,brdf:,bd:,of:,keep_t,keep_b,state:,scene:,brdf_cache:,brdf_cache_quota:,brdf_group: -n "${0}" -- "$@"`
 if [[ $? != 0 ]]; then echo "Failed parsing options" >&2 ; echo "${USAGE}" ; exit 1 ; fi
 eval set -- "${OPTS}"
 while true;
@@ -112,6 +157,31 @@ do
             kEEP_T=1 ; shift ;;
         --keep_b )
             kEEP_B=1 ; shift ;;
+        --state )
+            case "${2}" in
+                "") shift 2 ;;
+                *) STATE_DB=${2} ; shift 2 ;;
+            esac ;;
+        --scene )
+            case "${2}" in
+                "") shift 2 ;;
+                *) SCENE=${2} ; shift 2 ;;
+            esac ;;
+        --brdf_cache )
+            case "${2}" in
+                "") shift 2 ;;
+                *) BRDF_CACHE=${2} ; shift 2 ;;
+            esac ;;
+        --brdf_cache_quota )
+            case "${2}" in
+                "") shift 2 ;;
+                *) BRDF_CACHE_OPTS="${BRDF_CACHE_OPTS} --quota ${2}" ; shift 2 ;;
+            esac ;;
+        --brdf_group )
+            case "${2}" in
+                "") shift 2 ;;
+                *) BRDF_CACHE_OPTS="${BRDF_CACHE_OPTS} --group ${2}" ; shift 2 ;;
+            esac ;;
         -- ) shift ; break ;;
         * ) break ;;
     esac
@@ -216,6 +286,17 @@ SCFT_ID=$(grep satellite ${XML_LIST[0]} | cut -d'>' -f2 | cut -d'<' -f1 | xargs)
 dir_o=${OUTDIR}/${PRD_ID}
 dir_i=$(dirname ${XML_LIST[0]})
 dir_b=${dir_o}/brdf
+if [[ ! -z ${STATE_DB} ]]; then
+    if [[ -z ${SCENE} ]]; then
+        SCENE=${PRD_ID}
+    fi
+    if ${STATE_CMD} --db ${STATE_DB} check ${SCENE} ${STAGE} --inputs ${XML_LIST[@]}; then
+        echoWarnStr "Albedo of ${SCENE} is already done, skip!"
+        exit 0
+    fi
+    ${STATE_CMD} --db ${STATE_DB} start ${SCENE} ${STAGE} --inputs ${XML_LIST[@]}
+    trap 'recordState $?' EXIT
+fi
 if [ ! -r $dir_o ]; then
     mkdir -p $dir_o
 else
@@ -223,8 +304,9 @@ else
     # it.
     TMP=($(find ${dir_o} -name ${PRD_ID}"_albedo_*"))
     if [[ ${#TMP[@]} -eq 6 ]]; then
-        echoWarnStr "Warning: ${scene} albedo outputs exists! Skip!"
-        exit 2
+        echoWarnStr "Warning: ${PRD_ID} albedo outputs exists! Skip!"
+        STATE_OUTPUTS=(${TMP[@]})
+        exit 0
     fi
 fi
 if [[ ! -r ${dir_b} ]]; then
@@ -236,21 +318,11 @@ num_f=${#XML_LIST[@]}
 mos_xml_param=${XML_LIST[@]}
 
 # check how many tiles we need. 
-mos_out=$($mos_exe NULL NULL NULL ${num_f} ${mos_xml_param} -p | grep -i "tiles")
-tile_hstr=$(echo ${mos_out} | cut -d',' -f1 | cut -d'h' -f2)
-tile_vstr=$(echo ${mos_out} | cut -d',' -f2 | cut -d'v' -f2 | cut -d'.' -f1)
-tile_hmin=$(echo ${tile_hstr} | cut -d'-' -f1)
-tile_hmax=$(echo ${tile_hstr} | cut -d'-' -f2)
-tile_vmin=$(echo ${tile_vstr} | cut -d'-' -f1)
-tile_vmax=$(echo ${tile_vstr} | cut -d'-' -f2)
+read tile_hmin tile_hmax tile_vmin tile_vmax <<< "$(${SIN_TILES_CMD} xml ${mos_xml_param})"
 if [[ -z ${tile_hmin} || -z ${tile_hmax} || -z ${tile_vmin} || -z ${tile_vmax} ]]; then
     echoErrorStr "Failed to calculate the needed ${BRDF} tiles."
     exit 2
 fi
-tile_hmin=$(( $(echo ${tile_hmin} | sed 's/^0*//') ))
-tile_hmax=$(( $(echo ${tile_hmax} | sed 's/^0*//') ))
-tile_vmin=$(( $(echo ${tile_vmin} | sed 's/^0*//') ))
-tile_vmax=$(( $(echo ${tile_vmax} | sed 's/^0*//') ))
 if [[ ${tile_hmin} -lt 0 || ${tile_hmax} -gt 35 || ${tile_vmin} -lt 0 || ${tile_vmax} -gt 17 ]]; then
    echoErrorStr "Illegal tile numbers"
    exit 2
@@ -269,7 +341,11 @@ for ((i=0; i < ${#brdf_prd[@]}; i++));
 do
     brdf_ss[${i}]=${dir_b}/${brdf_prd[i]}_FOR_${PRD_ID}.${brdf_fmt}
     echoStatStr "Mosaic and subset ${brdf_prd[i]} for $PRD_ID ..."
-    $mos_exe ${BRDFDIR} ${brdf_prd[i]} ${brdf_ss[i]} ${num_f} ${mos_xml_param} -f
+    if [[ -z ${BRDF_CACHE} ]]; then
+        $mos_exe ${BRDFDIR} ${brdf_prd[i]} ${brdf_ss[i]} ${num_f} ${mos_xml_param} -f
+    else
+        ${BRDF_TILES_CMD} --mos_exe ${mos_exe} --bd ${BRDFDIR} --product ${brdf_prd[i]} -o ${brdf_ss[i]} --cache ${BRDF_CACHE} ${BRDF_CACHE_OPTS} ${mos_xml_param}
+    fi
     if [ $? -ne 0 ]; then
         echoErrorStr "mosaic ${brdf_prd[i]} failed for ${num_f} ${mos_xml_param}"
         rm -f ${brdf_ss[i]}
@@ -334,11 +410,13 @@ this_pcf=${dir_o}/${out_prefix}_pcf.ini
 eval "echo \"$(cat ${pcf_template})\"" > ${this_pcf}
 
 ${alb_exe} ${this_pcf}
-if [[ $? -ne 0 ]]; then
+ALB_RET=$?
+if [[ ${ALB_RET} -ne 0 ]]; then
     # Remove every output except PCF file for diagnosis.
     find ${dir_o} -maxdepth 1 -type f ! -name "*.ini" | xargs rm -f
     echoErrorStr "Failed Landsat albedo for $PRD_ID"
 else 
+    STATE_OUTPUTS=($(find ${dir_o} -maxdepth 1 -type f -name "${PRD_ID}_*"))
     echoStatStr "Got Landsat albedo for $PRD_ID"
 fi
 
@@ -353,4 +431,7 @@ if [[ ${KEEP_T} -eq 0 ]]; then
 fi
 
 echo ""
+if [[ ! -z ${STATE_DB} && ${ALB_RET} -ne 0 ]]; then
+    exit 2
+fi
 exit 0
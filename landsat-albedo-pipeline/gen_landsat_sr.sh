@@ -1,7 +1,19 @@
 #!/bin/bash
 
 read -d '' USAGE <<EOF
-$(basename ${0}) --mtl full_path_to_mtl_file
+$(basename ${0}) [options] --mtl full_path_to_mtl_file
+
+Options:
+
+  --state="STATE_DB", optional
+    SQLite database of the stages done for each scene, see
+    state_store.py. If given, skip the scene if its surface reflectance
+    is recorded as done and its output files are unchanged, and record
+    this run.
+
+  --scene="SCENE_NAME", optional
+    Name of the scene in STATE_DB. Default: the product ID of the MTL
+    file.
 
 EOF
 
@@ -21,10 +33,22 @@ function echoStatStr ()
 {
     echo -e $(date +"%Y-%m-%d %T")" [STA] "'\033[0m'${1}'\033[0m'
 }
+function recordState ()
+{
+    if [[ ${1} -eq 0 ]]; then
+        ${STATE_CMD} --db ${STATE_DB} done ${SCENE} ${STAGE} --outputs "${STATE_OUTPUTS[@]}" || exit 2
+    else
+        ${STATE_CMD} --db ${STATE_DB} fail ${SCENE} ${STAGE} --message "Exit code ${1}"
+    fi
+}
+
+STATE_CMD="python $(dirname $(readlink -f ${0}))/state_store.py"
+STAGE="gen-landsat-sr"
+STATE_OUTPUTS=()
 
 RUN_DIR=$(pwd)
 
-OPTS=`getopt -o "" --long mtl: -n "$(basename ${0})" -- "$@"`
+OPTS=`getopt -o "" --long mtl:,state:,scene: -n "$(basename ${0})" -- "$@"`
 if [[ $? != 0 ]]; then echo "Failed to parse options" >&2 ; echo ${USAGE} ; exit 1 ; fi
 eval set -- "${OPTS}"
 while true
@@ -35,6 +59,16 @@ do
                 "") shift 2 ;;
                 *) MTL=${2} ; shift 2 ;;
             esac ;;
+        --state )
+            case "${2}" in
+                "") shift 2 ;;
+                *) STATE_DB=${2} ; shift 2 ;;
+            esac ;;
+        --scene )
+            case "${2}" in
+                "") shift 2 ;;
+                *) SCENE=${2} ; shift 2 ;;
+            esac ;;
         -- ) shift ; break ;;
         * ) break ;;
     esac
@@ -51,6 +85,18 @@ if [[ ! -r ${MTL} ]]; then
     exit 1
 fi
 
+if [[ ! -z ${STATE_DB} ]]; then
+    if [[ -z ${SCENE} ]]; then
+        SCENE=$(basename ${MTL} "_MTL.txt")
+    fi
+    if ${STATE_CMD} --db ${STATE_DB} check ${SCENE} ${STAGE} --inputs ${MTL}; then
+        echoWarnStr "Surface reflectance of ${SCENE} is already done, skip!"
+        exit 0
+    fi
+    ${STATE_CMD} --db ${STATE_DB} start ${SCENE} ${STAGE} --inputs ${MTL}
+    trap 'recordState $?' EXIT
+fi
+
 echoStatStr "Getting surface reflectance from ${MTL}"
 
 # Check solar zenith angle, skip if > 76 deg. 
@@ -99,4 +145,9 @@ echoStatStr "Starting convert_espa_to_gtif for ${XML_FNAME}"
 convert_espa_to_gtif --xml=${XML_FNAME} --gtif=${PRD_ID} --del_src_files
 
 cd ${RUN_DIR}
+if [[ ! -r ${MTLDIR}/${XML_FNAME} ]]; then
+    echoErrorStr "Failed to get surface reflectance from ${MTL}"
+    exit 2
+fi
+STATE_OUTPUTS=($(find ${MTLDIR} -maxdepth 1 -type f -name "${PRD_ID}*"))
 echoStatStr "Got surface reflectance from ${MTL}"
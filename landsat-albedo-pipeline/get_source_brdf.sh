@@ -18,6 +18,16 @@ Options:
     hdf. Notice: at this moment writing h5 is much slower than writing
     hdf for some reason.
 
+  --state="STATE_DB", optional
+    SQLite database of the stages done for each scene, see
+    state_store.py. If given, skip the target scene if its BRDF is
+    recorded as done and the BRDF files are unchanged, and record this
+    run.
+
+  --scene="SCENE_NAME", optional
+    Name of the target scene in STATE_DB. Default: the product ID of
+    target_xml.
+
 Arguments:
 
   target_xml, 
@@ -52,6 +62,14 @@ function echoStatStr ()
 {
     echo -e $(date +"%Y-%m-%d %T")" [STA] "'\033[0m'${1}'\033[0m'
 }
+function recordState ()
+{
+    if [[ ${1} -eq 0 ]]; then
+        ${STATE_CMD} --db ${STATE_DB} done ${SCENE} ${STAGE} --outputs "${STATE_OUTPUTS[@]}" || exit 2
+    else
+        ${STATE_CMD} --db ${STATE_DB} fail ${SCENE} ${STAGE} --message "Exit code ${1}"
+    fi
+}
 
 exe_dir=$(readlink -f ${0} | xargs dirname)
 
@@ -64,9 +82,14 @@ run_dir=$(pwd)
 
 MAX_NTILES=9
 
+STATE_CMD="python ${exe_dir}/state_store.py"
+SIN_TILES_CMD="python ${exe_dir}/sin_tiles.py"
+STAGE="get-source-brdf"
+STATE_OUTPUTS=()
+
 BRDF="MODIS"
 OUTFMT="hdf"
-OPTS=`getopt -o "" --long od:,brdf:,format: -n "${0}" -- "$@"`
+OPTS=`getopt -o "" --long od:,brdf:,format:,state:,scene: -n "${0}" -- "$@"`
 if [[ $? != 0 ]]; then echo "Failed parsing options" >&2 ; echo "${USAGE}" ; exit 1 ; fi
 eval set -- "${OPTS}"
 while true;
@@ -87,6 +110,16 @@ do
                 "") shift 2 ;;
                 *) OUTFMT=${2} ; shift 2 ;;
             esac ;;
+        --state )
+            case "${2}" in
+                "") shift 2 ;;
+                *) STATE_DB=${2} ; shift 2 ;;
+            esac ;;
+        --scene )
+            case "${2}" in
+                "") shift 2 ;;
+                *) SCENE=${2} ; shift 2 ;;
+            esac ;;
         -- ) shift ; break ;;
         * ) break ;;
     esac
@@ -113,12 +146,10 @@ if [[ ${OUTFMT} != "hdf" && ${OUTFMT} != "h5" ]]; then
 fi
 
 if [[ ${BRDF} == "MODIS" ]]; then
-    mos_exe=${alb_dir}/bin/modis_sub2
     brdf_fmt="hdf"
     brdf_vnum="6"
     brdf_prd=("MCD43A1" "MCD43A2")
 elif [[ ${BRDF} == "VIIRS" ]]; then
-    mos_exe=${alb_dir}/bin/viirs_sub2
     brdf_fmt="h5"
     brdf_vnum="5000"
     brdf_prd=("VNP43MA1" "VNP43MA2")
@@ -138,12 +169,6 @@ else
     echoErrorStr "Not found or executable, source BRDF downloading command = ${brdf_dl_cmd}"
     exit 2
 fi
-if [[ -x ${mos_exe} ]]; then
-    echoStatStr "Checked, source BRDF subsetting command = ${mos_exe}"
-else
-    echoErrorStr "Not found or executable, source BRDF subsetting command = ${mos_exe}"
-    exit 2
-fi
 
 # Get product_id
 PRD_ID=$(grep product_id ${XML_LIST[0]} | cut -d'>' -f2 | cut -d'<' -f1 | xargs basename)
@@ -156,21 +181,22 @@ TMP=$(echo ${PRD_ID} | cut -d'_' -f4)
 DOY=$(date -d ${TMP} +%j)
 YEAR=${TMP:0:4}
 
+if [[ ! -z ${STATE_DB} ]]; then
+    if [[ -z ${SCENE} ]]; then
+        SCENE=${PRD_ID}
+    fi
+    if ${STATE_CMD} --db ${STATE_DB} check ${SCENE} ${STAGE} --inputs ${XML_LIST[@]}; then
+        echoWarnStr "${BRDF} BRDF of ${SCENE} is already done, skip!"
+        exit 0
+    fi
+    ${STATE_CMD} --db ${STATE_DB} start ${SCENE} ${STAGE} --inputs ${XML_LIST[@]}
+    trap 'recordState $?' EXIT
+fi
+
 # number of xml files
-num_f=${#XML_LIST[@]}
 mos_xml_param=${XML_LIST[@]}
 # Find the needed MODIS tiles
-mos_out=$($mos_exe NULL NULL NULL ${num_f} ${mos_xml_param} -p | grep -i "tiles")
-
-echoInfoStr "Output from $mos_exe NULL NULL NULL ${num_f} ${mos_xml_param} -p | grep -i \"tiles\""
-echoInfoStr "${mos_out}"
-
-tile_hstr=$(echo ${mos_out} | cut -d',' -f1 | cut -d'h' -f2)
-tile_vstr=$(echo ${mos_out} | cut -d',' -f2 | cut -d'v' -f2 | cut -d'.' -f1)
-tile_hmin=$(echo ${tile_hstr} | cut -d'-' -f1)
-tile_hmax=$(echo ${tile_hstr} | cut -d'-' -f2)
-tile_vmin=$(echo ${tile_vstr} | cut -d'-' -f1)
-tile_vmax=$(echo ${tile_vstr} | cut -d'-' -f2)
+read tile_hmin tile_hmax tile_vmin tile_vmax <<< "$(${SIN_TILES_CMD} xml ${mos_xml_param})"
 if [[ -z ${tile_hmin} || -z ${tile_hmax} || -z ${tile_vmin} || -z ${tile_vmax} ]]; then
     echoErrorStr "Failed to calculate the needed ${BRDF} tiles."
     exit 2
@@ -180,13 +206,6 @@ echoStatStr "Downloading ${BRDF} tiles h${tile_hmin}-${tile_hmax}, v${tile_vmin}
 
 echoInfoStr "hmin = ${tile_hmin}, hmax = ${tile_hmax}, vmin = ${tile_vmin}, vmax = ${tile_vmax}"
 
-tile_hmin=$(( $(echo ${tile_hmin} | sed 's/^0*//') ))
-tile_hmax=$(( $(echo ${tile_hmax} | sed 's/^0*//') ))
-tile_vmin=$(( $(echo ${tile_vmin} | sed 's/^0*//') ))
-tile_vmax=$(( $(echo ${tile_vmax} | sed 's/^0*//') ))
-
-echoInfoStr "hmin = ${tile_hmin}, hmax = ${tile_hmax}, vmin = ${tile_vmin}, vmax = ${tile_vmax}"
-
 if [[ ${tile_hmin} -lt 0 || ${tile_hmax} -gt 35 || ${tile_vmin} -lt 0 || ${tile_vmax} -gt 17 ]]; then
    echoErrorStr "Illegal tile numbers"
    exit 2
@@ -210,6 +229,7 @@ do
         for ((v=${tile_vmin}; v<=${tile_vmax}; v++)); 
         do
             ${brdf_dl_cmd} --user ${brdf_dl_user} --password ${brdf_dl_psw} -f ${brdf_fmt} -t h$(printf %02d ${h})v$(printf %02d ${v}) -y ${YEAR} -p "${brdf_prd[i]}" -n ${brdf_vnum} -o ${OUTDIR} -b ${DOY} -e ${DOY}
+            STATE_OUTPUTS+=($(find ${OUTDIR} -maxdepth 1 -type f -name "${brdf_prd[i]}.A${YEAR}${DOY}.h$(printf %02d ${h})v$(printf %02d ${v}).*"))
         done
     done
 done
@@ -0,0 +1,320 @@
+import os
+import time
+import heapq
+import logging
+import subprocess
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger('landsat-pipeline')
+
+# States of the tasks after a run.
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+class Task(object):
+    """ One command of one stage of the pipeline, usually for one scene.
+
+    :param cmd:
+        Shell command, or a function returning it, which is called when
+        the task is started, e.g. to look for the files made by the
+        tasks before it.
+    :param deps:
+        Names of the tasks that must succeed before this one starts;
+        if one fails, this task is skipped.
+    :param after:
+        Names of the tasks that must only end before this one starts,
+        e.g. the helping scenes of a target scene.
+    :param env:
+        dict of the environment variables to set for the command.
+    :param lock:
+        Tasks with the same lock never run at the same time, e.g. the
+        ones writing the same files.
+    :param check:
+        Function returning True if the outputs of the task are already
+        there from an earlier run, so it is not run again.
+    """
+    def __init__(self, name, stage, cmd, deps=(), after=(), env=None, lock=None, check=None):
+        self.name = name
+        self.stage = stage
+        self.cmd = cmd
+        self.deps = list(deps)
+        self.after = [nm for nm in after if nm not in deps]
+        self.env = env
+        self.lock = lock
+        self.check = check
+
+
+    def command(self):
+        return self.cmd() if callable(self.cmd) else self.cmd
+
+
+def run_command(cmd, log_path=None, env=None):
+    """ Run a shell command with bash, its output appended to log_path
+    (default, to the output of this process).
+    :returns:
+        (int) exit code of the command.
+    """
+    cmd_env = None
+    if env is not None:
+        cmd_env = dict(os.environ)
+        cmd_env.update(env)
+    if log_path is None:
+        return subprocess.call(["/bin/bash", "-c", cmd], env=cmd_env)
+    with open(log_path, "ab") as log_fobj:
+        return subprocess.call(["/bin/bash", "-c", cmd], env=cmd_env,
+                               stdout=log_fobj, stderr=subprocess.STDOUT)
+
+
+def run_bsub(bsub_args, script):
+    """ Submit a job script to LSF and wait for the job to end.
+    :returns:
+        (int) exit code of the job, given by bsub -K.
+    """
+    proc = subprocess.Popen(bsub_args, stdin=subprocess.PIPE)
+    proc.communicate(script.encode("utf-8"))
+    return proc.returncode
+
+
+class LocalExecutor(object):
+    """ Run the tasks on this computer with a pool of processes. """
+    def __init__(self, jobs=1, log_dir=None):
+        self.jobs = max(1, int(jobs))
+        self.log_dir = log_dir
+        self.executor = ProcessPoolExecutor(max_workers=self.jobs)
+
+
+    def submit(self, task, cmd):
+        log_path = None
+        if self.log_dir is not None:
+            log_path = os.path.join(self.log_dir, "{0:s}.log".format(task.name))
+        return self.executor.submit(run_command, cmd, log_path, task.env)
+
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class LsfExecutor(object):
+    """ Run each task as an LSF job, submitted with bsub -K, which
+    returns when the job ends with its exit code, from a pool of threads
+    of up to `jobs` jobs in the queue at a time.
+
+    :param stage_options:
+        dict of the list of bsub options of each stage, e.g.
+        {"gen-landsat-sr": ["-n", "4", "-W", "2:00"]}.
+    """
+    def __init__(self, jobs=100, log_dir=None, stage_options=None, prefix=None):
+        self.jobs = max(1, int(jobs))
+        self.log_dir = log_dir
+        self.stage_options = dict() if stage_options is None else stage_options
+        self.prefix = prefix
+        self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+
+
+    def bsubArgs(self, task):
+        job_name = task.name if self.prefix is None else "{0:s}-{1:s}".format(self.prefix, task.name)
+        args = ["bsub", "-K", "-J", job_name]
+        if self.log_dir is not None:
+            log_base = os.path.join(self.log_dir, task.name)
+            args.extend(["-o", "{0:s}.%J.o".format(log_base), "-e", "{0:s}.%J.e".format(log_base)])
+        args.extend(self.stage_options.get(task.stage, []))
+        if task.env is not None and len(task.env) > 0:
+            args.extend(["-env", ",".join(["all"] + ["{0:s}={1:s}".format(k, str(v)) for k, v in task.env.items()])])
+        return args
+
+
+    def submit(self, task, cmd):
+        # The command is fed to bsub as a job script on its standard
+        # input, so it is not split into arguments again by LSF.
+        return self.executor.submit(run_bsub, self.bsubArgs(task), "#!/bin/bash\n{0:s}\n".format(cmd))
+
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class Pipeline(object):
+    """ A DAG of tasks, each started as soon as the tasks it depends on
+    have ended, instead of after whole stages, so e.g. the surface
+    reflectance of a scene is made while other scenes are still being
+    downloaded.
+
+    :param stages:
+        Names of the stages in their order in the pipeline. Ready tasks
+        of later stages start first, so scenes are finished one after
+        another instead of all being held at an early stage.
+    :param stage_limits:
+        dict of the maximum number of tasks of a stage to run at the
+        same time. Default: only limited by the jobs of the executor.
+    """
+    def __init__(self, stages, stage_limits=None):
+        self.stages = list(stages)
+        self.stage_limits = dict() if stage_limits is None else dict(stage_limits)
+        self.tasks = OrderedDict()
+
+
+    def add(self, task):
+        """ Add a task; the tasks it depends on must have been added
+        before, so the graph has no cycles. """
+        if task.name in self.tasks:
+            raise ValueError("Duplicate task {0:s}".format(task.name))
+        if task.stage not in self.stages:
+            raise ValueError("Unknown stage {0:s} of task {1:s}".format(task.stage, task.name))
+        for nm in task.deps + task.after:
+            if nm not in self.tasks:
+                raise ValueError("Task {0:s} depends on unknown task {1:s}".format(task.name, nm))
+        self.tasks[task.name] = task
+        return task
+
+
+    def run(self, executor):
+        """ Run all the tasks with an executor, LocalExecutor or
+        LsfExecutor. A failed task only stops the tasks that depend on
+        it. Tasks that are up to date by their check, or only needed by
+        tasks that are up to date, are not run.
+        :returns:
+            OrderedDict of the state of each task, DONE, FAILED or
+            SKIPPED.
+        """
+        states = OrderedDict()
+        n_ended = dict((state, 0) for state in (DONE, FAILED, SKIPPED))
+        n_waiting = dict()
+        blocked = set()
+        dependants = dict((nm, []) for nm in self.tasks)
+        for task in self.tasks.values():
+            n_waiting[task.name] = len(task.deps) + len(task.after)
+            for nm in task.deps + task.after:
+                dependants[nm].append(task.name)
+
+        # From the last tasks back to the first ones, so a task whose
+        # outputs were consumed by the tasks after it is not run again.
+        uptodate = set()
+        for task in reversed(list(self.tasks.values())):
+            needed_by = dependants[task.name]
+            if len(needed_by) > 0 and all([nm in uptodate for nm in needed_by]):
+                uptodate.add(task.name)
+            elif task.check is not None and task.check():
+                uptodate.add(task.name)
+        if len(uptodate) > 0:
+            logger.info("{0:d} of {1:d} tasks are up to date from an earlier run.".format(len(uptodate), len(self.tasks)))
+
+        # One heap of ready tasks per stage, in the order they were
+        # added; tasks of later stages are started first, and stages at
+        # their limit are passed over without touching their tasks.
+        # Up-to-date tasks are ended as they come, and tasks whose lock
+        # is held wait for it apart.
+        seq = dict((nm, i) for i, nm in enumerate(self.tasks))
+        ready = dict((st, []) for st in self.stages)
+        ready_uptodate = deque()
+        lock_waiting = dict()
+
+        def push(nm):
+            if nm in uptodate:
+                ready_uptodate.append(nm)
+            else:
+                heapq.heappush(ready[self.tasks[nm].stage], (seq[nm], nm))
+
+        def next_stage():
+            # The last stage with a ready task that is below its limit.
+            for st in reversed(self.stages):
+                limit = self.stage_limits.get(st)
+                if len(ready[st]) > 0 and (limit is None or running[st] < limit):
+                    return st
+            return None
+
+        def finish(nm, state):
+            # Record the end of a task and release the tasks waiting for
+            # it; the ones that depend on a failed task are skipped.
+            stack = [(nm, state)]
+            while len(stack) > 0:
+                nm, state = stack.pop()
+                states[nm] = state
+                n_ended[state] += 1
+                if state == DONE and nm in uptodate:
+                    logger.debug("Task {0:s} up to date.".format(nm))
+                elif state == DONE:
+                    logger.info("Task {0:s} done.".format(nm))
+                elif state == FAILED:
+                    logger.error("Task {0:s} failed.".format(nm))
+                else:
+                    logger.warning("Task {0:s} skipped after a failed task it depends on.".format(nm))
+                for dnm in dependants[nm]:
+                    if state != DONE and nm in self.tasks[dnm].deps:
+                        blocked.add(dnm)
+                    n_waiting[dnm] -= 1
+                    if n_waiting[dnm] == 0:
+                        if dnm in blocked:
+                            stack.append((dnm, SKIPPED))
+                        else:
+                            push(dnm)
+
+        for nm, n in n_waiting.items():
+            if n == 0:
+                push(nm)
+
+        n_total = len(self.tasks)
+        in_flight = dict()
+        running = dict((st, 0) for st in self.stages)
+        locks = set()
+        t0 = time.time()
+        try:
+            while True:
+                while len(in_flight) < executor.jobs:
+                    while len(ready_uptodate) > 0:
+                        finish(ready_uptodate.popleft(), DONE)
+                    st = next_stage()
+                    if st is None:
+                        break
+                    _, nm = heapq.heappop(ready[st])
+                    task = self.tasks[nm]
+                    if task.lock is not None and task.lock in locks:
+                        lock_waiting.setdefault(task.lock, []).append(nm)
+                        continue
+                    try:
+                        cmd = task.command()
+                    except Exception as exc:
+                        logger.error("Making the command of task {0:s} failed: {1:s}".format(task.name, str(exc)))
+                        finish(task.name, FAILED)
+                        continue
+                    logger.info("--> Task {0:s}: {1:s}".format(task.name, cmd))
+                    in_flight[executor.submit(task, cmd)] = task
+                    running[task.stage] += 1
+                    if task.lock is not None:
+                        locks.add(task.lock)
+                if len(in_flight) == 0:
+                    stuck = [st for st in self.stages if len(ready[st]) > 0]
+                    if len(stuck) > 0:
+                        raise RuntimeError("No task can start, check the limits of stages {0:s}".format(
+                            ", ".join(sorted(stuck))))
+                    break
+
+                done, _ = wait(list(in_flight.keys()), return_when=FIRST_COMPLETED)
+                for fut in done:
+                    task = in_flight.pop(fut)
+                    running[task.stage] -= 1
+                    if task.lock is not None:
+                        locks.discard(task.lock)
+                        for nm in lock_waiting.pop(task.lock, []):
+                            push(nm)
+                    exc = fut.exception()
+                    if exc is not None:
+                        logger.error("Running task {0:s} failed: {1:s}".format(task.name, str(exc)))
+                        finish(task.name, FAILED)
+                    elif fut.result() != 0:
+                        logger.error("Task {0:s} exited with code {1:d}".format(task.name, fut.result()))
+                        finish(task.name, FAILED)
+                    else:
+                        finish(task.name, DONE)
+
+                n_done = len(states)
+                n_bad = n_ended[FAILED] + n_ended[SKIPPED]
+                elapsed = time.time() - t0
+                eta = elapsed / n_done * (n_total - n_done) if n_done > 0 else float("nan")
+                logger.info("Progress: {0:d} of {1:d} tasks ended, {2:d} failed or skipped, {3:d} running, {4:.1f} min elapsed, {5:.1f} min left.".format(
+                    n_done, n_total, n_bad, len(in_flight), elapsed / 60., eta / 60.))
+        finally:
+            executor.shutdown()
+
+        return states
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import glob
+import shlex
+import argparse
+import functools
+import logging, logging.config
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "landsat-data-access"))
+from scene_id import parse_scene_ids
+from buffer_scene_list import bufferRows
+from pipeline import Task, Pipeline, LocalExecutor, LsfExecutor, DONE
+from state_store import SceneStateStore, STATE_FNAME
+from sin_tiles import path_row_tiles, num_tiles, MAX_NTILES
+
+LOGGING = {
+    "version" : 1,
+    "disable_existing_loggers" : False,
+    "formatters" : {
+        "default" : {
+            "format" : "%(asctime)s %(levelname)s %(message)s",
+        },
+    },
+    "handlers" : {
+        "console" : {
+            "class" : "logging.StreamHandler",
+            "level" : "DEBUG",
+            "formatter" : "default",
+            "stream" : "ext://sys.stdout",
+        },
+    },
+    "root" : {
+        "handlers" : ["console"],
+        "level" : "DEBUG",
+    },
+}
+logging.config.dictConfig(LOGGING)
+logger = logging.getLogger('landsat-pipeline')
+
+SRC_DIR = os.path.dirname(os.path.realpath(__file__))
+DL_TOA_CMD = "{0:s} {1:s}".format(sys.executable, os.path.join(SRC_DIR, "..", "landsat-data-access", "download_landsat_cloud.py"))
+GEN_SR_CMD = os.path.join(SRC_DIR, "gen_landsat_sr.sh")
+GET_BRDF_CMD = os.path.join(SRC_DIR, "get_source_brdf.sh")
+GEN_ALBEDO_CMD = os.path.join(SRC_DIR, "gen_landsat_albedo.sh")
+STATE_CMD = "{0:s} {1:s}".format(sys.executable, os.path.join(SRC_DIR, "state_store.py"))
+
+STAGES = ["dl-landsat-toa", "gen-landsat-sr", "get-source-brdf", "gen-landsat-albedo", "data-archive"]
+
+# bsub options of the LSF job of one task of each stage.
+LSF_HOSTS = ["-q", "long", "-R", "select[hname!=c24b08 && hname!=c23b04 && hname!=c16b07 && hname!=c31b02]"]
+LSF_STAGE_OPTIONS = {
+    "dl-landsat-toa" : ["-n", "1", "-W", "1:00", "-R", "rusage[mem=512]"] + LSF_HOSTS,
+    "gen-landsat-sr" : ["-n", "4", "-W", "2:00", "-R", "rusage[mem=640]", "-R", "span[hosts=1]"] + LSF_HOSTS,
+    "get-source-brdf" : ["-n", "1", "-W", "1:00", "-R", "rusage[mem=512]", "-R", "span[hosts=1]"] + LSF_HOSTS,
+    "gen-landsat-albedo" : ["-n", "1", "-W", "2:00", "-R", "rusage[mem=9216]", "-R", "span[hosts=1]"] + LSF_HOSTS,
+    "data-archive" : ["-n", "1", "-W", "4:00", "-R", "rusage[mem=64]", "-R", "span[hosts=1]"] + LSF_HOSTS,
+}
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description="Generate Landsat albedo of the scenes in a list, like bsub_landsat_albedo.sh, but run the stages of each scene (download TOA, SR, source BRDF, albedo) as soon as the stages before it are done for this scene and its helping scenes, instead of each stage waiting for the previous one over all the scenes. Tasks run on this computer with a pool of processes, or as LSF jobs.")
+
+    p.add_argument("base_scn_list", metavar="BASE_SCN_LIST", help="A CSV list of scene ID, index URL to the cloud storage, each of which is to be processed to albedo.")
+    p.add_argument("mate_scn_list", metavar="MATE_SCN_LIST", help="A CSV list of scene ID, index URL to the cloud storage; these are additional scenes needed as mate scenes in genearting albedo for the scenes in the base_scn_list.")
+
+    p.add_argument("--od", dest="outdir", required=True, default=None, metavar="OUTPUT_DIRECTORY", help="Output directory to save albedo product files.")
+    p.add_argument("-s", "--snow", dest="snow", required=False, action="store_true", help="Turn on snow-included albedo generation.")
+    p.add_argument("--prefix", dest="prefix", required=False, default="p1", metavar="JOB_NAME_PREFIX", help="A string to label this pipeline, prefixed to the names of its LSF jobs. Default: p1.")
+
+    p.add_argument("--executor", dest="executor", required=False, choices=["local", "lsf"], default="local", help="Run the tasks on this computer with a pool of processes, or submit each as an LSF job with bsub -K. Default: local.")
+    p.add_argument("-j", "--jobs", dest="jobs", required=False, type=int, default=None, metavar="NUM_OF_JOBS", help="Maximum number of tasks to run at the same time: processes with --executor local, jobs in the LSF queue with --executor lsf. Default: 4 local, 200 LSF.")
+    p.add_argument("--stage_jobs", dest="stage_jobs", required=False, nargs="+", default=["dl-landsat-toa=4"], metavar="STAGE=NUM_OF_JOBS", help="Maximum number of tasks of a stage to run at the same time, e.g. gen-landsat-sr=8. Stages: {0:s}. Default: dl-landsat-toa=4.".format(", ".join(STAGES)))
+    p.add_argument("--dl_options", dest="dl_options", required=False, default="", metavar="DOWNLOAD_OPTIONS", help="Options passed on to download_landsat_cloud.py for each scene, e.g. \"--bands albedo --bandwidth 50 --cache_dir /path/to/cache\".")
+    p.add_argument("--state", dest="state_db", required=False, default=None, metavar="STATE_DB", help="SQLite database of the stages done for each scene, with which a pipeline run again on the same lists skips the scenes already processed and only runs the stages that failed or never ran. Default: {0:s} in the output directory.".format(STATE_FNAME))
+    p.add_argument("--force", dest="force", required=False, action="store_true", help="Forget the states recorded by earlier runs in STATE_DB and process all the scenes again.")
+    p.add_argument("--brdf_cache", dest="brdf_cache", required=False, default=None, metavar="BRDF_CACHE_DIRECTORY", help="Directory of a cache of BRDF mosaics, e.g. on shared storage for several pipelines, so the BRDF subset of a target scene with its helping scenes is made only once across the pipelines that use it. A first run gets no speedup from it, as each target scene has its own helping scenes. Default: no cache, unless --brdf_share_day is given, then brdf-mosaics in the output directory, removed with the other data after archiving.")
+    p.add_argument("--brdf_share_day", dest="brdf_share_day", required=False, action="store_true", help="Share one BRDF mosaic between the target scenes of a day that need the same tiles, through the cache of --brdf_cache. The BRDF of a scene then covers the extent of all of them rather than only of the scene and its helping scenes; only use it if the albedo program is known to give the same albedo for a larger BRDF extent, within its memory.")
+    p.add_argument("--brdf_cache_quota", dest="brdf_cache_quota", required=False, type=float, default=None, metavar="GIGABYTES", help="Maximum size of the BRDF cache in GB, if there is one; the least recently used mosaics are evicted beyond it. Default: no limit.")
+    p.add_argument("--tile_lut", dest="tile_lut", required=False, default=None, metavar="TILE_LUT_NPY", help="Lookup table of the MODIS tiles of WRS-2 path/rows, made by sin_tiles.py lut, to plan the BRDF tiles of all the target scenes before any job runs and leave out the ones needing more than {0:d} tiles with their helping scenes. Default: none, such scenes are found by their jobs.".format(MAX_NTILES))
+    p.add_argument("--wait", dest="wait", required=False, default=None, metavar="WAIT_CONDITION_TO_BSUB_WAIT", help="A string in the syntax of bsub waiting condition; with --executor lsf, no scene is downloaded until it is met.")
+
+    p.add_argument("--archive_server_ip", dest="arch_server", required=False, default=None, metavar="SERVER_IP_TO_ARCHIVE_ALBEDO", help="A string of URL or explicit IP address to the server where to store the albedo data.")
+    p.add_argument("--archive_server_dir", dest="arch_dir", required=False, default=None, metavar="SERVER_DIR_TO_ARCHIVE_ALBEDO", help="A string of a directory on the archival server to store the albedo data.")
+    p.add_argument("--archive_server_user", dest="arch_user", required=False, default=None, metavar="USER_NAME_TO_ACCESS_ARCHIVAL_SERVER", help="Your user name to access the archival server.")
+    p.add_argument("--archive_server_key", dest="arch_key", required=False, default=None, metavar="PRIVATE_SSH_KEY_TO_ACCESS_ARCHIVAL_SERVER", help="Your private ssh key on this computer to access the archival server without a password.")
+
+    cmdargs = p.parse_args()
+
+    return cmdargs
+
+
+def readScenes(scn_csv):
+    # Returns the DataFrame of the list and the decoded scene IDs of its
+    # rows; rows that cannot be decoded are dropped.
+    scn_df = pd.read_csv(scn_csv, dtype=str)
+    keys = parse_scene_ids(scn_df.iloc[:, 0], errors="mask")
+    for scn_id in scn_df.loc[~keys["valid"], :].iloc[:, 0]:
+        logger.error("Scene ID {0:s} in {1:s} cannot be decoded, and will be skipped.".format(str(scn_id), scn_csv))
+    return scn_df.loc[keys["valid"], :], keys.loc[keys["valid"], :]
+
+
+def findFile(pattern):
+    # The first file matching a pattern, or raise.
+    fnames = sorted(glob.glob(pattern))
+    if len(fnames) == 0:
+        raise RuntimeError("No file {0:s}".format(pattern))
+    return fnames[0]
+
+
+def srCommand(scn_dir, state_opts):
+    # Returns a function that makes the SR command of a scene when the
+    # task starts, after its MTL file is downloaded.
+    def make():
+        return "{0:s} --mtl={1:s} {2:s}".format(GEN_SR_CMD, shlex.quote(findFile(os.path.join(scn_dir, "*_MTL.txt"))), state_opts)
+    return make
+
+
+def mateCommand(cmd, target_dir, mate_dirs, group_file=None, group_dirs=()):
+    # Returns a function that makes the command of a target scene and
+    # its helping scenes when the task starts, with the .xml of the
+    # helping scenes whose SR is available. The .xml of the scenes in
+    # group_dirs available by then are written to group_file.
+    def make():
+        if group_file is not None:
+            with open(group_file, "w") as fobj:
+                for gdir in group_dirs:
+                    for gxml in sorted(glob.glob(os.path.join(gdir, "*.xml")))[0:1]:
+                        fobj.write("{0:s}\n".format(gxml))
+        xmls = [findFile(os.path.join(target_dir, "*.xml"))]
+        for mdir in mate_dirs:
+            mxml = sorted(glob.glob(os.path.join(mdir, "*.xml")))
+            if len(mxml) > 0:
+                xmls.append(mxml[0])
+        return "{0:s} {1:s}".format(cmd, " ".join([shlex.quote(x) for x in xmls]))
+    return make
+
+
+def planTiles(lut_file, targets, mates):
+    # Log the MODIS tiles needed by the target scenes with their helping
+    # scenes from the lookup table of path/rows, and return the target
+    # scenes that need more than MAX_NTILES tiles, which the BRDF and
+    # albedo scripts would skip.
+    lut = np.load(lut_file, mmap_mode="r")
+    keys = sorted(set(targets + [mk for key in targets for mk in mates[key]]))
+    tiles = path_row_tiles(lut, [k[1] for k in keys], [k[2] for k in keys])
+    key_tiles = dict(zip(keys, zip(*tiles)))
+    too_many = set()
+    tile_days = set()
+    for key in targets:
+        known = [key_tiles[k] for k in [key] + mates[key] if key_tiles[k][0] >= 0]
+        if len(known) == 0:
+            logger.warning("Path/row {0:03d}/{1:03d} of a target scene not in the tile lookup table {2:s}.".format(key[1], key[2], lut_file))
+            continue
+        hmin, hmax = min([t[0] for t in known]), max([t[1] for t in known])
+        vmin, vmax = min([t[2] for t in known]), max([t[3] for t in known])
+        if num_tiles(hmin, hmax, vmin, vmax) > MAX_NTILES:
+            logger.warning("Scene of path/row {0:03d}/{1:03d} on {2:s} needs tiles h{3:02d}-{4:02d}, v{5:02d}-{6:02d}, more than {7:d}, no albedo will be made.".format(
+                key[1], key[2], str(key[0])[:10], hmin, hmax, vmin, vmax, MAX_NTILES))
+            too_many.add(key)
+            continue
+        tile_days.update([(key[0], h, v) for h in range(hmin, hmax+1) for v in range(vmin, vmax+1)])
+    logger.info("BRDF of {0:d} target scenes from {1:d} daily tiles, {2:d} scenes left out for too many tiles.".format(
+        len(targets) - len(too_many), len(tile_days), len(too_many)))
+    return too_many
+
+
+def buildPipeline(cmdargs, outdir, store):
+    toa_sr_dir = os.path.join(outdir, "toa-sr")
+    brdf_dir = os.path.join(outdir, "brdf")
+    albedo_dir = os.path.join(outdir, "albedo")
+    list_dir = os.path.join(outdir, "scene-lists")
+    # The cache only saves work when mosaics are shared, so without
+    # --brdf_cache or --brdf_share_day every BRDF subset is made by
+    # gen_landsat_albedo.sh and removed with its other data.
+    brdf_cache = None
+    if cmdargs.brdf_cache is not None:
+        brdf_cache = os.path.abspath(cmdargs.brdf_cache)
+    elif cmdargs.brdf_share_day:
+        brdf_cache = os.path.join(outdir, "brdf-mosaics")
+    for d in [brdf_dir, albedo_dir, list_dir]:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+
+    stage_limits = dict()
+    for item in cmdargs.stage_jobs:
+        stage, _, n = item.partition("=")
+        if stage not in STAGES:
+            raise RuntimeError("Unknown stage {0:s} in --stage_jobs, must be one of {1:s}".format(stage, ", ".join(STAGES)))
+        stage_limits[stage] = int(n)
+    pipe = Pipeline(STAGES, stage_limits)
+
+    # Scenes by date, path and row, the target scenes first.
+    scenes = dict()
+    targets = []
+    for scn_csv, subdir, is_target in [(cmdargs.base_scn_list, "target-scenes", True),
+                                       (cmdargs.mate_scn_list, "extra-scenes", False)]:
+        scn_df, keys = readScenes(scn_csv)
+        for i in range(len(scn_df)):
+            scn_id = scn_df.iloc[i, 0]
+            key = (keys["date"].iloc[i], int(keys["path"].iloc[i]), int(keys["row"].iloc[i]))
+            if key in scenes:
+                continue
+            scn_dir = os.path.join(toa_sr_dir, subdir, scn_id)
+            scenes[key] = scn_dir
+            if is_target:
+                targets.append(key)
+            # The processing scripts record their stage of the scene.
+            state_opts = "--state={0:s} --scene={1:s}".format(shlex.quote(store.db_file), shlex.quote(scn_id))
+
+            # Download and SR of every scene.
+            dl_dir = os.path.join(toa_sr_dir, subdir)
+            scn_list = os.path.join(list_dir, "{0:s}.csv".format(scn_id))
+            failed_csv = os.path.join(list_dir, "{0:s}.failed.csv".format(scn_id))
+            scn_df.iloc[i:i+1, :].to_csv(scn_list, index=False)
+            # The download fails if the scene is written to its list of
+            # failed scenes.
+            dl_cmd = ("mkdir -p {0:s} && {1:s} -l {2:s} -d {0:s} --failed {3:s} {4:s} && [[ ! -e {3:s} ]] "
+                      + "&& {5:s} --db {6:s} done {7:s} dl-landsat-toa --outputs {8:s}/* "
+                      + "|| {{ {5:s} --db {6:s} fail {7:s} dl-landsat-toa ; exit 1 ; }}").format(
+                          shlex.quote(dl_dir), DL_TOA_CMD, shlex.quote(scn_list), shlex.quote(failed_csv), cmdargs.dl_options,
+                          STATE_CMD, shlex.quote(store.db_file), shlex.quote(scn_id), shlex.quote(scn_dir))
+            pipe.add(Task("dl-{0:s}".format(scn_id), "dl-landsat-toa", dl_cmd,
+                          check=functools.partial(store.isDone, scn_id, "dl-landsat-toa")))
+            pipe.add(Task("sr-{0:s}".format(scn_id), "gen-landsat-sr",
+                          srCommand(scn_dir, state_opts), deps=["dl-{0:s}".format(scn_id)], env={"OMP_THREAD_LIMIT" : "2"},
+                          check=functools.partial(store.isDone, scn_id, "gen-landsat-sr")))
+
+    # BRDF and albedo of the target scenes with the scenes in the rows
+    # before and after them.
+    gen_albedo_cmd = GEN_ALBEDO_CMD + (" -s" if cmdargs.snow else "")
+    if brdf_cache is not None:
+        gen_albedo_cmd += " --brdf_cache={0:s}".format(shlex.quote(brdf_cache))
+        if cmdargs.brdf_cache_quota is not None:
+            gen_albedo_cmd += " --brdf_cache_quota={0:f}".format(cmdargs.brdf_cache_quota)
+    # Scenes by date, whose BRDF may be mosaicked together.
+    date_dirs = dict()
+    for (date, path, row), scn_dir in scenes.items():
+        date_dirs.setdefault(date, []).append(scn_dir)
+    mates = dict()
+    for key in targets:
+        date, path, row = key
+        mate_keys = [(date, path, int(r)) for r in bufferRows(row, (-1, 1)) if r != row]
+        mates[key] = [mk for mk in mate_keys if mk in scenes]
+    too_many = set()
+    if cmdargs.tile_lut is not None:
+        too_many = planTiles(cmdargs.tile_lut, targets, mates)
+    albedo_tasks = []
+    for key in targets:
+        if key in too_many:
+            continue
+        date, path, row = key
+        scn_id = os.path.basename(scenes[key])
+        mate_dirs = [scenes[mk] for mk in mates[key]]
+        mate_sr = ["sr-{0:s}".format(os.path.basename(d)) for d in mate_dirs]
+        state_opts = "--state={0:s} --scene={1:s}".format(shlex.quote(store.db_file), shlex.quote(scn_id))
+        brdf_cmd = "{0:s} --brdf=MODIS --format=hdf --od={1:s} {2:s}".format(GET_BRDF_CMD, shlex.quote(brdf_dir), state_opts)
+        # Scenes of the same day may need the same BRDF tiles.
+        pipe.add(Task("brdf-{0:s}".format(scn_id), "get-source-brdf", mateCommand(brdf_cmd, scenes[key], mate_dirs),
+                      deps=["sr-{0:s}".format(scn_id)], after=mate_sr, lock="brdf-{0:s}".format(str(date)[:10]),
+                      check=functools.partial(store.isDone, scn_id, "get-source-brdf")))
+        albedo_cmd = "{0:s} --brdf=MODIS --bd={1:s} --of=hdf --od={2:s} {3:s}".format(
+            gen_albedo_cmd, shlex.quote(brdf_dir), shlex.quote(albedo_dir), state_opts)
+        group_file = None
+        if cmdargs.brdf_share_day:
+            group_file = os.path.join(list_dir, "{0:s}.brdf-group.txt".format(scn_id))
+            albedo_cmd += " --brdf_group={0:s}".format(shlex.quote(group_file))
+        albedo_tasks.append(pipe.add(Task("albedo-{0:s}".format(scn_id), "gen-landsat-albedo",
+                                          mateCommand(albedo_cmd, scenes[key], mate_dirs, group_file, sorted(date_dirs[date])),
+                                          deps=["brdf-{0:s}".format(scn_id)], after=mate_sr,
+                                          check=functools.partial(store.isDone, scn_id, "gen-landsat-albedo"))).name)
+
+    if cmdargs.arch_server is not None:
+        arch_cmd = "scp -C -v -q -i {0:s} -r {1:s}/* {2:s}@{3:s}:{4:s} && rm -rf {5:s} {6:s} {1:s}".format(
+            shlex.quote(cmdargs.arch_key), shlex.quote(albedo_dir), cmdargs.arch_user, cmdargs.arch_server,
+            shlex.quote(cmdargs.arch_dir), shlex.quote(toa_sr_dir), shlex.quote(brdf_dir))
+        if cmdargs.brdf_cache is None and brdf_cache is not None:
+            arch_cmd += " {0:s}".format(shlex.quote(brdf_cache))
+        pipe.add(Task("archive", "data-archive", arch_cmd, deps=albedo_tasks))
+    return pipe
+
+
+def main(cmdargs):
+    arch_opts = [cmdargs.arch_server, cmdargs.arch_dir, cmdargs.arch_user, cmdargs.arch_key]
+    if any([opt is not None for opt in arch_opts]) and not all([opt is not None for opt in arch_opts]):
+        raise RuntimeError("To archive data on a designated server, the four options must be all given: --archive_server_ip, --archive_server_dir, --archive_server_user, --archive_server_key")
+
+    outdir = os.path.abspath(cmdargs.outdir)
+    log_dir = os.path.join(outdir, "pipe-log")
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    state_db = os.path.join(outdir, STATE_FNAME) if cmdargs.state_db is None else os.path.abspath(cmdargs.state_db)
+    store = SceneStateStore(state_db)
+    if cmdargs.force:
+        logger.info("{0:d} states of earlier runs removed from {1:s}".format(store.reset(), state_db))
+
+    pipe = buildPipeline(cmdargs, outdir, store)
+    if cmdargs.executor == "local":
+        if cmdargs.wait is not None:
+            logger.warning("--wait is only used with --executor lsf.")
+        executor = LocalExecutor(jobs=4 if cmdargs.jobs is None else cmdargs.jobs, log_dir=log_dir)
+    else:
+        stage_options = dict((st, list(opts)) for st, opts in LSF_STAGE_OPTIONS.items())
+        if cmdargs.wait is not None:
+            stage_options["dl-landsat-toa"].extend(["-w", cmdargs.wait])
+        executor = LsfExecutor(jobs=200 if cmdargs.jobs is None else cmdargs.jobs, log_dir=log_dir,
+                               stage_options=stage_options, prefix=cmdargs.prefix)
+
+    try:
+        states = pipe.run(executor)
+    finally:
+        store.close()
+    n_bad = len([st for st in states.values() if st != DONE])
+    logger.info("Landsat albedo pipeline done! {0:d} of {1:d} tasks failed or skipped.".format(n_bad, len(states)))
+    if n_bad > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    cmdargs = getCmdArgs()
+    main(cmdargs)
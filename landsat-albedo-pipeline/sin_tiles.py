@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import sqlite3
+import argparse
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "landsat-data-access"))
+from index_db import INDEX_CHANNELS
+from snapshot import MAX_WRS_PATH, MAX_WRS_ROW
+
+from scene_id import parse_scene_ids
+from buffer_scene_list import bufferRows
+
+# MODIS/VIIRS sinusoidal grid: 36 x 18 tiles of 2400 x 2400 pixels of
+# 463.3 m on a sphere, numbered from the upper left corner.
+EARTH_RADIUS = 6371007.181
+NUM_H_TILES = 36
+NUM_V_TILES = 18
+TILE_SIZE = 2 * np.pi * EARTH_RADIUS / NUM_H_TILES
+
+# Most tiles the albedo scripts mosaic for a scene and its helping
+# scenes; more usually means the scenes cross the edge of the grid.
+MAX_NTILES = 9
+
+# Path and row columns of the index of each server channel.
+PATH_ROW_COLUMNS = dict(google=("WRS_PATH", "WRS_ROW"),
+                        aws=("path", "row"))
+
+def scene_info(xml_path):
+    """ Acquisition date (YYYY-MM-DD) and bounding coordinates (west,
+    east, north, south) of a scene from its ESPA .xml file. """
+    date = None
+    bounds = dict()
+    for _, elem in ET.iterparse(xml_path):
+        tag = elem.tag.split("}")[-1]
+        if tag == "acquisition_date" and date is None:
+            date = elem.text.strip()
+        elif tag in ("west", "east", "north", "south") and tag not in bounds:
+            bounds[tag] = float(elem.text)
+    if date is None or len(bounds) < 4:
+        raise ValueError("No acquisition date or bounding coordinates in {0:s}".format(xml_path))
+    return date, (bounds["west"], bounds["east"], bounds["north"], bounds["south"])
+
+
+def bounds_tiles(west, east, north, south):
+    """ Sinusoidal tiles (hmin, hmax, vmin, vmax) covering boxes of
+    longitude and latitude in degrees, as arrays of the shape of the
+    inputs. Boxes across the antimeridian (west > east) get all the
+    columns of tiles.
+
+    x = R * lon * cos(lat) is linear in longitude and monotonic in
+    cos(lat), so its extremes over a box are on its west or east edge
+    at its north, south or nearest to equator latitude.
+    """
+    west, east, north, south = [np.asarray(a, dtype=np.float64) for a in (west, east, north, south)]
+    cross = west > east
+    west = np.where(cross, -180., west)
+    east = np.where(cross, 180., east)
+    lat0 = np.clip(0., south, north)
+    xs = np.stack([EARTH_RADIUS * np.radians(lon) * np.cos(np.radians(lat))
+                   for lon in (west, east) for lat in (north, south, lat0)])
+    hmin = np.floor((xs.min(axis=0) + NUM_H_TILES / 2 * TILE_SIZE) / TILE_SIZE)
+    hmax = np.floor((xs.max(axis=0) + NUM_H_TILES / 2 * TILE_SIZE) / TILE_SIZE)
+    vmin = np.floor((NUM_V_TILES / 2 * TILE_SIZE - EARTH_RADIUS * np.radians(north)) / TILE_SIZE)
+    vmax = np.floor((NUM_V_TILES / 2 * TILE_SIZE - EARTH_RADIUS * np.radians(south)) / TILE_SIZE)
+    return (np.clip(hmin, 0, NUM_H_TILES - 1).astype(np.int16),
+            np.clip(hmax, 0, NUM_H_TILES - 1).astype(np.int16),
+            np.clip(vmin, 0, NUM_V_TILES - 1).astype(np.int16),
+            np.clip(vmax, 0, NUM_V_TILES - 1).astype(np.int16))
+
+
+def num_tiles(hmin, hmax, vmin, vmax):
+    """ Number of tiles in a mosaic of the tile ranges. """
+    return (np.asarray(hmax) - hmin + 1) * (np.asarray(vmax) - vmin + 1)
+
+
+def xml_tiles(xmls):
+    """ Sinusoidal tiles (hmin, hmax, vmin, vmax) needed to mosaic the
+    BRDF of the scenes of ESPA .xml files together, like the -p option
+    of modis_sub2 but without running it. """
+    bounds = np.array([scene_info(x)[1] for x in xmls], dtype=np.float64).reshape(-1, 4)
+    if len(bounds) == 0:
+        raise ValueError("No .xml files given")
+    hmin, hmax, vmin, vmax = bounds_tiles(bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3])
+    return int(hmin.min()), int(hmax.max()), int(vmin.min()), int(vmax.max())
+
+
+def build_path_row_tiles(db_file, tname="landsat", channel="google"):
+    """ Lookup table of the sinusoidal tiles of each WRS-2 path/row from
+    the union of the footprints of its scenes in an index database.
+    :returns:
+        int16 array of (MAX_WRS_PATH+1, MAX_WRS_ROW+1, 4), the hmin,
+        hmax, vmin and vmax of tiles at [path, row], -1 for the
+        path/rows without any scene in the index.
+    """
+    west, east, south, north = INDEX_CHANNELS[channel]["bounds"]
+    path, row = PATH_ROW_COLUMNS[channel]
+    conn = sqlite3.connect(db_file)
+    try:
+        df = pd.read_sql_query("""
+        SELECT {0:s} AS path, {1:s} AS row, MAX({2:s} > {3:s}) AS cross,
+         MIN({2:s}) AS west, MAX({3:s}) AS east, MAX({5:s}) AS north, MIN({4:s}) AS south
+        FROM "{6:s}"
+        WHERE {2:s} IS NOT NULL AND {3:s} IS NOT NULL AND {4:s} IS NOT NULL AND {5:s} IS NOT NULL
+         AND {0:s} BETWEEN 1 AND {7:d} AND {1:s} BETWEEN 1 AND {8:d}
+        GROUP BY {0:s}, {1:s}""".format(path, row, west, east, south, north, tname, MAX_WRS_PATH, MAX_WRS_ROW), conn)
+    finally:
+        conn.close()
+    # A path/row with a scene across the antimeridian needs all the
+    # columns of tiles anyway.
+    cross = df["cross"].values > 0
+    tiles = bounds_tiles(np.where(cross, 180., df["west"].values), np.where(cross, -180., df["east"].values),
+                         df["north"].values, df["south"].values)
+    lut = np.full((MAX_WRS_PATH + 1, MAX_WRS_ROW + 1, 4), -1, dtype=np.int16)
+    lut[df["path"].values, df["row"].values] = np.stack(tiles, axis=-1)
+    return lut
+
+
+def path_row_tiles(lut, path, row, row_offsets=(0, )):
+    """ Sinusoidal tiles (hmin, hmax, vmin, vmax) of scenes at the
+    arrays of paths and rows together with their scenes in rows at
+    `row_offsets` (e.g. -1, 0, 1 for the helping scenes), from a lookup
+    table of build_path_row_tiles. Rows are clipped to the rows of a
+    path, and rows without any scene in the table are left out; all
+    four are -1 if there is none at all.
+    """
+    path = np.asarray(path, dtype=np.int64)[:, None]
+    row = bufferRows(row, row_offsets)
+    tiles = lut[path, row]
+    known = tiles[:, :, 0] >= 0
+    hmin = np.where(known, tiles[:, :, 0], NUM_H_TILES).min(axis=1)
+    hmax = np.where(known, tiles[:, :, 1], -1).max(axis=1)
+    vmin = np.where(known, tiles[:, :, 2], NUM_V_TILES).min(axis=1)
+    vmax = np.where(known, tiles[:, :, 3], -1).max(axis=1)
+    none = ~known.any(axis=1)
+    return tuple([np.where(none, -1, t).astype(np.int16) for t in (hmin, hmax, vmin, vmax)])
+
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description="Compute the MODIS/VIIRS sinusoidal tiles needed for the BRDF of Landsat scenes, from their .xml files, or for whole scene lists from a lookup table of WRS-2 path/row made from the index of Landsat scenes.")
+
+    sp = p.add_subparsers(dest="action", metavar="ACTION")
+    sp.required = True
+
+    xml_p = sp.add_parser("xml", help="Print the hmin hmax vmin vmax of the tiles to mosaic for the scenes of the .xml files together, e.g. a target scene and its helping scenes.")
+    xml_p.add_argument("xmls", metavar="XML", nargs="+", help="ESPA .xml files of the scenes.")
+
+    lut_p = sp.add_parser("lut", help="Make the lookup table of the tiles of each WRS-2 path/row from an index database of update_landsat_index.py.")
+    lut_p.add_argument("--db", dest="db", required=True, default=None, metavar="INDEX_DB", help="SQLite database of the index of Landsat scenes.")
+    lut_p.add_argument("--table", dest="table", required=False, default="landsat", metavar="TABLE", help="Table of the index in the database. Default: landsat.")
+    lut_p.add_argument("--channel", dest="channel", required=False, choices=list(INDEX_CHANNELS.keys()), default="google", help="Server channel of the index. Default: google.")
+    lut_p.add_argument("-o", "--output", dest="output", required=True, default=None, metavar="LUT_NPY", help="Output .npy file of the lookup table.")
+
+    plan_p = sp.add_parser("plan", help="Write the tiles of each scene of a list with the scenes in its neighboring rows, from the lookup table, and flag the scenes that need more than {0:d} tiles.".format(MAX_NTILES))
+    plan_p.add_argument("--lut", dest="lut", required=True, default=None, metavar="LUT_NPY", help="Lookup table made by the action lut.")
+    plan_p.add_argument("-l", "--list", dest="scn_list", required=True, default=None, metavar="CSV_OF_SCENE_LIST", help="A CSV file of scene list, with the scene IDs or product IDs in the first column.")
+    plan_p.add_argument("--lead", dest="nlead", required=False, type=int, default=1, metavar="NUM_OF_LEADING_ROWS", help="Number of leading rows of helping scenes. Default: 1.")
+    plan_p.add_argument("--trail", dest="ntrail", required=False, type=int, default=1, metavar="NUM_OF_TRAILING_ROWS", help="Number of trailing rows of helping scenes. Default: 1.")
+    plan_p.add_argument("-o", "--output", dest="output", required=True, default=None, metavar="OUTPUT_CSV", help="Output CSV of scene_id,path,row,date,hmin,hmax,vmin,vmax,ntiles,status, where status is ok, too_many, unknown for a path/row not in the lookup table, or invalid for an ID that cannot be decoded.")
+
+    cmdargs = p.parse_args()
+
+    return cmdargs
+
+
+def main(cmdargs):
+    if cmdargs.action == "xml":
+        try:
+            tiles = xml_tiles(cmdargs.xmls)
+        except (ValueError, OSError, ET.ParseError) as exc:
+            sys.stderr.write("Failed to calculate the needed tiles: {0:s}\n".format(str(exc)))
+            return 2
+        sys.stdout.write("{0:d} {1:d} {2:d} {3:d}\n".format(*tiles))
+    elif cmdargs.action == "lut":
+        lut = build_path_row_tiles(cmdargs.db, tname=cmdargs.table, channel=cmdargs.channel)
+        np.save(cmdargs.output, lut)
+        n = np.count_nonzero(lut[:, :, 0] >= 0)
+        n_many = np.count_nonzero((lut[:, :, 0] >= 0) & (num_tiles(*[lut[:, :, i] for i in range(4)]) > MAX_NTILES))
+        sys.stdout.write("Tiles of {0:d} path/rows written to {1:s}, {2:d} of them need more than {3:d} tiles.\n".format(
+            n, cmdargs.output, n_many, MAX_NTILES))
+    elif cmdargs.action == "plan":
+        lut = np.load(cmdargs.lut, mmap_mode="r")
+        scn_df = pd.read_csv(cmdargs.scn_list, usecols=[0])
+        prd_df = parse_scene_ids(scn_df.iloc[:, 0], errors="mask")
+        valid = prd_df["valid"].values
+        hmin, hmax, vmin, vmax = path_row_tiles(lut, prd_df["path"].values, prd_df["row"].values,
+                                                np.arange(-1*cmdargs.ntrail, cmdargs.nlead+1))
+        hmin, hmax, vmin, vmax = [np.where(valid, t, -1) for t in (hmin, hmax, vmin, vmax)]
+        ntiles = np.where(hmin < 0, 0, num_tiles(hmin, hmax, vmin, vmax))
+        status = np.where(~valid, "invalid", np.where(hmin < 0, "unknown", np.where(ntiles > MAX_NTILES, "too_many", "ok")))
+        out_df = pd.DataFrame(dict(scene_id=scn_df.iloc[:, 0].values, path=prd_df["path"].values, row=prd_df["row"].values,
+                                   date=prd_df["date"].dt.strftime("%Y-%m-%d").values,
+                                   hmin=hmin, hmax=hmax, vmin=vmin, vmax=vmax, ntiles=ntiles, status=status),
+                              columns=["scene_id", "path", "row", "date", "hmin", "hmax", "vmin", "vmax", "ntiles", "status"])
+        out_df.to_csv(cmdargs.output, index=False)
+        n_tile_days = len(set([(d, h, v) for d, h0, h1, v0, v1 in zip(out_df["date"], hmin, hmax, vmin, vmax) if h0 >= 0
+                               for h in range(h0, h1+1) for v in range(v0, v1+1)]))
+        sys.stdout.write("{0:d} scenes need {1:d} daily BRDF tiles; {2:d} need more than {3:d} tiles, {4:d} are unknown, {5:d} are invalid.\n".format(
+            len(out_df), n_tile_days, np.count_nonzero(status == "too_many"), MAX_NTILES, np.count_nonzero(status == "unknown"),
+            np.count_nonzero(status == "invalid")))
+    return 0
+
+if __name__ == "__main__":
+    cmdargs = getCmdArgs()
+    sys.exit(main(cmdargs))
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import hashlib
+import argparse
+
+# File name of the state store saved in the output directory of a
+# pipeline.
+STATE_FNAME = ".landsat_pipeline_state.db"
+
+# States of a stage of a scene.
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Size of the blocks read to hash files.
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+
+def file_stamp(path, md5=False):
+    """ [size, mtime, MD5 digest (hex) or None] of a file, or None if it
+    does not exist. """
+    if not os.path.isfile(path):
+        return None
+    st = os.stat(path)
+    digest = None
+    if md5:
+        hasher = hashlib.md5()
+        with open(path, "rb") as fobj:
+            while True:
+                block = fobj.read(READ_BLOCK_SIZE)
+                if len(block) == 0:
+                    break
+                hasher.update(block)
+        digest = hasher.hexdigest()
+    return [st.st_size, st.st_mtime, digest]
+
+
+class SceneStateStore(object):
+    """ A persistent record of the stages of the pipeline done for each
+    scene: their state, inputs and outputs with their size, time of
+    modification and optionally MD5 digest, when and on which host they
+    ran, so that a restarted pipeline skips the stages whose outputs are
+    still there and only runs the ones that failed or never ran.
+
+    The database uses the rollback journal rather than WAL, since the
+    jobs of one pipeline may write to it from many hosts over shared
+    storage.
+    """
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._conn = sqlite3.connect(db_file, timeout=300, isolation_level=None)
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS stages (
+         scene TEXT NOT NULL,
+         stage TEXT NOT NULL,
+         status TEXT NOT NULL,
+         inputs TEXT,
+         outputs TEXT,
+         host TEXT,
+         started REAL,
+         ended REAL,
+         message TEXT,
+         PRIMARY KEY (scene, stage))""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS stages_status ON stages (status, stage)")
+
+
+    @classmethod
+    def forDir(cls, path):
+        """ Open the state store of the output directory `path`. """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        return cls(os.path.join(path, STATE_FNAME))
+
+
+    def get(self, scene, stage):
+        """ Returns the record of a stage of a scene as a dict, or None
+        if it never ran. """
+        cur = self._conn.execute("""
+        SELECT scene, stage, status, inputs, outputs, host, started, ended, message
+        FROM stages WHERE scene = ? AND stage = ?""", (scene, stage))
+        rec = cur.fetchone()
+        if rec is None:
+            return None
+        return self._toDict(rec)
+
+
+    def _toDict(self, rec):
+        keys = ("scene", "stage", "status", "inputs", "outputs", "host", "started", "ended", "message")
+        rec = dict(zip(keys, rec))
+        for k in ("inputs", "outputs"):
+            rec[k] = dict() if rec[k] is None else json.loads(rec[k])
+        return rec
+
+
+    def start(self, scene, stage, inputs=()):
+        """ Record that a stage of a scene starts, with the stamps of
+        its input files. """
+        inputs = dict((os.path.abspath(p), file_stamp(p)) for p in inputs)
+        self._conn.execute("""
+        INSERT OR REPLACE INTO stages (scene, stage, status, inputs, outputs, host, started, ended, message)
+        VALUES (?, ?, ?, ?, NULL, ?, ?, NULL, NULL)""",
+                           (scene, stage, RUNNING, json.dumps(inputs), socket.gethostname(), time.time()))
+
+
+    def markDone(self, scene, stage, outputs=(), md5=False):
+        """ Record that a stage of a scene is done, with the stamps of
+        its output files, and their MD5 digests if `md5`. """
+        outputs = dict((os.path.abspath(p), file_stamp(p, md5=md5)) for p in outputs)
+        missing = [p for p, stamp in outputs.items() if stamp is None]
+        if len(missing) > 0:
+            raise ValueError("Output files of {0:s} of {1:s} not found: {2:s}".format(stage, scene, ", ".join(missing)))
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute("""
+            INSERT OR IGNORE INTO stages (scene, stage, status, host, started)
+            VALUES (?, ?, ?, ?, ?)""", (scene, stage, RUNNING, socket.gethostname(), time.time()))
+            self._conn.execute("""
+            UPDATE stages SET status = ?, outputs = ?, ended = ?, message = NULL
+            WHERE scene = ? AND stage = ?""", (DONE, json.dumps(outputs), time.time(), scene, stage))
+            self._conn.execute("COMMIT")
+        except:
+            self._conn.execute("ROLLBACK")
+            raise
+
+
+    def markFailed(self, scene, stage, message=None):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute("""
+            INSERT OR IGNORE INTO stages (scene, stage, status, host, started)
+            VALUES (?, ?, ?, ?, ?)""", (scene, stage, RUNNING, socket.gethostname(), time.time()))
+            self._conn.execute("""
+            UPDATE stages SET status = ?, outputs = NULL, ended = ?, message = ?
+            WHERE scene = ? AND stage = ?""", (FAILED, time.time(), message, scene, stage))
+            self._conn.execute("COMMIT")
+        except:
+            self._conn.execute("ROLLBACK")
+            raise
+
+
+    def isDone(self, scene, stage, inputs=None, md5=False):
+        """ Whether a stage of a scene is done and its output files are
+        unchanged since. If `inputs` are given, those of them that were
+        recorded as inputs and still exist must be unchanged too, so a
+        stage is run again after its inputs are made again; inputs
+        consumed by the stage may be gone. If `md5`, the outputs
+        recorded with a digest are read again to check it. """
+        rec = self.get(scene, stage)
+        if rec is None or rec["status"] != DONE:
+            return False
+        for p, stamp in rec["outputs"].items():
+            now = file_stamp(p, md5=md5 and stamp[2] is not None)
+            if now is None or now[0:2] != stamp[0:2] or (md5 and stamp[2] is not None and now[2] != stamp[2]):
+                return False
+        for p in (inputs or []):
+            p = os.path.abspath(p)
+            now = file_stamp(p)
+            if p in rec["inputs"] and now is not None and rec["inputs"][p] is not None and now[0:2] != rec["inputs"][p][0:2]:
+                return False
+        return True
+
+
+    def records(self, stage=None, status=None):
+        """ Returns the records of all the scenes, of one stage and/or
+        one state if given, in the order of scene and stage. """
+        sql = """
+        SELECT scene, stage, status, inputs, outputs, host, started, ended, message
+        FROM stages WHERE (? IS NULL OR stage = ?) AND (? IS NULL OR status = ?)
+        ORDER BY scene, stage"""
+        return [self._toDict(rec) for rec in self._conn.execute(sql, (stage, stage, status, status))]
+
+
+    def reset(self, scene=None, stage=None):
+        """ Forget the stages of a scene, or of all scenes, so they run
+        again. """
+        cur = self._conn.execute("""
+        DELETE FROM stages WHERE (? IS NULL OR scene = ?) AND (? IS NULL OR stage = ?)""",
+                                 (scene, scene, stage, stage))
+        return cur.rowcount
+
+
+    def close(self):
+        self._conn.close()
+
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description="Record and query the stages of the albedo pipeline done for each scene, in a SQLite database, so that the processing scripts skip the scenes already processed when a pipeline is run again.")
+
+    p.add_argument("--db", dest="db", required=True, default=None, metavar="STATE_DB", help="SQLite database of the states, e.g. {0:s} in the output directory of a pipeline. Created if it does not exist.".format(STATE_FNAME))
+
+    sp = p.add_subparsers(dest="action", metavar="ACTION")
+    sp.required = True
+
+    check_p = sp.add_parser("check", help="Exit with 0 if a stage of a scene is done and its outputs are unchanged, 1 if not.")
+    start_p = sp.add_parser("start", help="Record that a stage of a scene starts.")
+    done_p = sp.add_parser("done", help="Record that a stage of a scene is done, with its output files.")
+    fail_p = sp.add_parser("fail", help="Record that a stage of a scene failed.")
+    for q in (check_p, start_p, done_p, fail_p):
+        q.add_argument("scene", metavar="SCENE", help="Scene ID or product ID.")
+        q.add_argument("stage", metavar="STAGE", help="Name of the stage, e.g. gen-landsat-sr.")
+    for q in (check_p, start_p):
+        q.add_argument("--inputs", dest="inputs", required=False, nargs="*", default=[], metavar="FILE", help="Input files of the stage; with check, the stage is not done if one of them changed since it started.")
+    for q in (check_p, done_p):
+        q.add_argument("--md5", dest="md5", required=False, action="store_true", help="With done, record the MD5 digests of the outputs; with check, read the outputs again to check them.")
+    done_p.add_argument("--outputs", dest="outputs", required=False, nargs="*", default=[], metavar="FILE", help="Output files of the stage.")
+    fail_p.add_argument("--message", dest="message", required=False, default=None, help="Why the stage failed.")
+
+    list_p = sp.add_parser("list", help="Print the states as CSV of scene,stage,status,host,started,ended,minutes,message.")
+    list_p.add_argument("--stage", dest="stage", required=False, default=None, help="Only this stage.")
+    list_p.add_argument("--status", dest="status", required=False, choices=[RUNNING, DONE, FAILED], default=None, help="Only the stages in this state.")
+
+    reset_p = sp.add_parser("reset", help="Forget the states of a scene, or of all scenes, so they are processed again.")
+    reset_p.add_argument("scene", metavar="SCENE", nargs="?", default=None, help="Scene ID or product ID. Default: all scenes.")
+    reset_p.add_argument("--stage", dest="stage", required=False, default=None, help="Only this stage.")
+
+    cmdargs = p.parse_args()
+
+    return cmdargs
+
+
+def main(cmdargs):
+    store = SceneStateStore(cmdargs.db)
+    try:
+        if cmdargs.action == "check":
+            return 0 if store.isDone(cmdargs.scene, cmdargs.stage, inputs=cmdargs.inputs, md5=cmdargs.md5) else 1
+        elif cmdargs.action == "start":
+            store.start(cmdargs.scene, cmdargs.stage, inputs=cmdargs.inputs)
+        elif cmdargs.action == "done":
+            store.markDone(cmdargs.scene, cmdargs.stage, outputs=cmdargs.outputs, md5=cmdargs.md5)
+        elif cmdargs.action == "fail":
+            store.markFailed(cmdargs.scene, cmdargs.stage, message=cmdargs.message)
+        elif cmdargs.action == "list":
+            fmt_time = lambda t: "" if t is None else time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+            sys.stdout.write("scene,stage,status,host,started,ended,minutes,message\n")
+            for rec in store.records(stage=cmdargs.stage, status=cmdargs.status):
+                minutes = "" if rec["started"] is None or rec["ended"] is None else "{0:.1f}".format((rec["ended"] - rec["started"]) / 60.)
+                sys.stdout.write(",".join([rec["scene"], rec["stage"], rec["status"], rec["host"] or "",
+                                           fmt_time(rec["started"]), fmt_time(rec["ended"]), minutes,
+                                           '"{0:s}"'.format((rec["message"] or "").replace('"', '""'))]))
+                sys.stdout.write("\n")
+        elif cmdargs.action == "reset":
+            n = store.reset(cmdargs.scene, cmdargs.stage)
+            sys.stdout.write("{0:d} states removed.\n".format(n))
+    finally:
+        store.close()
+    return 0
+
+if __name__ == "__main__":
+    cmdargs = getCmdArgs()
+    sys.exit(main(cmdargs))
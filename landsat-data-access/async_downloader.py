@@ -0,0 +1,231 @@
+import os
+import random
+import hashlib
+import asyncio
+import functools
+import logging
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from common import HTTPStatusError, IncompleteDownload
+from downloader import CHUNK_SIZE, MANIFEST_UPDATE_BYTES, resume_offset, check_digest
+from throttle import SLOT_POLL
+from verify import md5_from_headers, file_md5
+
+logger = logging.getLogger('landsat-downloader')
+
+def _url_host(url):
+    return "/".join(url.split("/")[0:3])
+
+
+class AsyncDownloader(object):
+    """ Download the files of many scenes on one asyncio event loop.
+
+    Requests to the same host share one aiohttp session with a pool
+    of at most `host_connections` kept-alive connections, so the many
+    small text files of a scene do not each pay a TCP and TLS
+    handshake. The size check (HEAD) of a file and the transfer (GET)
+    of other files are in flight on the pool at the same time. Like
+    Downloader, at most `workers` files are in flight over all the
+    scenes and at most `scene_workers` of them belong to one scene.
+    With a Throttle, the transfers share the bandwidth and connection
+    limits of the node and failed requests are retried. The writes to
+    disk and the updates of the manifest run in the thread pool of the
+    loop, so they do not hold up the other transfers. Requires the
+    aiohttp package.
+    """
+    def __init__(self, workers=16, scene_workers=None, host_connections=8,
+                 show_progress=False, manifest=None, timeout=60, throttle=None):
+        if aiohttp is None:
+            raise RuntimeError("The async download backend requires the aiohttp package.")
+        self.workers = max(1, int(workers))
+        if scene_workers is None:
+            scene_workers = self.workers
+        self.scene_workers = max(1, min(int(scene_workers), self.workers))
+        self.host_connections = max(1, int(host_connections))
+        self.show_progress = show_progress
+        self.manifest = manifest
+        self.timeout = timeout
+        self.throttle = throttle
+
+
+    async def _remoteSize(self, session, url):
+        # Returns the size and the MD5 digest given by the server, and
+        # raises HTTPStatusError on an error status like fetch_file.
+        try:
+            async with session.head(url, allow_redirects=True) as resp:
+                if resp.status < 200 or resp.status >= 300:
+                    raise HTTPStatusError(url, resp.status, resp.headers.get("Retry-After"))
+                return int(resp.headers["content-length"]), md5_from_headers(resp.headers)
+        except (KeyError, ValueError, aiohttp.ClientError):
+            return None, None
+
+
+    async def _blocking(self, fn, *args):
+        # Run file and manifest I/O, which blocks, in the default thread
+        # pool of the loop, so the other transfers go on meanwhile.
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args))
+
+
+    def _writeBlock(self, fobj, md5, block, url, written, last_update):
+        # Write and hash a block of received data, and record the
+        # progress in the manifest every so often. Runs off the loop.
+        # Returns the bytes written, the bytes at the last update of the
+        # manifest and the seconds to wait for the bandwidth limit.
+        fobj.write(block)
+        md5.update(block)
+        written += len(block)
+        if self.manifest is not None and written - last_update >= MANIFEST_UPDATE_BYTES:
+            fobj.flush()
+            self.manifest.progress(url, written)
+            last_update = written
+        delay = self.throttle.reserve(len(block)) if self.throttle is not None else 0.
+        return written, last_update, delay
+
+
+    async def _fetch(self, session, scn_name, url, local_path):
+        # Same steps as downloader.fetch_file, with the blocking ones in
+        # the thread pool.
+        manifest = self.manifest
+        if manifest is not None and await self._blocking(manifest.isComplete, url, local_path):
+            return 0
+        if self.show_progress:
+            print("{0:s} : {1:s} ".format(scn_name, url.split('/')[-1]))
+
+        expected_size, expected_md5 = await self._remoteSize(session, url)
+        if manifest is not None:
+            await self._blocking(manifest.register, url, scn_name, local_path, expected_size)
+
+        offset = await self._blocking(resume_offset, local_path, expected_size)
+        if offset == expected_size and await self._blocking(os.path.isfile, local_path):
+            if manifest is not None:
+                await self._blocking(manifest.markComplete, url, offset)
+            return 0
+
+        headers = dict()
+        if offset > 0:
+            headers["Range"] = "bytes={0:d}-".format(offset)
+        async with session.get(url, headers=headers) as resp:
+            if resp.status == 206:
+                mode = "ab"
+            elif resp.status == 200:
+                # The server ignored the range request, start over.
+                mode = "wb"
+                offset = 0
+            else:
+                raise HTTPStatusError(url, resp.status, resp.headers.get("Retry-After"))
+
+            if mode == "wb" and os.path.lexists(local_path):
+                # Unlink rather than truncate, as the file may be a hard
+                # link to a file of the scene cache.
+                await self._blocking(os.remove, local_path)
+            written = offset
+            last_update = written
+            md5 = await self._blocking(file_md5, local_path, offset) if offset > 0 else hashlib.md5()
+            fobj = await self._blocking(open, local_path, mode)
+            try:
+                # Gather the chunks of the stream into blocks of
+                # CHUNK_SIZE, to hand them to the thread pool at once.
+                buf = bytearray()
+                async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                    buf += chunk
+                    if len(buf) < CHUNK_SIZE:
+                        continue
+                    block, buf = bytes(buf), bytearray()
+                    written, last_update, delay = await self._blocking(
+                        self._writeBlock, fobj, md5, block, url, written, last_update)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                if len(buf) > 0:
+                    written, last_update, _ = await self._blocking(
+                        self._writeBlock, fobj, md5, bytes(buf), url, written, last_update)
+            finally:
+                await self._blocking(fobj.close)
+
+        if manifest is not None:
+            await self._blocking(manifest.progress, url, written)
+        if expected_size is not None and written != expected_size:
+            raise IncompleteDownload("Incomplete download of {0:s}: {1:d} of {2:d} bytes".format(url, written, expected_size))
+        await self._blocking(check_digest, url, local_path, md5.hexdigest(), expected_md5, manifest)
+        if manifest is not None:
+            await self._blocking(manifest.markComplete, url, written, md5.hexdigest())
+        return written - offset
+
+
+    async def _fetchRetrying(self, session, scn_name, url, local_path):
+        throttle = self.throttle
+        if throttle is None:
+            return await self._fetch(session, scn_name, url, local_path)
+        attempt = 0
+        while True:
+            slot = throttle.tryHostSlot(url)
+            while slot is None:
+                await asyncio.sleep(SLOT_POLL * random.uniform(0.5, 1.5))
+                slot = throttle.tryHostSlot(url)
+            try:
+                return await self._fetch(session, scn_name, url, local_path)
+            except Exception as exc:
+                delay = throttle.retryDelay(attempt, exc)
+                if delay is None:
+                    raise
+                attempt += 1
+                logger.warning("Request of {0:s} failed ({1:s}), retry {2:d} of {3:d} in {4:.1f} s.".format(
+                    url, str(exc), attempt, throttle.retries, delay))
+            finally:
+                throttle.releaseHostSlot(slot)
+            await asyncio.sleep(delay)
+
+
+    async def _runJobs(self, jobs):
+        sessions = dict()
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout)
+        workers = asyncio.Semaphore(self.workers)
+        scene_slots = dict((scn_name, asyncio.Semaphore(self.scene_workers)) for scn_name, _, _ in jobs)
+        failed = dict()
+
+        def session_of(url):
+            host = _url_host(url)
+            if host not in sessions:
+                connector = aiohttp.TCPConnector(limit=self.host_connections,
+                                                 limit_per_host=self.host_connections)
+                sessions[host] = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            return sessions[host]
+
+        async def one_file(scn_name, url, dest_dir):
+            async with scene_slots[scn_name]:
+                async with workers:
+                    try:
+                        await self._fetchRetrying(session_of(url), scn_name, url,
+                                                  os.path.join(dest_dir, url.split('/')[-1]))
+                    except Exception as exc:
+                        logger.error("Downloading {0:s} failed: {1:s}".format(url, str(exc)))
+                        failed.setdefault(scn_name, []).append((url, exc))
+
+        # Interleave the files of the scenes so the semaphores, which
+        # wake their waiters in order, hand them out round-robin.
+        queues = [[(scn_name, url, dest_dir) for url in urls] for scn_name, urls, dest_dir in jobs]
+        order = []
+        for i in range(max([len(q) for q in queues] or [0])):
+            order.extend([q[i] for q in queues if i < len(q)])
+        try:
+            await asyncio.gather(*[one_file(*job) for job in order])
+        finally:
+            for session in sessions.values():
+                await session.close()
+        return failed
+
+
+    def run(self, jobs):
+        """ Download all the files of the given scenes.
+        :param jobs:
+            List of tuples (scene name, list of file urls, output
+            directory of the scene).
+        :returns:
+            (dict) scene name -> list of (url, exception) of the
+            files that failed. Scenes with all files downloaded are
+            not in the dict.
+        """
+        return asyncio.run(self._runJobs(jobs))
@@ -2,10 +2,12 @@ import re
 import datetime
 import os
 import sys
+import threading
 
 import numpy as np
 
 import requests
+from requests.adapters import HTTPAdapter
 from wordpad import pad
 
 # AWS S3 now only hosts Landsat-8
@@ -47,6 +49,56 @@ GOOGLE_LANDSAT_DTYPE = dict(SCENE_ID = str,
                             TOTAL_SIZE = np.uint64,
                             BASE_URL = str)
 
+# Number of keep-alive connections kept per host by a shared session.
+HTTP_POOL_SIZE = 16
+
+_sessions = dict()
+_sessions_lock = threading.Lock()
+
+class RemoteFileDoesntExist(Exception):
+    """ Exception raised when a remote file does not exist. """
+    pass
+
+
+class HTTPStatusError(IOError):
+    """ Exception raised when the server answers a request with an
+    error status. """
+    def __init__(self, url, status, retry_after=None):
+        super(HTTPStatusError, self).__init__("HTTP status {0:d} for {1:s}".format(status, url))
+        self.url = url
+        self.status = status
+        # Value of the Retry-After header of the answer, if any.
+        self.retry_after = retry_after
+
+
+class IncompleteDownload(IOError):
+    """ Exception raised when the server closes a transfer before the
+    whole file was received. """
+    pass
+
+
+def get_session(url):
+    """ Returns the requests.Session shared by all the requests to the
+    host of a url, so the requests reuse kept-alive connections
+    instead of paying a TCP and TLS handshake each.
+    :param url:
+        The url to request.
+    :type url:
+        String
+    :returns:
+        requests.Session
+    """
+    host = "/".join(url.split("/")[0:3])
+    with _sessions_lock:
+        if host not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[host] = session
+        return _sessions[host]
+
+
 def check_create_folder(folder_path):
     """ Check whether a folder exists, if not the folder is created.
     :param folder_path:
@@ -62,6 +114,23 @@ def check_create_folder(folder_path):
     return folder_path
 
 
+def get_remote_file_headers(url):
+    """ Gets the headers of a remote file.
+    :param url:
+        The url that has to be checked.
+    :type url:
+        String
+    :returns:
+        case-insensitive dict of headers
+    :raises HTTPStatusError:
+        if the server answers with an error status, e.g. 404 or 503.
+    """
+    resp = get_session(url).head(url, allow_redirects=True, timeout=60)
+    if resp.status_code < 200 or resp.status_code >= 300:
+        raise HTTPStatusError(url, resp.status_code, resp.headers.get("Retry-After"))
+    return resp.headers
+
+
 def get_remote_file_size(url):
     """ Gets the filesize of a remote file.
     :param url:
@@ -71,8 +140,7 @@ def get_remote_file_size(url):
     :returns:
         int
     """
-    headers = requests.head(url).headers
-    return int(headers['content-length'])
+    return int(get_remote_file_headers(url)['content-length'])
 
 
 def remote_file_exists(url):
@@ -84,7 +152,7 @@ def remote_file_exists(url):
         :returns:
             **True** if remote file exists and **False** if it doesn't exist.
         """
-        status = requests.head(url).status_code
+        status = get_session(url).head(url, allow_redirects=True, timeout=60).status_code
 
         if status == 200:
             return True
@@ -5,12 +5,13 @@ import argparse
 import textwrap
 import logging, logging.config
 
-import pandas as pd
-
-from landsat import Landsat
+from manifest import MANIFEST_FNAME
+from scheduler import DownloadScheduler
+from throttle import Throttle, THROTTLE_DIR
 
 LOGGING = {
     "version" : 1, 
+    "disable_existing_loggers" : False, 
     "formatters" : {
         "default" : {
             "format" : "%(asctime)s %(levelname)s %(message)s", 
@@ -42,76 +43,64 @@ def getCmdArgs():
 
     p.add_argument("-d", "--directory", dest="outdir", required=True, metavar="OUTPUT_DIRECTORY", default=None, help=textwrap.fill("Output directory to save the Landsat data."))
 
-    cmdargs = p.parse_args()
-    
-    return cmdargs
+    p.add_argument("-j", "--jobs", dest="jobs", required=False, type=int, metavar="NUM_OF_JOBS", default=1, help=textwrap.fill("Number of batches of scenes to download at the same time, each with its own --workers. Default: 1."))
+    p.add_argument("--batch_size", dest="batch_size", required=False, type=int, metavar="NUM_OF_SCENES", default=50, help=textwrap.fill("Number of scenes of the same repository and spacecraft downloaded together as one batch. Default: 50."))
+    p.add_argument("--pool", dest="pool", required=False, choices=["process", "thread"], default="process", help=textwrap.fill("Run the --jobs batches in a pool of processes or of threads. Default: 'process'."))
+    p.add_argument("--failed", dest="failed_csv", required=False, default=None, metavar="CSV_OF_FAILED_SCENES", help=textwrap.fill("A CSV file to write the rows of the scene list that failed to, in the same format, to retry them with -l. Not written if all scenes succeed. Default: failed_scenes.csv in the output directory."))
+
+    p.add_argument("-w", "--workers", dest="workers", required=False, type=int, metavar="NUM_OF_WORKERS", default=4, help=textwrap.fill("Maximum number of files to download at the same time over all the scenes. Default: 4."))
+    p.add_argument("--scene_workers", dest="scene_workers", required=False, type=int, metavar="NUM_OF_WORKERS_PER_SCENE", default=None, help=textwrap.fill("Maximum number of files of one scene to download at the same time. Default: same as --workers."))
 
+    p.add_argument("--bands", dest="bands", required=False, nargs="+", metavar="BAND", default=["all"], help=textwrap.fill("Files of each scene to download: a preset, 'all', 'sr' (the inputs of gen_landsat_sr.sh, i.e. without the panchromatic band and, for Landsat 8, the thermal bands) or 'albedo' (the inputs of gen_landsat_sr.sh and gen_landsat_albedo.sh); or a list of bands by their file name suffix, e.g. B4 B5 BQA ANG. The _MTL.txt file is always downloaded. Default: all."))
 
-def scnIdToSpacecraftId(scn_id):
-    sc_code = int(scn_id[2])
-    if sc_code != 5 and sc_code != 7 and sc_code != 8:
-        return None
-    return "LANDSAT_{0:d}".format(sc_code)
+    p.add_argument("--backend", dest="backend", required=False, choices=["threads", "async"], default="threads", help=textwrap.fill("How to run the downloads. 'threads': a pool of threads of the size of --workers; 'async': one event loop with many downloads in flight, suited to a large --workers (requires the aiohttp package). Both reuse kept-alive connections to a server. Default: 'threads'."))
+    p.add_argument("--host_connections", dest="host_connections", required=False, type=int, metavar="NUM_OF_CONNECTIONS", default=8, help=textwrap.fill("Maximum number of connections open to one server with --backend async. Default: 8."))
 
+    p.add_argument("--bandwidth", dest="bandwidth", required=False, type=float, metavar="MB_PER_SECOND", default=None, help=textwrap.fill("Maximum total download rate in MB/s of all the download jobs on this node that share the same --throttle_dir. Default: no limit."))
+    p.add_argument("--node_connections", dest="node_connections", required=False, type=int, metavar="NUM_OF_CONNECTIONS", default=None, help=textwrap.fill("Maximum number of files downloaded at the same time from one server by all the download jobs on this node that share the same --throttle_dir. Default: no limit."))
+    p.add_argument("--retries", dest="retries", required=False, type=int, metavar="NUM_OF_RETRIES", default=5, help=textwrap.fill("Number of times to retry a file after the server throttles the request (HTTP 429, 503), fails with a transient error or drops the connection, waiting an exponentially growing, randomized delay, or the delay asked by the server, in between. Default: 5."))
+    p.add_argument("--throttle_dir", dest="throttle_dir", required=False, default=THROTTLE_DIR, metavar="LOCK_DIRECTORY", help=textwrap.fill("Local directory of the lock files through which the download jobs on this node share --bandwidth and --node_connections. Default: {0:s}.".format(THROTTLE_DIR)))
 
-def indexUrlToBucketId(index_url):
-    if index_url[0:2] == "gs" or index_url.find("googleapi.com") > -1:
-        return "GOOGLE"
-    elif index_url.find("amazonaws.com"):
-        return "AWS"
-    else:
-        return None
+    p.add_argument("--cache_dir", dest="cache_dir", required=False, default=None, metavar="SCENE_CACHE_DIRECTORY", help=textwrap.fill("Directory of a scene cache shared by download jobs, e.g. on shared storage for all the LSF jobs of a project. Files in the cache with the same size and ETag as on the server are hard-linked (or reflinked, or copied across file systems) to the output directory instead of downloaded, and downloaded files are added to the cache. Files from the cache are read-only. Default: no cache."))
+    p.add_argument("--cache_quota", dest="cache_quota", required=False, type=float, metavar="GIGABYTES", default=None, help=textwrap.fill("Maximum size of the scene cache in GB; the least recently used files are evicted beyond it. Default: no limit."))
+
+    p.add_argument("--no_resume", dest="resume", required=False, action="store_false", help=textwrap.fill("Download every file again instead of skipping the files completed by an earlier run and resuming the partial ones, as recorded in the download manifest {0:s} in the output directory.".format(MANIFEST_FNAME)))
+
+    cmdargs = p.parse_args()
+    
+    return cmdargs
 
 
 def main(cmdargs):
     scn_csv = cmdargs.scn_list
     outdir = cmdargs.outdir
+    cache_quota = None if cmdargs.cache_quota is None else int(cmdargs.cache_quota * 1024**3)
+    failed_csv = cmdargs.failed_csv
+    if failed_csv is None:
+        failed_csv = os.path.join(outdir, "failed_scenes.csv")
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    bandwidth = None if cmdargs.bandwidth is None else cmdargs.bandwidth * 1024**2
+    throttle = Throttle(bandwidth=bandwidth, host_connections=cmdargs.node_connections, 
+                        retries=cmdargs.retries, lock_dir=cmdargs.throttle_dir)
+
+    save_kwargs = dict(show_progress=False, 
+                       workers=cmdargs.workers, 
+                       scene_workers=cmdargs.scene_workers, 
+                       resume=cmdargs.resume, 
+                       backend=cmdargs.backend, 
+                       host_connections=cmdargs.host_connections, 
+                       cache_dir=cmdargs.cache_dir, 
+                       cache_quota=cache_quota, 
+                       throttle=throttle)
+    scheduler = DownloadScheduler(outdir, jobs=cmdargs.jobs, batch_size=cmdargs.batch_size, 
+                                  pool=cmdargs.pool, bands=cmdargs.bands, 
+                                  save_kwargs=save_kwargs, failed_csv=failed_csv)
+    n_good, n_bad = scheduler.run(scn_csv)
 
-    repo_ch_list = ["GOOGLE", "AWS"]
-    landsat_obj_dict = {}
-    for repo in repo_ch_list:
-        if repo == "GOOGLE":
-            scft_id_list = ["LANDSAT_5", "LANDSAT_7", "LANDSAT_8"]
-        elif repo == "AWS":
-            scft_id_list = ["LANDSAT_8"]
-        else:
-            scft_id_list = []
-        for scft in scft_id_list:
-            landsat_obj_dict[(repo, scft)] = Landsat(scft, repo)
-
-    n_good = 0
-    n_bad = 0
-
-    chunksize = int(1e3)
-    for scn_df in pd.read_csv(scn_csv, usecols=[0, 1], chunksize=chunksize):
-        for idx, row in enumerate(scn_df.itertuples()):
-            scft_id = scnIdToSpacecraftId(row[1])
-            if scft_id is None:
-                logger.error(("Scene ID {0:s} cannot be parsed to " + 
-                              "Landsat spacecraft ID, and will be skipped.").format(row[1]))
-                n_bad += 1
-                continue
-            repo_ch = indexUrlToBucketId(row[2])
-            if repo_ch is None:
-                logger.error(("Scene index url {0:s} cannot be parsed " 
-                              + "to public data repository channel name, " 
-                              + "and will be skipped.").format(row[2]))
-                n_bad += 1
-                continue
-
-            landsat_obj = landsat_obj_dict[(repo_ch, scft_id)]
-            if landsat_obj.addScene(row[1], row[2]) is None:
-                logger.error("Adding scene {0:s} to the download queue failed, and will be skipped.".format(row[1]))
-                n_bad += 1
-                continue
-            logger.info("Saving scene {0:s} started.".format(row[1]))
-            landsat_obj.saveToDir(outdir)
-            landsat_obj.clearScenes()
-            n_good += 1
-            
     logger.info("{0:d} scenes saved to {1:s}".format(n_good, outdir))
     if n_bad > 0:
-        logger.warning("{0:d} scenes failed to download.".format(n_bad))
+        logger.warning("{0:d} scenes failed to download, listed in {1:s} to retry with -l.".format(n_bad, failed_csv))
 
 if __name__ == "__main__":
     cmdargs = getCmdArgs()
@@ -0,0 +1,208 @@
+import os
+import hashlib
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+from common import get_remote_file_headers, get_session, HTTPStatusError, IncompleteDownload
+from verify import ChecksumMismatch, md5_from_headers, file_md5
+
+logger = logging.getLogger('landsat-downloader')
+
+# Size of the blocks read from the server and written to disk.
+CHUNK_SIZE = 1024 * 1024
+# Write the progress of a file to the manifest every so many bytes.
+MANIFEST_UPDATE_BYTES = 16 * CHUNK_SIZE
+
+def resume_offset(local_path, expected_size):
+    """ Offset to resume the download of a file to `local_path` from:
+    the size of a partial file, 0 to start over, or `expected_size`
+    if the file is already complete. """
+    if not os.path.isfile(local_path):
+        return 0
+    offset = os.path.getsize(local_path)
+    if expected_size is None or offset > expected_size:
+        return 0
+    return offset
+
+
+def check_digest(url, local_path, digest, expected_md5, manifest=None):
+    """ Raise ChecksumMismatch if a downloaded file does not have the
+    digest given by the server, after removing the file so that it
+    is downloaded again from the start. """
+    if expected_md5 is None or digest == expected_md5:
+        return
+    os.remove(local_path)
+    if manifest is not None:
+        manifest.progress(url, 0)
+    raise ChecksumMismatch("MD5 of {0:s} is {1:s}, expected {2:s}".format(url, digest, expected_md5))
+
+
+def fetch_file(url, local_path, manifest=None, scene=None, timeout=60, throttle=None):
+    """ Download `url` to `local_path`, resuming a partial download.
+    The MD5 digest of the file is computed from the received bytes and
+    checked against the one given by the server, if any.
+    :param manifest:
+        A DownloadManifest to skip the file if it was completely
+        downloaded before and to record the progress of this download.
+    :param throttle:
+        A Throttle to take bandwidth from for the received data.
+    :returns:
+        (int) number of bytes transferred in this call, 0 if the file
+        was skipped.
+    """
+    if manifest is not None and manifest.isComplete(url, local_path):
+        return 0
+
+    try:
+        headers = get_remote_file_headers(url)
+        expected_size = int(headers['content-length'])
+        expected_md5 = md5_from_headers(headers)
+    except (KeyError, ValueError, requests.RequestException):
+        expected_size = None
+        expected_md5 = None
+    if manifest is not None:
+        manifest.register(url, scene, local_path, expected_size)
+
+    offset = resume_offset(local_path, expected_size)
+    if os.path.isfile(local_path) and offset == expected_size:
+        if manifest is not None:
+            manifest.markComplete(url, offset)
+        return 0
+
+    headers = dict()
+    if offset > 0:
+        headers["Range"] = "bytes={0:d}-".format(offset)
+    resp = get_session(url).get(url, headers=headers, stream=True, timeout=timeout)
+    try:
+        if resp.status_code == 206:
+            mode = "ab"
+        elif resp.status_code == 200:
+            # The server ignored the range request, start over.
+            mode = "wb"
+            offset = 0
+        else:
+            raise HTTPStatusError(url, resp.status_code, resp.headers.get("Retry-After"))
+
+        if mode == "wb" and os.path.lexists(local_path):
+            # Unlink rather than truncate, as the file may be a hard
+            # link to a file of the scene cache.
+            os.remove(local_path)
+        written = offset
+        last_update = written
+        # Hash the partial file once, then the bytes as they come in.
+        md5 = file_md5(local_path, offset) if offset > 0 else hashlib.md5()
+        with open(local_path, mode) as fobj:
+            for block in resp.iter_content(chunk_size=CHUNK_SIZE):
+                fobj.write(block)
+                md5.update(block)
+                written += len(block)
+                if throttle is not None:
+                    throttle.consume(len(block))
+                if manifest is not None and written - last_update >= MANIFEST_UPDATE_BYTES:
+                    fobj.flush()
+                    manifest.progress(url, written)
+                    last_update = written
+    finally:
+        resp.close()
+
+    if manifest is not None:
+        manifest.progress(url, written)
+    if expected_size is not None and written != expected_size:
+        raise IncompleteDownload("Incomplete download of {0:s}: {1:d} of {2:d} bytes".format(url, written, expected_size))
+    check_digest(url, local_path, md5.hexdigest(), expected_md5, manifest)
+    if manifest is not None:
+        manifest.markComplete(url, written, md5.hexdigest())
+
+    return written - offset
+
+
+class Downloader(object):
+    """ Download the files of many scenes with a bounded pool of worker
+    threads.
+
+    At most `workers` files are in flight at any time over all the
+    scenes, and at most `scene_workers` of them belong to the same
+    scene. Files are handed out round-robin over the scenes so that
+    every scene in the queue makes progress instead of one scene
+    hogging all the workers. With a Throttle, the transfers share the
+    bandwidth and connection limits of the node and failed requests
+    are retried.
+    """
+    def __init__(self, workers=4, scene_workers=None, show_progress=False, 
+                 manifest=None, throttle=None):
+        self.workers = max(1, int(workers))
+        if scene_workers is None:
+            scene_workers = self.workers
+        self.scene_workers = max(1, min(int(scene_workers), self.workers))
+        self.show_progress = show_progress
+        self.manifest = manifest
+        self.throttle = throttle
+
+
+    def _fetch(self, scn_name, url, dest_dir):
+        if self.show_progress:
+            print("{0:s} : {1:s} ".format(scn_name, url.split('/')[-1]))
+        local_path = os.path.join(dest_dir, url.split('/')[-1])
+        if self.throttle is None:
+            fetch_file(url, local_path, manifest=self.manifest, scene=scn_name)
+        else:
+            self.throttle.call(url, fetch_file, url, local_path, 
+                               manifest=self.manifest, scene=scn_name, throttle=self.throttle)
+        return url
+
+
+    def run(self, jobs):
+        """ Download all the files of the given scenes.
+        :param jobs:
+            List of tuples (scene name, list of file urls, output
+            directory of the scene).
+        :returns:
+            (dict) scene name -> list of (url, exception) of the
+            files that failed. Scenes with all files downloaded are
+            not in the dict.
+        """
+        pending = deque()
+        for scn_name, urls, dest_dir in jobs:
+            if len(urls) > 0:
+                pending.append((scn_name, deque(urls), dest_dir))
+        in_flight = dict()
+        scn_load = dict((scn_name, 0) for scn_name, _, _ in pending)
+        failed = dict()
+
+        def next_job():
+            # Round-robin over the scenes that still have files and a
+            # free slot under the per-scene limit.
+            for _ in range(len(pending)):
+                scn_name, urls, dest_dir = pending[0]
+                if scn_load[scn_name] < self.scene_workers:
+                    url = urls.popleft()
+                    if len(urls) == 0:
+                        pending.popleft()
+                    else:
+                        pending.rotate(-1)
+                    return scn_name, url, dest_dir
+                pending.rotate(-1)
+            return None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while len(pending) > 0 or len(in_flight) > 0:
+                while len(in_flight) < self.workers:
+                    job = next_job()
+                    if job is None:
+                        break
+                    scn_name, url, dest_dir = job
+                    scn_load[scn_name] += 1
+                    in_flight[executor.submit(self._fetch, *job)] = (scn_name, url)
+                done, _ = wait(list(in_flight.keys()), return_when=FIRST_COMPLETED)
+                for fut in done:
+                    scn_name, url = in_flight.pop(fut)
+                    scn_load[scn_name] -= 1
+                    exc = fut.exception()
+                    if exc is not None:
+                        logger.error("Downloading {0:s} failed: {1:s}".format(url, str(exc)))
+                        failed.setdefault(scn_name, []).append((url, exc))
+
+        return failed
@@ -0,0 +1,113 @@
+import json
+
+import numpy as np
+
+def load_geojson(geojson):
+    """ Read GeoJSON from a file name, a string or an already parsed
+    dict. """
+    if isinstance(geojson, dict):
+        return geojson
+    try:
+        with open(geojson, "r") as fobj:
+            return json.load(fobj)
+    except (IOError, OSError):
+        return json.loads(geojson)
+
+
+def geojson_polygons(geojson):
+    """ Extract the polygons of a GeoJSON object.
+    :param geojson:
+        A Geometry, Feature or FeatureCollection, as a dict.
+    :returns:
+        (list) polygons, each as a list of rings, each ring as an
+        (n, 2) array of longitude and latitude. Points and lines are
+        ignored.
+    """
+    gtype = geojson.get("type")
+    if gtype == "FeatureCollection":
+        return [p for f in geojson["features"] for p in geojson_polygons(f)]
+    elif gtype == "Feature":
+        return [] if geojson.get("geometry") is None else geojson_polygons(geojson["geometry"])
+    elif gtype == "GeometryCollection":
+        return [p for g in geojson["geometries"] for p in geojson_polygons(g)]
+    elif gtype == "Polygon":
+        return [[np.asarray(ring, dtype=float)[:, 0:2] for ring in geojson["coordinates"]]]
+    elif gtype == "MultiPolygon":
+        return [[np.asarray(ring, dtype=float)[:, 0:2] for ring in poly]
+                for poly in geojson["coordinates"]]
+    return []
+
+
+def polygon_bounds(polygon):
+    """ Returns (west, south, east, north) of a polygon. """
+    outer = polygon[0]
+    return (outer[:, 0].min(), outer[:, 1].min(),
+            outer[:, 0].max(), outer[:, 1].max())
+
+
+def _ring_edges(polygon):
+    for ring in polygon:
+        for i in range(len(ring)):
+            yield ring[i - 1], ring[i]
+
+
+def points_in_polygon(x, y, polygon):
+    """ Even-odd test of arrays of points against a polygon with
+    holes. Returns a boolean array. """
+    inside = np.zeros(np.shape(x), dtype=bool)
+    for (x0, y0), (x1, y1) in _ring_edges(polygon):
+        if y0 == y1:
+            continue
+        crosses = (y0 > y) != (y1 > y)
+        x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        inside ^= crosses & (x < x_cross)
+    return inside
+
+
+def _segment_hits_boxes(x0, y0, x1, y1, west, south, east, north):
+    # Liang-Barsky clipping of one segment against arrays of boxes;
+    # true if any part of the segment is in a box.
+    dx = x1 - x0
+    dy = y1 - y0
+    t0 = np.zeros(np.shape(west))
+    t1 = np.ones(np.shape(west))
+    hit = np.ones(np.shape(west), dtype=bool)
+    for p, q in ((-dx, x0 - west), (dx, east - x0), (-dy, y0 - south), (dy, north - y0)):
+        if p == 0:
+            hit &= q >= 0
+            continue
+        r = q / p
+        if p < 0:
+            t0 = np.maximum(t0, r)
+        else:
+            t1 = np.minimum(t1, r)
+    return hit & (t0 <= t1)
+
+
+def _boxes_hit_polygon(west, south, east, north, polygon):
+    # Either a box corner is in the polygon (covers boxes inside the
+    # polygon), or a polygon edge passes through the box (covers
+    # polygons inside the box and partial overlaps).
+    result = np.zeros(west.shape, dtype=bool)
+    for cx, cy in ((west, south), (west, north), (east, south), (east, north)):
+        result |= points_in_polygon(cx, cy, polygon)
+    for (x0, y0), (x1, y1) in _ring_edges(polygon):
+        result |= _segment_hits_boxes(x0, y0, x1, y1, west, south, east, north)
+    return result
+
+
+def boxes_intersect_polygon(west, south, east, north, polygon):
+    """ Exact test of arrays of lon/lat boxes against a polygon.
+    Boxes with west > east cross the antimeridian.
+    Returns a boolean array.
+    """
+    west, south, east, north = [np.asarray(v, dtype=float) for v in (west, south, east, north)]
+    wrap = west > east
+    # Boxes across the antimeridian are split into the part east of
+    # their west bound and the part west of their east bound.
+    result = _boxes_hit_polygon(west, south, np.where(wrap, 180., east), north, polygon)
+    if wrap.any():
+        result[wrap] |= _boxes_hit_polygon(np.full(wrap.sum(), -180.), south[wrap],
+                                           east[wrap], north[wrap], polygon)
+    return result
+
@@ -0,0 +1,216 @@
+import io
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from common import (GOOGLE_LANDSAT_INDEX, GOOGLE_LANDSAT_DTYPE,
+                    S3_LANDSAT_INDEX, S3_LANDSAT_DTYPE)
+
+# Format of the date/time columns in the index database. SQLite
+# compares them as text, which orders the same as the time.
+INDEX_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+# How the index of each server channel is downloaded, parsed and
+# indexed in the database. The composite index covers every column in
+# the WHERE clause of Landsat.addPathRow/searchPathRow, so a search of
+# a path/row is an index range scan instead of a full table scan. The
+# key column identifies a record for incremental updates. The bounds
+# columns (west, east, south, north) give the footprint of a scene for
+# the spatial index.
+INDEX_CHANNELS = dict(
+    google=dict(url=GOOGLE_LANDSAT_INDEX,
+                dtype=GOOGLE_LANDSAT_DTYPE,
+                key="PRODUCT_ID",
+                bounds=["WEST_LON", "EAST_LON", "SOUTH_LAT", "NORTH_LAT"],
+                parse_dates=["DATE_ACQUIRED", "SENSING_TIME"],
+                indexes=[("sc_path_row_time", ["SPACECRAFT_ID", "WRS_PATH", "WRS_ROW",
+                                               "SENSING_TIME", "COLLECTION_NUMBER"])]),
+    aws=dict(url=S3_LANDSAT_INDEX,
+             dtype=S3_LANDSAT_DTYPE,
+             key="productId",
+             bounds=["min_lon", "max_lon", "min_lat", "max_lat"],
+             parse_dates=["acquisitionDate"],
+             indexes=[("path_row_time", ["path", "row", "acquisitionDate"])]))
+
+
+def sql_type_of(dtype):
+    """ SQLite column type for a dtype in the *_LANDSAT_DTYPE dicts. """
+    if dtype is str:
+        return "TEXT"
+    kind = np.dtype(dtype).kind
+    if kind in "iub":
+        return "INTEGER"
+    elif kind == "f":
+        return "REAL"
+    return "TEXT"
+
+
+def tune_bulk_load(conn):
+    """ Trade durability for speed while building a new database file
+    from scratch. A crash leaves a corrupt file, which is fine as long
+    as it is built aside and moved in place when finished. """
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA locking_mode=EXCLUSIVE")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    # Negative cache size is in KiB, i.e. 512 MiB.
+    conn.execute("PRAGMA cache_size=-524288")
+
+
+def create_index_table(conn, tname, channel):
+    """ Create the typed table of an index channel. """
+    cfg = INDEX_CHANNELS[channel]
+    coldefs = ["{0:s} {1:s}".format(col, "TEXT" if col in cfg["parse_dates"] else sql_type_of(dt))
+               for col, dt in cfg["dtype"].items()]
+    conn.execute('CREATE TABLE IF NOT EXISTS "{0:s}" ({1:s})'.format(tname, ", ".join(coldefs)))
+
+
+def create_indexes(conn, tname, channel):
+    for iname, cols in INDEX_CHANNELS[channel]["indexes"]:
+        conn.execute('CREATE INDEX IF NOT EXISTS "{0:s}_{1:s}" ON "{0:s}" ({2:s})'.format(tname, iname,
+                                                                                           ", ".join(cols)))
+    # The server index occasionally lists a product more than once;
+    # keep the last listing so the key can be unique. Records without
+    # a key (pre-collection scenes) are all kept.
+    key = INDEX_CHANNELS[channel]["key"]
+    conn.execute("""
+    DELETE FROM "{0:s}" 
+    WHERE {1:s} IS NOT NULL 
+     AND rowid NOT IN (SELECT MAX(rowid) FROM "{0:s}" WHERE {1:s} IS NOT NULL GROUP BY {1:s})""".format(tname, key))
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS "{0:s}_key" ON "{0:s}" ({1:s})'.format(tname, key))
+
+
+def create_rtree(conn, tname, channel):
+    """ Create and fill the R*Tree index of the scene footprints of a
+    table, named <table>_rtree, with the rowid of a record as its id.
+    Triggers keep it in sync with later changes of the table. Scenes
+    across the antimeridian (west > east) are entered with the full
+    range of longitude; searches test them exactly afterwards.
+    """
+    west, east, south, north = INDEX_CHANNELS[channel]["bounds"]
+    rtname = "{0:s}_rtree".format(tname)
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (rtname, )).fetchone()
+    if exists is None:
+        conn.execute('CREATE VIRTUAL TABLE "{0:s}" USING rtree(id, min_lon, max_lon, min_lat, max_lat)'.format(rtname))
+    footprint = """
+     CASE WHEN {0:s}.{1:s} > {0:s}.{2:s} THEN -180.0 ELSE {0:s}.{1:s} END, 
+     CASE WHEN {0:s}.{1:s} > {0:s}.{2:s} THEN 180.0 ELSE {0:s}.{2:s} END, 
+     {0:s}.{3:s}, {0:s}.{4:s}"""
+    valid = "{0:s}.{1:s} IS NOT NULL AND {0:s}.{2:s} IS NOT NULL AND {0:s}.{3:s} IS NOT NULL AND {0:s}.{4:s} IS NOT NULL"
+    if exists is None:
+        conn.execute("""
+        INSERT INTO "{0:s}" (id, min_lon, max_lon, min_lat, max_lat) 
+        SELECT t.rowid, {1:s} FROM "{2:s}" AS t WHERE {3:s}""".format(
+            rtname, footprint.format("t", west, east, south, north), tname, 
+            valid.format("t", west, east, south, north)))
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS "{0:s}_insert" AFTER INSERT ON "{1:s}" 
+    WHEN {2:s} BEGIN 
+     INSERT OR REPLACE INTO "{0:s}" (id, min_lon, max_lon, min_lat, max_lat) VALUES (new.rowid, {3:s}); 
+    END""".format(rtname, tname, valid.format("new", west, east, south, north), 
+                  footprint.format("new", west, east, south, north)))
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS "{0:s}_update" AFTER UPDATE OF {2:s} ON "{1:s}" BEGIN 
+     DELETE FROM "{0:s}" WHERE id = old.rowid; 
+     INSERT INTO "{0:s}" (id, min_lon, max_lon, min_lat, max_lat) 
+     SELECT new.rowid, {3:s} WHERE {4:s}; 
+    END""".format(rtname, tname, ", ".join([west, east, south, north]), 
+                  footprint.format("new", west, east, south, north), 
+                  valid.format("new", west, east, south, north)))
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS "{0:s}_delete" AFTER DELETE ON "{1:s}" BEGIN 
+     DELETE FROM "{0:s}" WHERE id = old.rowid; 
+    END""".format(rtname, tname))
+
+
+def create_meta_table(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS index_meta (name TEXT PRIMARY KEY, value TEXT)")
+
+
+def get_meta(conn, name):
+    """ Returns a value saved in the metadata table of the database,
+    e.g. the ETag of the server index it was built from. """
+    try:
+        rec = conn.execute("SELECT value FROM index_meta WHERE name = ?", (name, )).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return None if rec is None else rec[0]
+
+
+def set_meta(conn, name, value):
+    conn.execute("INSERT OR REPLACE INTO index_meta (name, value) VALUES (?, ?)", (name, value))
+
+
+class TeeReader(io.RawIOBase):
+    """ A readable stream that copies everything read from `src` to
+    the writable file object `sink`. """
+    def __init__(self, src, sink):
+        super(TeeReader, self).__init__()
+        self.src = src
+        self.sink = sink
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.src.read(len(b))
+        n = len(data)
+        b[:n] = data
+        self.sink.write(data)
+        return n
+
+
+def read_index_csv(csv_file, channel, chunksize=int(1e5)):
+    """ Read a CSV file, or a binary stream of CSV text, of a channel's
+    index in chunks of DataFrames with the columns of its table. """
+    cfg = INDEX_CHANNELS[channel]
+    for df in pd.read_csv(csv_file, chunksize=chunksize, iterator=True,
+                          dtype={k: v for k, v in cfg["dtype"].items() if k not in cfg["parse_dates"]},
+                          parse_dates=cfg["parse_dates"]):
+        df = df.rename(columns={c: c.replace(' ', '_') for c in df.columns})
+        yield df.loc[:, list(cfg["dtype"].keys())]
+
+
+def df_to_rows(df, channel):
+    """ Convert a DataFrame of index records to a list of tuples of
+    Python values ready to be bound to an INSERT statement. """
+    df = df.copy()
+    for col in INDEX_CHANNELS[channel]["parse_dates"]:
+        df[col] = df[col].dt.strftime(INDEX_DATETIME_FORMAT)
+    df = df.astype(object).where(pd.notnull(df), None)
+    return list(df.itertuples(index=False, name=None))
+
+
+def df_to_keyed_rows(df, channel):
+    """ Like df_to_rows but drops the records without a key, which
+    cannot be matched for an incremental update. """
+    return df_to_rows(df.loc[df[INDEX_CHANNELS[channel]["key"]].notnull(), :], channel)
+
+
+def insert_rows(conn, tname, channel, rows):
+    cols = list(INDEX_CHANNELS[channel]["dtype"].keys())
+    sql = 'INSERT INTO "{0:s}" ({1:s}) VALUES ({2:s})'.format(tname, ", ".join(cols),
+                                                               ", ".join(["?"] * len(cols)))
+    conn.executemany(sql, rows)
+
+
+def upsert_rows(conn, tname, channel, rows):
+    """ Insert the records with new keys and update the records whose
+    values changed; records that did not change are not written.
+    :returns:
+        (int) number of records inserted or updated.
+    """
+    cols = list(INDEX_CHANNELS[channel]["dtype"].keys())
+    key = INDEX_CHANNELS[channel]["key"]
+    vals = [c for c in cols if c != key]
+    sql = """
+    INSERT INTO "{0:s}" ({1:s}) VALUES ({2:s})
+    ON CONFLICT({3:s}) DO UPDATE SET {4:s}
+    WHERE ({5:s}) IS NOT ({6:s})""".format(tname, ", ".join(cols), ", ".join(["?"] * len(cols)), key,
+                                          ", ".join(["{0:s} = excluded.{0:s}".format(c) for c in vals]),
+                                          ", ".join(['"{0:s}".{1:s}'.format(tname, c) for c in vals]),
+                                          ", ".join(["excluded.{0:s}".format(c) for c in vals]))
+    n_before = conn.total_changes
+    conn.executemany(sql, rows)
+    return conn.total_changes - n_before
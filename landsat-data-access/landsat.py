@@ -1,26 +1,61 @@
 import os
 import sys
+import time
+import logging
 
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import sqlalchemy as sa
 import pandas as pd
 
-from homura import download
-
 from scene import Scene, Scenes
 from common import GS_PUBURL_PREFIX, check_create_folder
+from downloader import Downloader
+from async_downloader import AsyncDownloader
+from manifest import DownloadManifest
+from geometry import load_geojson, geojson_polygons, polygon_bounds, boxes_intersect_polygon
+from snapshot import IndexSnapshot
+from remote_tiff import RemoteGeoTiff, TileCache
+from scene_cache import SceneCache
+from scene_id import spacecraft_ids
+
+logger = logging.getLogger('landsat-query')
+
+# Files of a scene to download by preset name, as band tokens, the
+# file name suffix without the leading underscore and the extension.
+# "sr": the inputs of gen_landsat_sr.sh (LaSRC for Landsat 8, LEDAPS
+# for Landsat 5/7), without the panchromatic band and, for Landsat 8,
+# the thermal bands that LaSRC does not read. "albedo": the same, as
+# gen_landsat_albedo.sh works on the output of gen_landsat_sr.sh plus
+# the _ANG.txt file of the scene. "all": every file.
+BAND_PRESETS = dict(
+    LANDSAT_8=dict(sr=["ANG", "B1", "B2", "B3", "B4", "B5", "B6", "B7", "B9", "BQA", "MTL"]), 
+    LANDSAT_7=dict(sr=["ANG", "B1", "B2", "B3", "B4", "B5", "B6_VCID_1", "B6_VCID_2", "B7", "BQA", "MTL"]), 
+    LANDSAT_5=dict(sr=["ANG", "B1", "B2", "B3", "B4", "B5", "B6", "B7", "BQA", "MTL"]))
+for _presets in BAND_PRESETS.values():
+    _presets["albedo"] = _presets["sr"]
+
+# Band tokens of the files of any spacecraft, to check a selection.
+BAND_TOKENS = ["ANG", "B1", "B2", "B3", "B4", "B5", "B6", "B6_VCID_1", "B6_VCID_2", "B7", 
+               "B8", "B9", "B10", "B11", "BQA", "MTL"]
 
 class Landsat(Scenes):
-    def __init__(self, spacecraft_id, bucket_id, index_db=None, index_tb="landsat"):
+    def __init__(self, spacecraft_id, bucket_id, index_db=None, index_tb="landsat", bands="all"):
         super(Landsat, self).__init__()
         self._saved_scenes = dict()
+        self._stmt_cache = dict()
+        self._query_stats = dict()
         # spacecraft_id: Landsat_5, Landsat_7, Landsat_8
         # bucket_id: Google, AWS
+        # bands: files of a scene to download, see setBands.
         spacecraft_id = spacecraft_id.upper()
         bucket_id = bucket_id.upper()
         self.spacecraft_id = spacecraft_id
         self.bucket_id = bucket_id
 
         self.index_db_defined = False
+        self.index_snapshot = None
         if index_db is not None and index_tb is not None:
             self.defIndexDatabase(index_db, index_tb)
             self.index_db_defined = True
@@ -29,12 +64,20 @@ class Landsat(Scenes):
             self._colnames = dict(target_id = "PRODUCT_ID", c_number = "COLLECTION_NUMBER", 
                                   sc_id = "SPACECRAFT_ID", 
                                   wrs_path = "WRS_PATH", wrs_row = "WRS_ROW", 
-                                  acq_date = "SENSING_TIME", url = "BASE_URL")
+                                  acq_date = "SENSING_TIME", url = "BASE_URL", 
+                                  west = "WEST_LON", east = "EAST_LON", 
+                                  south = "SOUTH_LAT", north = "NORTH_LAT", 
+                                  cloud = "CLOUD_COVER", tier = "COLLECTION_CATEGORY", 
+                                  level = "DATA_TYPE")
         elif (bucket_id == "AWS"):
             self._colnames = dict(target_id = "productId", c_number = None, 
                                   sc_id = None, 
                                   wrs_path = "path", wrs_row = "row", 
-                                  acq_date = "acquisitionDate", url = "download_url")
+                                  acq_date = "acquisitionDate", url = "download_url", 
+                                  west = "min_lon", east = "max_lon", 
+                                  south = "min_lat", north = "max_lat", 
+                                  cloud = "cloudCover", tier = None, 
+                                  level = "processingLevel")
         else:
             raise RuntimeError("Accessing the data bucket {0:s} not implemented!".format(bucket_id))
 
@@ -79,6 +122,32 @@ class Landsat(Scenes):
                                    "_MTL.txt"]
         else:
             raise RuntimeError("Unrecognized Landsat spacecraft {0:s}".format(spacecraft_id))
+        self._all_suffix = self._target_suffix
+        self.setBands(bands)
+
+
+    def setBands(self, bands):
+        # Select the files of a scene to download, for the scenes
+        # added afterwards.
+        # bands (str or list of str): a preset in BAND_PRESETS, "all",
+        # or a list of band tokens, e.g. ["B4", "B5", "BQA", "MTL"].
+        # Tokens of bands this spacecraft does not have are skipped,
+        # e.g. B10 for Landsat 7. The _MTL.txt file is always
+        # downloaded since the processing finds scenes by it.
+        if isinstance(bands, str):
+            bands = [bands]
+        bands = [b.upper() for b in bands]
+        if len(bands) == 1 and bands[0].lower() in BAND_PRESETS[self.spacecraft_id]:
+            bands = BAND_PRESETS[self.spacecraft_id][bands[0].lower()]
+        if len(bands) == 1 and bands[0] == "ALL":
+            self._target_suffix = self._all_suffix
+            return self._target_suffix
+        unknown = [b for b in bands if b not in BAND_TOKENS]
+        if len(unknown) > 0:
+            raise RuntimeError("Unrecognized Landsat bands {0:s}".format(", ".join(unknown)))
+        bands = set(bands + ["MTL"])
+        self._target_suffix = [ss for ss in self._all_suffix if ss[1:].split(".")[0] in bands]
+        return self._target_suffix
 
 
     def defIndexDatabase(self, index_db, index_tb="landsat"):
@@ -86,6 +155,26 @@ class Landsat(Scenes):
         self.index_db_engine = sa.create_engine("sqlite:///{0:s}".format(index_db))
         self.index_tb_name = index_tb
         self.index_db_defined = True
+        self._stmt_cache = dict()
+
+
+    def defIndexSnapshot(self, snapshot_dir):
+        # Answer the path/row searches from the memory-mapped columnar
+        # snapshot of the index written by update_landsat_index.py
+        # --snapshot instead of the database. Searches by footprint
+        # still need the database. A snapshot older than the database
+        # is refused.
+        snapshot = IndexSnapshot(snapshot_dir)
+        if snapshot.channel.upper() != self.bucket_id:
+            raise RuntimeError("Index snapshot {0:s} is of the {1:s} index, not {2:s}".format(
+                snapshot_dir, snapshot.channel, self.bucket_id))
+        if self.index_db_defined:
+            snapshot.checkIndex(self.index_db_name)
+        self.index_snapshot = snapshot
+
+
+    def _pathRowDefined(self):
+        return self.index_db_defined or self.index_snapshot is not None
 
 
     def _indexUrlToFileUrls(self, index_url):
@@ -99,48 +188,179 @@ class Landsat(Scenes):
                 for ss in self._target_suffix]
 
         
-    def addPathRow(self, path, row, start_date=None, end_date=None):
+    def _timeBounds(self, start_date, end_date):
         # start_date (str), YYYY-MM-DD
         # end_date (str): YYYY-MM-DD
-        if not self.index_db_defined:
-            return 0
+        # Bounds of the acquisition time to bind to a query, in the
+        # same form as datetime() in SQLite gives.
+        start_time = None if start_date is None else "{0:s} 00:00:00".format(start_date)
+        end_time = None if end_date is None else "{0:s} 23:59:59".format(end_date)
+        return start_time, end_time
+
+
+    def _selectClause(self, columns, prefix=""):
+        if columns is None:
+            return "{0:s}*".format(prefix)
+        return ", ".join(["{0:s}{1:s}".format(prefix, c) for c in columns])
+
+
+    def _filterKey(self, max_cloud, tiers, levels):
+        # Shape of the scene filters, to cache a statement by.
+        return (max_cloud is not None,
+                None if tiers is None else len(tiers),
+                None if levels is None else len(levels))
+
+
+    def _filterClause(self, filter_key, prefix=""):
+        # SQL conditions of the scene filters of a given shape: maximum
+        # cloud cover, collection tiers (T1, T2, RT) and processing
+        # levels (L1TP, L1GT, L1GS). The AWS index has no tier column;
+        # the tier is the end of the product ID.
+        has_cloud, n_tiers, n_levels = filter_key
+        sql_query_str = ""
+        if has_cloud:
+            sql_query_str = sql_query_str + """
+         AND {0:s}{1:s} <= :max_cloud """.format(prefix, self._colnames["cloud"])
+        if n_tiers is not None:
+            if self._colnames["tier"] is None:
+                tier_expr = "substr({0:s}{1:s}, -2)".format(prefix, self._colnames["target_id"])
+            else:
+                tier_expr = "{0:s}{1:s}".format(prefix, self._colnames["tier"])
+            tier_params = [":tier_{0:d}".format(i) for i in range(n_tiers)]
+            sql_query_str = sql_query_str + """
+         AND {0:s} IN ({1:s}) """.format(tier_expr, ", ".join(tier_params) if n_tiers > 0 else "NULL")
+        if n_levels is not None:
+            level_params = [":level_{0:d}".format(i) for i in range(n_levels)]
+            sql_query_str = sql_query_str + """
+         AND {0:s}{1:s} IN ({2:s}) """.format(prefix, self._colnames["level"],
+                                             ", ".join(level_params) if n_levels > 0 else "NULL")
+        return sql_query_str
 
-        sql_query_str = """
-        SELECT 
-         {0:s}, 
-         {1:s} """.format(self._colnames["target_id"], 
-                          self._colnames["url"])
 
-        sql_query_str = sql_query_str + """
-        FROM
-         "{0:s}" """.format(self.index_tb_name)
+    def _filterParams(self, max_cloud, tiers, levels):
+        params = dict(max_cloud=None if max_cloud is None else float(max_cloud))
+        for i, t in enumerate(tiers or []):
+            params["tier_{0:d}".format(i)] = t.upper()
+        for i, l in enumerate(levels or []):
+            params["level_{0:d}".format(i)] = l.upper()
+        return params
 
-        sql_query_str = sql_query_str + """
-        WHERE
-         {0:s} == {1:d}
-         AND {2:s} == {3:d} """.format(self._colnames["wrs_path"], path, 
-                                       self._colnames["wrs_row"], row)
 
-        if start_date is not None:
+    def _pathRowStatement(self, columns, has_start, has_end, filter_key):
+        # Parameterized query of one path/row/date window. The
+        # statements are cached by their shape, so the same SQL text
+        # is reused and the prepared statement cache of the database
+        # connection can skip parsing and planning it again.
+        key = ("path_row", None if columns is None else tuple(columns), has_start, has_end, filter_key)
+        if key in self._stmt_cache:
+            return self._stmt_cache[key]
+
+        sql_query_str = """
+        SELECT 
+         {0:s} 
+        FROM 
+         "{1:s}" 
+        WHERE 
+         {2:s} == :path 
+         AND {3:s} == :row """.format(self._selectClause(columns), self.index_tb_name, 
+                                     self._colnames["wrs_path"], self._colnames["wrs_row"])
+        if has_start:
             sql_query_str = sql_query_str + """
-             AND {0:s} >= datetime("{1:s}")"""
-            sql_query_str = sql_query_str.format(self._colnames["acq_date"], 
-                                                 start_date)
-        if end_date is not None:
+         AND {0:s} >= :start_time """.format(self._colnames["acq_date"])
+        if has_end:
             sql_query_str = sql_query_str + """
-             AND {0:s} <= datetime("{1:s}")"""
-            sql_query_str = sql_query_str.format(self._colnames["acq_date"], 
-                                                 "{0:s} 23:59:59".format(end_date))
-
+         AND {0:s} <= :end_time """.format(self._colnames["acq_date"])
         if (self.bucket_id == "GOOGLE"):
             sql_query_str = sql_query_str + """
-             AND {0:s} != "PRE" 
-             AND {1:s} == "{2:s}" """.format(self._colnames["c_number"], 
-                                             self._colnames["sc_id"], 
-                                             self.spacecraft_id)
-        sql_query_str = sql_query_str + ";"
+         AND {0:s} != 'PRE' 
+         AND {1:s} == :sc_id """.format(self._colnames["c_number"], self._colnames["sc_id"])
+        sql_query_str = sql_query_str + self._filterClause(filter_key) + ";"
+
+        self._stmt_cache[key] = sa.text(sql_query_str)
+        return self._stmt_cache[key]
+
+
+    def _runQuery(self, name, stmt, conn, params):
+        # Run a query to a DataFrame and record how long it took.
+        t0 = time.time()
+        result = pd.read_sql_query(stmt, conn, params=params)
+        self._recordQuery(name, len(result), time.time() - t0)
+        return result
+
+
+    def _recordQuery(self, name, n_records, elapsed):
+        stats = self._query_stats.setdefault(name, [0, 0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += n_records
+        stats[2] += elapsed
+        stats[3] = max(stats[3], elapsed)
+        logger.debug("Query {0:s} returned {1:d} records in {2:.3f} s".format(name, n_records, elapsed))
+
+
+    def queryStats(self):
+        # Returns a DataFrame of the number of calls, records returned,
+        # total and maximum time in seconds of each kind of query.
+        stats = pd.DataFrame.from_dict(self._query_stats, orient="index", 
+                                       columns=["calls", "records", "total_time", "max_time"])
+        stats.index.name = "query"
+        stats["mean_time"] = stats["total_time"] / stats["calls"]
+        return stats
+
+
+    def _snapshotIndices(self, path, row, start_time, end_time, filters):
+        # Positions in the snapshot of the scenes of one path/row/date
+        # window, with the same conditions as _pathRowStatement.
+        snapshot = self.index_snapshot
+        max_cloud, tiers, levels = filters
+        idx = snapshot.pathRowIndices(int(path), int(row), start_time, end_time)
+        keep = np.ones(len(idx), dtype=bool)
+        if (self.bucket_id == "GOOGLE"):
+            keep &= np.logical_not(snapshot.isCategory(idx, self._colnames["c_number"], "PRE"))
+            keep &= snapshot.isCategory(idx, self._colnames["sc_id"], self.spacecraft_id)
+        if max_cloud is not None:
+            keep &= snapshot.arrays[self._colnames["cloud"]][idx] <= float(max_cloud)
+        if tiers is not None:
+            tiers = [t.upper() for t in tiers]
+            if self._colnames["tier"] is None:
+                keep &= snapshot.endsWith(idx, self._colnames["target_id"], tiers)
+            else:
+                keep &= snapshot.isCategory(idx, self._colnames["tier"], tiers)
+        if levels is not None:
+            keep &= snapshot.isCategory(idx, self._colnames["level"], [l.upper() for l in levels])
+        return idx[keep]
+
+
+    def _searchPathRow(self, name, path, row, start_date, end_date, columns, filters):
+        start_time, end_time = self._timeBounds(start_date, end_date)
+        if self.index_snapshot is not None:
+            t0 = time.time()
+            idx = self._snapshotIndices(path, row, start_time, end_time, filters)
+            result = self.index_snapshot.toDataFrame(idx, columns)
+            self._recordQuery(name, len(result), time.time() - t0)
+            return result
+        stmt = self._pathRowStatement(columns, start_time is not None, end_time is not None, 
+                                      self._filterKey(*filters))
+        params = dict(path=int(path), row=int(row), start_time=start_time, end_time=end_time, 
+                      sc_id=self.spacecraft_id)
+        params.update(self._filterParams(*filters))
+        return self._runQuery(name, stmt, self.index_db_engine, params)
+
+
+    def addPathRow(self, path, row, start_date=None, end_date=None, 
+                   max_cloud=None, tiers=None, levels=None):
+        # start_date (str), YYYY-MM-DD
+        # end_date (str): YYYY-MM-DD
+        # max_cloud (float): maximum cloud cover in percent.
+        # tiers (list of str): collection tiers to keep, e.g. T1, T2, RT.
+        # levels (list of str): processing levels (data types) to keep,
+        # e.g. L1TP, L1GT, L1GS.
+        # None of a filter keeps all the scenes.
+        if not self._pathRowDefined():
+            return 0
 
-        search_result = pd.read_sql_query(sql_query_str, self.index_db_engine)
+        search_result = self._searchPathRow("addPathRow", path, row, start_date, end_date, 
+                                            [self._colnames["target_id"], self._colnames["url"]], 
+                                            (max_cloud, tiers, levels))
         if len(search_result) > 0:
             for idx, row in search_result.iterrows():
                 one_scn = Scene(row[self._colnames["target_id"]])
@@ -153,59 +373,224 @@ class Landsat(Scenes):
         return len(search_result)
 
 
-    def searchPathRow(self, path, row, start_date=None, end_date=None):
-        if not self.index_db_defined:
-            return None
-
+    def searchPathRow(self, path, row, start_date=None, end_date=None, columns=None, 
+                      max_cloud=None, tiers=None, levels=None):
         # start_date (str), YYYY-MM-DD
         # end_date (str): YYYY-MM-DD
-        sql_query_str = """
-        SELECT 
-         * """
+        # columns (list of str): index columns to return; default, all
+        # (all the columns in the snapshot if one is defined).
+        # max_cloud, tiers, levels: filters of the scenes as in addPathRow.
+        if not self._pathRowDefined():
+            return None
+
+        return self._searchPathRow("searchPathRow", path, row, start_date, end_date, columns, 
+                                   (max_cloud, tiers, levels))
 
-        sql_query_str = sql_query_str + """
-        FROM
-         "{0:s}" """.format(self.index_tb_name)
 
-        sql_query_str = sql_query_str + """
-        WHERE
-         {0:s} == {1:d}
-         AND {2:s} == {3:d} """.format(self._colnames["wrs_path"], path, 
-                                       self._colnames["wrs_row"], row)
+    def searchPathRows(self, prd_df, columns=None, max_cloud=None, tiers=None, levels=None):
+        # Search many path/row/date windows with one query.
+        # prd_df (DataFrame): columns path, row, and optionally
+        # start_date, end_date (str YYYY-MM-DD or datetime). 
+        # columns (list of str): index columns to return; default, all.
+        # max_cloud, tiers, levels: filters of the scenes as in addPathRow.
+        # Returns a DataFrame of the found scenes with the index
+        # columns and a column request_id, the index label of the row
+        # in prd_df that the scene was found for.
+        if not self._pathRowDefined():
+            return None
+
+        def toTimeStr(dates, default, time_str):
+            if dates is None:
+                return [default] * len(prd_df)
+            dates = pd.to_datetime(dates)
+            return ["{0:s} {1:s}".format(d.strftime("%Y-%m-%d"), time_str) if not pd.isnull(d) else default 
+                    for d in dates]
+
+        request = pd.DataFrame(dict(
+            request_id=range(len(prd_df)), 
+            path=prd_df["path"].astype(int).values, 
+            row=prd_df["row"].astype(int).values, 
+            start_time=toTimeStr(prd_df.get("start_date"), "0000-01-01 00:00:00", "00:00:00"), 
+            end_time=toTimeStr(prd_df.get("end_date"), "9999-12-31 23:59:59", "23:59:59")))
+
+        if self.index_snapshot is not None:
+            t0 = time.time()
+            found = [self._snapshotIndices(r.path, r.row, r.start_time, r.end_time, 
+                                           (max_cloud, tiers, levels)) 
+                     for r in request.itertuples()]
+            n_found = np.array([len(idx) for idx in found], dtype=int)
+            search_result = self.index_snapshot.toDataFrame(
+                np.concatenate(found) if len(found) > 0 else np.arange(0), columns)
+            search_result.insert(0, "request_id", prd_df.index.values[np.repeat(np.arange(len(found)), n_found)])
+            self._recordQuery("searchPathRows", len(search_result), time.time() - t0)
+            return search_result
+
+        filter_key = self._filterKey(max_cloud, tiers, levels)
+        key = ("path_rows", None if columns is None else tuple(columns), filter_key)
+        if key not in self._stmt_cache:
+            sql_query_str = """
+            SELECT 
+             r.request_id AS request_id, 
+             {0:s} 
+            FROM 
+             temp.path_row_request AS r 
+             JOIN "{1:s}" AS t 
+             ON t.{2:s} == r.path 
+              AND t.{3:s} == r.row 
+              AND t.{4:s} >= r.start_time 
+              AND t.{4:s} <= r.end_time """.format(self._selectClause(columns, prefix="t."), 
+                                                self.index_tb_name, 
+                                                self._colnames["wrs_path"], 
+                                                self._colnames["wrs_row"], 
+                                                self._colnames["acq_date"])
+            if (self.bucket_id == "GOOGLE"):
+                sql_query_str = sql_query_str + """
+              AND t.{0:s} != 'PRE' 
+              AND t.{1:s} == :sc_id """.format(self._colnames["c_number"], 
+                                               self._colnames["sc_id"])
+            sql_query_str = sql_query_str + self._filterClause(filter_key, prefix="t.") + """
+            ORDER BY r.request_id, t.{0:s};""".format(self._colnames["acq_date"])
+            self._stmt_cache[key] = sa.text(sql_query_str)
+
+        # A temporary table lives only in the connection that made it.
+        with self.index_db_engine.connect() as conn:
+            conn.execute(sa.text("""
+            CREATE TEMP TABLE IF NOT EXISTS path_row_request (
+             request_id INTEGER PRIMARY KEY, 
+             path INTEGER, 
+             row INTEGER, 
+             start_time TEXT, 
+             end_time TEXT)"""))
+            conn.execute(sa.text("DELETE FROM temp.path_row_request"))
+            if len(request) > 0:
+                conn.execute(sa.text("""
+                INSERT INTO temp.path_row_request (request_id, path, row, start_time, end_time) 
+                VALUES (:request_id, :path, :row, :start_time, :end_time)"""), 
+                             request.to_dict("records"))
+            params = dict(sc_id=self.spacecraft_id)
+            params.update(self._filterParams(max_cloud, tiers, levels))
+            search_result = self._runQuery("searchPathRows", self._stmt_cache[key], conn, params)
+            conn.execute(sa.text("DROP TABLE temp.path_row_request"))
+
+        search_result["request_id"] = prd_df.index.values[search_result["request_id"].values.astype(int)]
+        return search_result
+
+
+    def _bboxStatement(self, columns, has_start, has_end, filter_key):
+        # Parameterized query of the scenes whose footprints in the
+        # R*Tree index built by update_landsat_index.py intersect a
+        # lon/lat box. The unary + keeps the planner from using the
+        # path/row index for the spacecraft instead of the R*Tree.
+        key = ("bbox", None if columns is None else tuple(columns), has_start, has_end, filter_key)
+        if key in self._stmt_cache:
+            return self._stmt_cache[key]
 
-        if start_date is not None:
+        sql_query_str = """
+        SELECT 
+         {0:s} 
+        FROM 
+         "{1:s}_rtree" AS r 
+         JOIN "{1:s}" AS t ON t.rowid == r.id 
+        WHERE 
+         r.max_lon >= :west 
+         AND r.min_lon <= :east 
+         AND r.max_lat >= :south 
+         AND r.min_lat <= :north """.format(self._selectClause(columns, prefix="t."), self.index_tb_name)
+        if has_start:
             sql_query_str = sql_query_str + """
-             AND {0:s} >= datetime("{1:s}")"""
-            sql_query_str = sql_query_str.format(self._colnames["acq_date"], 
-                                                 start_date)
-        if end_date is not None:
+         AND +t.{0:s} >= :start_time """.format(self._colnames["acq_date"])
+        if has_end:
             sql_query_str = sql_query_str + """
-             AND {0:s} <= datetime("{1:s}")"""
-            sql_query_str = sql_query_str.format(self._colnames["acq_date"], 
-                                                 "{0:s} 23:59:59".format(end_date))
-
+         AND +t.{0:s} <= :end_time """.format(self._colnames["acq_date"])
         if (self.bucket_id == "GOOGLE"):
             sql_query_str = sql_query_str + """
-             AND {0:s} != "PRE" 
-             AND {1:s} == "{2:s}" """.format(self._colnames["c_number"], 
-                                             self._colnames["sc_id"], 
-                                             self.spacecraft_id)
-        sql_query_str = sql_query_str + ";"
+         AND t.{0:s} != 'PRE' 
+         AND +t.{1:s} == :sc_id """.format(self._colnames["c_number"], self._colnames["sc_id"])
+        sql_query_str = sql_query_str + self._filterClause(filter_key, prefix="t.") + """
+        ORDER BY t.{0:s};""".format(self._colnames["acq_date"])
+
+        self._stmt_cache[key] = sa.text(sql_query_str)
+        return self._stmt_cache[key]
+
+
+    def _searchPolygons(self, name, polygons, start_date, end_date, columns, filters):
+        # R*Tree search with the bounds of each polygon, then exact
+        # test of the scene footprints against the polygon.
+        bounds_cols = [self._colnames[k] for k in ("west", "south", "east", "north")]
+        sel_cols = None if columns is None else list(columns) + [c for c in bounds_cols if c not in columns]
+        start_time, end_time = self._timeBounds(start_date, end_date)
+        stmt = self._bboxStatement(sel_cols, start_time is not None, end_time is not None, 
+                                   self._filterKey(*filters))
+        found = []
+        for poly in polygons:
+            west, south, east, north = polygon_bounds(poly)
+            params = dict(west=float(west), south=float(south), east=float(east), north=float(north), 
+                          start_time=start_time, end_time=end_time, sc_id=self.spacecraft_id)
+            params.update(self._filterParams(*filters))
+            candidates = self._runQuery(name, stmt, self.index_db_engine, params)
+            hit = boxes_intersect_polygon(*[candidates[c].values for c in bounds_cols], polygon=poly)
+            found.append(candidates.loc[hit, :])
+        if len(found) == 0:
+            return None
+        search_result = pd.concat(found, ignore_index=True)
+        if len(found) > 1:
+            search_result = search_result.drop_duplicates().reset_index(drop=True)
+        if columns is not None:
+            search_result = search_result.loc[:, list(columns)]
+        return search_result
+
+
+    def searchBBox(self, west, south, east, north, start_date=None, end_date=None, columns=None, 
+                   max_cloud=None, tiers=None, levels=None):
+        # Search the scenes whose footprints intersect a box of
+        # longitude and latitude; west > east for a box across the
+        # antimeridian.
+        # start_date (str), YYYY-MM-DD
+        # end_date (str): YYYY-MM-DD
+        # columns (list of str): index columns to return; default, all.
+        # max_cloud, tiers, levels: filters of the scenes as in addPathRow.
+        if not self.index_db_defined:
+            return None
 
-        return pd.read_sql_query(sql_query_str, self.index_db_engine)
+        def box(w, e):
+            return [np.array([[w, south], [e, south], [e, north], [w, north], [w, south]], dtype=float)]
 
+        if west <= east:
+            polygons = [box(west, east)]
+        else:
+            polygons = [box(west, 180.0), box(-180.0, east)]
+        return self._searchPolygons("searchBBox", polygons, start_date, end_date, columns, 
+                                    (max_cloud, tiers, levels))
 
-    def _scnIdToSpacecraftId(self, scn_id):
-        sc_code = int(scn_id[2])
-        if sc_code != 5 and sc_code != 7 and sc_code != 8:
+
+    def searchGeometry(self, geojson, start_date=None, end_date=None, columns=None, 
+                       max_cloud=None, tiers=None, levels=None):
+        # Search the scenes whose footprints intersect the polygons of
+        # a GeoJSON Geometry, Feature or FeatureCollection, given as a
+        # file name, a string or a dict.
+        # start_date (str), YYYY-MM-DD
+        # end_date (str): YYYY-MM-DD
+        # columns (list of str): index columns to return; default, all.
+        # max_cloud, tiers, levels: filters of the scenes as in addPathRow.
+        if not self.index_db_defined:
             return None
-        return "LANDSAT_{0:d}".format(sc_code)
+
+        polygons = geojson_polygons(load_geojson(geojson))
+        if len(polygons) == 0:
+            raise RuntimeError("No polygons found in the GeoJSON to search.")
+        return self._searchPolygons("searchGeometry", polygons, start_date, end_date, columns, 
+                                    (max_cloud, tiers, levels))
+
+
+    def _scnIdToSpacecraftId(self, scn_id):
+        # Scene IDs (LC8...) and product IDs (LC08_...)
+        return spacecraft_ids([scn_id]).iloc[0]
         
 
     def _indexUrlToBucketId(self, index_url):
-        if index_url[0:2] == "gs" or index_url.find("googleapi.com") > -1:
+        if index_url[0:2] == "gs" or index_url.find("googleapis.com") > -1:
             return "GOOGLE"
-        elif index_url.find("amazonaws.com"):
+        elif index_url.find("amazonaws.com") > -1:
             return "AWS"
         else:
             return None
@@ -245,11 +630,120 @@ class Landsat(Scenes):
         self._saved_scenes = {}
 
 
-    def saveToDir(self, path, show_progress=True):
+    def readWindow(self, scn_name, west, south, east, north, bands=None, cache=None):
+        # Read the pixels of the band images of a scene in this object
+        # that cover a box of longitude and latitude, fetching only the
+        # tiles of the GeoTIFFs on the server that intersect the box,
+        # with GDAL through /vsicurl/.
+        # bands (list of str): band tokens, e.g. ["B4", "B5"]; default,
+        # all the selected .TIF files of the scene.
+        # cache (TileCache): cache of tiles to share between calls, so
+        # that overlapping windows are not fetched again.
+        # Returns a dict of band token -> (array, geotransform).
+        if cache is None:
+            cache = TileCache()
+        scn = self[scn_name]
+        result = dict()
+        for url in scn.files:
+            # File names are <target_id>_<band token>.<ext>, in a
+            # folder named by the target id.
+            target_id = url.split("/")[-2]
+            token = url.split("/")[-1][len(target_id) + 1:].split(".")[0]
+            if not url.endswith(".TIF") or (bands is not None and token not in bands):
+                continue
+            tif = RemoteGeoTiff(url, cache=cache)
+            result[token] = tif.readLonLatWindow(west, south, east, north)
+        return result
+
+
+    def saveToDir(self, path, show_progress=True, workers=1, scene_workers=None, 
+                  resume=True, backend="threads", host_connections=8, 
+                  cache_dir=None, cache_quota=None, throttle=None):
+        # workers: maximum number of files downloaded at the same time
+        # over all the scenes.
+        # scene_workers: maximum number of files of one scene
+        # downloaded at the same time; default, same as workers.
+        # resume: record the downloads in a manifest in the directory
+        # path, skip the files completed by an earlier run and resume
+        # the partial ones.
+        # backend: "threads", a pool of threads with a shared
+        # keep-alive session per host; or "async", one asyncio event
+        # loop with aiohttp, for many files in flight at once.
+        # host_connections: maximum number of connections kept open to
+        # one host by the async backend.
+        # cache_dir: directory of a SceneCache shared with other jobs;
+        # files it has with the same size and ETag as on the server
+        # are linked from it instead of downloaded, and downloaded
+        # files are added to it.
+        # cache_quota: maximum bytes of the cache; default, no limit.
+        # throttle: a Throttle with the bandwidth and connection limits
+        # shared by the download processes of the node and the retries
+        # of failed requests; default, no limits and no retries.
+        # Returns the list of names of the scenes that failed.
+        jobs = []
         for scn in self.scenes_list:
             if (not self._saved_scenes[scn.name]):
                 scn_dir = check_create_folder(os.path.join(path, scn.name))
-                for f in scn.files:
-                    if show_progress:
-                        print("{0:s} : {1:s} ".format(scn.name, f.split('/')[-1]))
-                    download(f, scn_dir, show_progress=show_progress)
+                jobs.append((scn.name, scn.files, scn_dir))
+
+        manifest = DownloadManifest.forDir(path) if resume else None
+        cache = None if cache_dir is None else SceneCache(cache_dir, quota=cache_quota)
+        remote_stats = dict()
+        if cache is not None:
+            def lookup(url, local_path):
+                if manifest is not None and manifest.isComplete(url, local_path):
+                    return url, None, False
+                size, etag = cache.remoteStat(url)
+                try:
+                    hit = cache.linkTo(url, local_path, size, etag)
+                except OSError as exc:
+                    # e.g. a full disk or a cache gone read-only, download it instead.
+                    logger.warning("Failed to take {0:s} from the scene cache: {1:s}".format(url, str(exc)))
+                    hit = False
+                return url, (size, etag), hit
+
+            # Check the cache for the files of all the scenes, then
+            # download only the files it does not have.
+            files = [(url, os.path.join(scn_dir, url.split('/')[-1])) for _, urls, scn_dir in jobs for url in urls]
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                looked_up = list(executor.map(lambda f: lookup(*f), files))
+            hits = set()
+            for (url, stat, hit), (_, local_path) in zip(looked_up, files):
+                remote_stats[url] = stat
+                if hit:
+                    hits.add(url)
+                    if manifest is not None:
+                        manifest.register(url, None, local_path, stat[0])
+                        manifest.markComplete(url, stat[0])
+            logger.info("{0:d} of {1:d} files found in the scene cache {2:s}".format(len(hits), len(files), cache_dir))
+            jobs = [(scn_name, [url for url in urls if url not in hits], scn_dir) for scn_name, urls, scn_dir in jobs]
+
+        if backend == "async":
+            downloader = AsyncDownloader(workers=workers, scene_workers=scene_workers, 
+                                         host_connections=host_connections, 
+                                         show_progress=show_progress, manifest=manifest, 
+                                         throttle=throttle)
+        elif backend == "threads":
+            downloader = Downloader(workers=workers, scene_workers=scene_workers, 
+                                    show_progress=show_progress, manifest=manifest, 
+                                    throttle=throttle)
+        else:
+            raise RuntimeError("Unknown download backend {0:s}".format(backend))
+        try:
+            failed = downloader.run(jobs)
+            if cache is not None:
+                failed_urls = set([url for scn_failed in failed.values() for url, _ in scn_failed])
+                for _, urls, scn_dir in jobs:
+                    for url in urls:
+                        if url not in failed_urls and remote_stats.get(url) is not None:
+                            cache.store(url, os.path.join(scn_dir, url.split('/')[-1]), *remote_stats[url])
+        finally:
+            if manifest is not None:
+                manifest.close()
+            if cache is not None:
+                cache.close()
+        for scn_name, _, _ in jobs:
+            if scn_name not in failed:
+                self._saved_scenes[scn_name] = True
+
+        return [scn_name for scn_name, _, _ in jobs if scn_name in failed]
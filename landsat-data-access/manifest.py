@@ -0,0 +1,153 @@
+import os
+import time
+import sqlite3
+import threading
+
+# File name of the manifest saved in the output directory of downloads.
+MANIFEST_FNAME = ".landsat_download.db"
+
+class DownloadManifest(object):
+    """ A persistent record of the files downloaded to a directory.
+
+    For each file it keeps the url, the local path, the expected size
+    on the server, the number of bytes written so far and whether it
+    is complete, so that an interrupted download job can skip the
+    finished files and resume the partial ones when it is restarted.
+    It also keeps the MD5 digest of complete files, computed while
+    they were downloaded, so they can be validated without reading
+    them again. The manifest can be shared by the threads of one
+    process, and by processes and jobs on other hosts writing to the
+    same directory.
+    """
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        # The rollback journal works on network file systems where the
+        # output directories usually are, unlike WAL, and the busy
+        # timeout lets the writers wait for each other.
+        self._conn = sqlite3.connect(db_file, timeout=600,
+                                     check_same_thread=False,
+                                     isolation_level=None)
+        with self._lock:
+            # Also turns back manifests created in WAL mode.
+            self._conn.execute("PRAGMA journal_mode=DELETE")
+            self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+             url TEXT PRIMARY KEY,
+             scene TEXT,
+             local_path TEXT,
+             expected_size INTEGER,
+             written INTEGER NOT NULL DEFAULT 0,
+             complete INTEGER NOT NULL DEFAULT 0,
+             updated REAL,
+             md5 TEXT)""")
+            # Manifests written before digests were recorded.
+            columns = [rec[1] for rec in self._conn.execute("PRAGMA table_info(files)")]
+            if "md5" not in columns:
+                self._conn.execute("ALTER TABLE files ADD COLUMN md5 TEXT")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS files_local_path ON files (local_path)")
+
+
+    @classmethod
+    def forDir(cls, path):
+        """ Open the manifest of the download directory `path`. """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        return cls(os.path.join(path, MANIFEST_FNAME))
+
+
+    def get(self, url):
+        """ Returns the record of `url` as a dict, or None if unknown. """
+        with self._lock:
+            cur = self._conn.execute("""
+            SELECT url, scene, local_path, expected_size, written, complete, md5
+            FROM files WHERE url = ?""", (url, ))
+            rec = cur.fetchone()
+        if rec is None:
+            return None
+        keys = ("url", "scene", "local_path", "expected_size", "written", "complete", "md5")
+        rec = dict(zip(keys, rec))
+        rec["complete"] = bool(rec["complete"])
+        return rec
+
+
+    def register(self, url, scene, local_path, expected_size):
+        """ Add `url` or update its expected size, without touching its
+        download progress. """
+        # Absolute paths, so the digests can be looked up by path from
+        # another working directory.
+        local_path = os.path.abspath(local_path)
+        with self._lock:
+            self._conn.execute("""
+            INSERT OR IGNORE INTO files (url, scene, local_path, expected_size, updated)
+            VALUES (?, ?, ?, ?, ?)""", (url, scene, local_path, expected_size, time.time()))
+            self._conn.execute("""
+            UPDATE files SET scene = ?, local_path = ?, expected_size = ?, updated = ?
+            WHERE url = ?""", (scene, local_path, expected_size, time.time(), url))
+
+
+    def progress(self, url, written):
+        with self._lock:
+            self._conn.execute("""
+            UPDATE files SET written = ?, complete = 0, updated = ?, md5 = NULL
+            WHERE url = ?""", (written, time.time(), url))
+
+
+    def markComplete(self, url, written, md5=None):
+        # md5: digest (hex) of the whole file, if known.
+        with self._lock:
+            self._conn.execute("""
+            UPDATE files SET written = ?, complete = 1, updated = ?, md5 = ?
+            WHERE url = ?""", (written, time.time(), md5, url))
+
+
+    def recordDigest(self, local_path, md5):
+        """ Record the digest of a complete local file, e.g. one that
+        was not downloaded by this package but validated in this
+        directory, keyed by its file:// url if it is not known. """
+        local_path = os.path.abspath(local_path)
+        size = os.path.getsize(local_path)
+        with self._lock:
+            cur = self._conn.execute("""
+            UPDATE files SET md5 = ?, updated = ?
+            WHERE local_path = ? AND complete = 1 AND written = ?""", (md5, time.time(), local_path, size))
+            if cur.rowcount == 0:
+                self._conn.execute("""
+                INSERT OR REPLACE INTO files (url, scene, local_path, expected_size, written, complete, updated, md5)
+                VALUES (?, NULL, ?, ?, ?, 1, ?, ?)""", ("file://" + local_path, local_path, size, size, time.time(), md5))
+
+
+    def digestOf(self, local_path):
+        """ Returns the MD5 digest recorded for the complete file at
+        `local_path`, or None if there is none or the file changed
+        size since. """
+        local_path = os.path.abspath(local_path)
+        if not os.path.isfile(local_path):
+            return None
+        size = os.path.getsize(local_path)
+        with self._lock:
+            cur = self._conn.execute("""
+            SELECT md5 FROM files
+            WHERE local_path = ? AND complete = 1 AND written = ? AND md5 IS NOT NULL
+            ORDER BY updated DESC""", (local_path, size))
+            rec = cur.fetchone()
+        return None if rec is None else rec[0]
+
+
+    def isComplete(self, url, local_path):
+        """ Whether `url` was completely downloaded to `local_path` and
+        the local file still has the expected size. """
+        rec = self.get(url)
+        if rec is None or not rec["complete"]:
+            return False
+        if rec["local_path"] != os.path.abspath(local_path) or not os.path.isfile(local_path):
+            return False
+        size = os.path.getsize(local_path)
+        if rec["expected_size"] is not None and size != rec["expected_size"]:
+            return False
+        return size == rec["written"]
+
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -21,6 +21,7 @@ proc = psutil.Process(os.getpid())
 
 LOGGING = {
     "version" : 1, 
+    "disable_existing_loggers" : False, 
     "formatters" : {
         "default" : {
             "format" : "%(asctime)s %(levelname)s %(message)s", 
@@ -45,20 +46,56 @@ logger = logging.getLogger('landsat-query')
 def getCmdArgs():
     p = argparse.ArgumentParser(description="Search Landsat TOA data from public repositories such as Google Storage or AWS S3.", formatter_class=argparse.RawTextHelpFormatter)
 
-    p.add_argument("-l", "--list", dest="prd_list", required=True, default=None, metavar="CSV_OF_PATH_ROW_DATE_LIST", help=textwrap.fill("A CSV file of the list of path, row, start date, end date, to search and download available scenes. Sample format: ") + textwrap.dedent('''
+    search_by = p.add_mutually_exclusive_group(required=True)
+    search_by.add_argument("-l", "--list", dest="prd_list", default=None, metavar="CSV_OF_PATH_ROW_DATE_LIST", help=textwrap.fill("A CSV file of the list of path, row, start date, end date, to search and download available scenes. Sample format: ") + textwrap.dedent('''
     path,row,start_date,end_date
     18,32,2017-08-19,2017-08-25
     92,86,2015-08-22,2015-08-22'''))
+    search_by.add_argument("--bbox", dest="bbox", type=float, nargs=4, default=None, metavar=("WEST", "SOUTH", "EAST", "NORTH"), help=textwrap.fill("Search scenes whose footprints intersect a box of longitude and latitude in degrees, instead of a list of path/row. WEST > EAST for a box across the antimeridian."))
+    search_by.add_argument("--geojson", dest="geojson", default=None, metavar="GEOJSON_FILE_FOR_GEOSPATIAL_SEARCH", help=textwrap.fill("Search scenes whose footprints intersect the polygons in a GeoJSON file, instead of a list of path/row."))
+    p.add_argument("--start_date", dest="start_date", required=False, default=None, metavar="YYYY-MM-DD", help=textwrap.fill("Start date of the search by --bbox or --geojson, including this day."))
+    p.add_argument("--end_date", dest="end_date", required=False, default=None, metavar="YYYY-MM-DD", help=textwrap.fill("End date of the search by --bbox or --geojson, including this day."))
     p.add_argument("-s", "--spacecraft", dest="spacecraft_id", required=True, metavar="SPACECRAFT_ID", choices=["5", "7", "8"], default=None, help=textwrap.fill("Landsat spacecraft ID; choices: 5, 7, 8."))
     p.add_argument("-c", "--channel", dest="channel", required=False, metavar="CHANNEL_NAME", choices=["Google", "AWS"], default="Google", help=textwrap.fill("The channel of the data repository from which Landsat data to be searched and downloaded, Google Storage: 'Google'; AWS S3: 'AWS'. Default: 'Google'."))
     p.add_argument("-i", "--index", dest="index_db", required=True, metavar="SQLITE_DATABASE_FILE_OF_LANDSAT_INDEX", default=None, help=textwrap.fill("A SQLite database file of Landsat data index of the data repository. It can be generated using 'update_landsat_index.py'."))
 
     p.add_argument("-o", "--output", dest="outfile", required=True, default=None, help="A CSV file to write the found Landsat scene list to.")
 
+    p.add_argument("--max_cloud", dest="max_cloud", type=float, required=False, default=None, metavar="PERCENT", help=textwrap.fill("Only find scenes with cloud cover up to this percent in the index. Default: all scenes."))
+    p.add_argument("--tier", dest="tiers", nargs="+", required=False, default=None, metavar="TIER", help=textwrap.fill("Only find scenes of these collection tiers, e.g. T1, T2, RT. Default: all tiers."))
+    p.add_argument("--level", dest="levels", nargs="+", required=False, default=None, metavar="PROCESSING_LEVEL", help=textwrap.fill("Only find scenes of these processing levels, i.e. data types, e.g. L1TP, L1GT, L1GS. Default: all levels."))
+
+    p.add_argument("--snapshot", dest="snapshot_dir", required=False, default=None, metavar="DIRECTORY_OF_INDEX_SNAPSHOT", help=textwrap.fill("Answer the searches by --list from a columnar snapshot of the index written by 'update_landsat_index.py --snapshot', instead of the database. The snapshot is memory-mapped, so many searches running at once on a node share one copy of it in memory. Searches by --bbox or --geojson still use the database. A snapshot written before the last update of the database is refused."))
+
+    p.add_argument("--no_batch", dest="batch", required=False, action="store_false", help=textwrap.fill("Search the index with one query per path/row/date window in the list, instead of one query per chunk of the list."))
+
     cmdargs = p.parse_args()
     
     return cmdargs
 
+def searchBatch(landsat_obj, prd_df, out_fobj, columns, out_header, filters):
+    # Search all the path/row/date windows of a chunk of the list in
+    # one query and write the found scenes. Returns the number found.
+    request = pd.DataFrame(dict(path=prd_df.iloc[:, 0].values, 
+                                row=prd_df.iloc[:, 1].values, 
+                                start_date=prd_df.iloc[:, 2].values, 
+                                end_date=prd_df.iloc[:, 3].values), 
+                           index=prd_df.index)
+    logger.info("Searching scenes for {0:d} path/row/date windows started.".format(len(request)))
+    tmp = landsat_obj.searchPathRows(request, columns=columns, **filters)
+    for req in request.loc[~request.index.isin(tmp["request_id"]), :].itertuples():
+        logger.warning(("No scenes found for " 
+                        + "path = {0:d}, row = {1:d}" 
+                        + " between {2:s} and {3:s}").format(req.path, req.row, 
+                                                             req.start_date.strftime("%Y-%m-%d"), 
+                                                             req.end_date.strftime("%Y-%m-%d")))
+    if len(tmp) > 0:
+        tmp = tmp.loc[:, columns]
+        tmp.columns = out_header
+        tmp.to_csv(out_fobj, index=False, header=False, mode="a")
+    return len(tmp)
+
+
 def main(cmdargs):
     prd_csv = cmdargs.prd_list
     spacecraft_id = "LANDSAT_{0:s}".format(cmdargs.spacecraft_id)
@@ -82,43 +119,71 @@ def main(cmdargs):
         raise RuntimeError("Accessing the data in the channel {0:s} not implemented!".format(repo_channel))
 
     landsat_obj = Landsat(spacecraft_id, repo_channel, index_db_name)
+    if cmdargs.snapshot_dir is not None:
+        landsat_obj.defIndexSnapshot(cmdargs.snapshot_dir)
     out_header = ["scene_id", "url", "product_id", "wrs_path", "wrs_row", "acq_date"]
+    # Scene filters evaluated in the index query, so that unwanted
+    # scenes never make it to the list to download.
+    filters = dict(max_cloud=cmdargs.max_cloud, tiers=cmdargs.tiers, levels=cmdargs.levels)
     n_found = 0
     chunksize = int(1e3)
 
     with open(outfile, "w") as out_fobj:
         out_fobj.write(",".join(out_header))
         out_fobj.write("\n")
-        for prd_df in pd.read_csv(prd_csv, parse_dates=[2, 3], chunksize=chunksize):
-            for idx, row in enumerate(prd_df.itertuples()):
-                # for i in gc.get_objects():
-                #     before[type(i)] += 1
-
-                logger.info("Searching scenes for path = {0:d}, row = {1:d} started.".format(row[1], row[2]))
-
-                tmp = landsat_obj.searchPathRow(row[1], row[2], 
-                                                start_date=row[3].strftime("%Y-%m-%d"), 
-                                                end_date=row[4].strftime("%Y-%m-%d"))
-                if len(tmp) == 0:
-                    logger.warning(("No scenes found for " 
-                                    + "path = {0:d}, row = {1:d}" 
-                                    + " between {2:s} and {3:s}").format(row[1], row[2], 
-                                                                         row[3].strftime("%Y-%m-%d"), 
-                                                                         row[4].strftime("%Y-%m-%d")))
-                else:
-                    tmp = tmp.loc[:, [_colnames[k] for k in out_header]]
-                    tmp.columns = out_header
-                    tmp.to_csv(out_fobj, index=False, header=False, mode="a")
-
-                n_found = n_found + len(tmp)
-
-                # for i in gc.get_objects():
-                #     after[type(i)] += 1
-                # diff = [(k, after[k] - before[k]) for k in after if after[k] - before[k]]
-                # print idx, diff
-                logger.info("Memory = {0:d} at path = {1:d}, row = {2:d}".format(proc.memory_info().rss, row[1], row[2]))
+        if prd_csv is None:
+            columns = [_colnames[k] for k in out_header]
+            if cmdargs.bbox is not None:
+                logger.info("Searching scenes in the box {0:s} started.".format(str(cmdargs.bbox)))
+                tmp = landsat_obj.searchBBox(*cmdargs.bbox, start_date=cmdargs.start_date, 
+                                             end_date=cmdargs.end_date, columns=columns, **filters)
+            else:
+                logger.info("Searching scenes in {0:s} started.".format(cmdargs.geojson))
+                tmp = landsat_obj.searchGeometry(cmdargs.geojson, start_date=cmdargs.start_date, 
+                                                 end_date=cmdargs.end_date, columns=columns, **filters)
+            tmp.columns = out_header
+            tmp.to_csv(out_fobj, index=False, header=False, mode="a")
+            n_found = len(tmp)
+        else:
+            for prd_df in pd.read_csv(prd_csv, parse_dates=[2, 3], chunksize=chunksize):
+                if cmdargs.batch:
+                    n_found = n_found + searchBatch(landsat_obj, prd_df, out_fobj, 
+                                                    [_colnames[k] for k in out_header], out_header, filters)
+                    logger.info("Memory = {0:d} after {1:d} path/row/date windows".format(proc.memory_info().rss, 
+                                                                                        prd_df.index[-1]+1))
+                    continue
+
+                for idx, row in enumerate(prd_df.itertuples()):
+                    # for i in gc.get_objects():
+                    #     before[type(i)] += 1
+
+                    logger.info("Searching scenes for path = {0:d}, row = {1:d} started.".format(row[1], row[2]))
+
+                    tmp = landsat_obj.searchPathRow(row[1], row[2], 
+                                                    start_date=row[3].strftime("%Y-%m-%d"), 
+                                                    end_date=row[4].strftime("%Y-%m-%d"), 
+                                                    columns=[_colnames[k] for k in out_header], **filters)
+                    if len(tmp) == 0:
+                        logger.warning(("No scenes found for " 
+                                        + "path = {0:d}, row = {1:d}" 
+                                        + " between {2:s} and {3:s}").format(row[1], row[2], 
+                                                                             row[3].strftime("%Y-%m-%d"), 
+                                                                             row[4].strftime("%Y-%m-%d")))
+                    else:
+                        tmp = tmp.loc[:, [_colnames[k] for k in out_header]]
+                        tmp.columns = out_header
+                        tmp.to_csv(out_fobj, index=False, header=False, mode="a")
+
+                    n_found = n_found + len(tmp)
+
+                    # for i in gc.get_objects():
+                    #     after[type(i)] += 1
+                    # diff = [(k, after[k] - before[k]) for k in after if after[k] - before[k]]
+                    # print idx, diff
+                    logger.info("Memory = {0:d} at path = {1:d}, row = {2:d}".format(proc.memory_info().rss, row[1], row[2]))
 
     logger.info("{0:d} scenes found from {1:s}.".format(n_found, repo_channel))
+    logger.info("Query timing:\n{0:s}".format(landsat_obj.queryStats().to_string()))
 
 if __name__ == "__main__":
     cmdargs = getCmdArgs()
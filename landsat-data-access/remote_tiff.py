@@ -0,0 +1,263 @@
+import os
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    from osgeo import gdal, gdal_array, osr
+except ImportError:
+    gdal = None
+
+# Settings of GDAL for reading files on the buckets through /vsicurl/,
+# unless they are set in the environment: do not list the folder of a
+# file when opening it, and fetch consecutive ranges with one request.
+VSICURL_CONFIG = dict(GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR",
+                      GDAL_HTTP_MERGE_CONSECUTIVE_RANGES="YES")
+
+if gdal is not None:
+    gdal.UseExceptions()
+    for _name, _value in VSICURL_CONFIG.items():
+        if gdal.GetConfigOption(_name) is None:
+            gdal.SetConfigOption(_name, _value)
+
+
+class TileCache(object):
+    """ Least-recently-used cache of the blocks of images in memory,
+    shared by the RemoteGeoTiff objects that are given it, with an
+    optional directory that keeps the blocks across runs.
+
+    Blocks are keyed by (url, version, block index), where the version
+    identifies the content of the file on the server, e.g. its ETag,
+    so the blocks of a file replaced on the server are not used.
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.nbytes = 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir is not None and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+
+    def _path(self, key):
+        url, version, block_idx = key
+        url_hash = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        version_hash = hashlib.sha1(str(version).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, url_hash[0:2], url_hash, version_hash, "{0:d}.npy".format(block_idx))
+
+
+    def _remember(self, key, tile):
+        with self._lock:
+            if key in self._tiles:
+                return
+            self._tiles[key] = tile
+            self.nbytes += tile.nbytes
+            while self.nbytes > self.max_bytes and len(self._tiles) > 1:
+                _, old = self._tiles.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+
+    def get(self, key):
+        """ A block from memory or the cache directory, or None. """
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+                return tile
+        if self.cache_dir is None or key[1] is None:
+            return None
+        fname = self._path(key)
+        if not os.path.isfile(fname):
+            return None
+        tile = np.load(fname)
+        self._remember(key, tile)
+        return tile
+
+
+    def put(self, key, tile):
+        self._remember(key, tile)
+        if self.cache_dir is None or key[1] is None:
+            return
+        fname = self._path(key)
+        version_dir = os.path.dirname(fname)
+        if not os.path.exists(version_dir):
+            # Drop the blocks of the earlier versions of the file.
+            url_dir = os.path.dirname(version_dir)
+            if os.path.isdir(url_dir):
+                for d in os.listdir(url_dir):
+                    shutil.rmtree(os.path.join(url_dir, d), ignore_errors=True)
+            os.makedirs(version_dir, exist_ok=True)
+        # Write aside and rename so readers never see a partial block.
+        tmp_fname = "{0:s}.{1:d}.tmp.npy".format(fname[:-len(".npy")], os.getpid())
+        np.save(tmp_fname, tile)
+        os.rename(tmp_fname, fname)
+
+
+class RemoteGeoTiff(object):
+    """ Read windows of a GeoTIFF on an HTTP server with GDAL through
+    /vsicurl/, which fetches the header and then only the byte ranges
+    of the blocks (tiles or strips) that intersect a window instead of
+    the whole file. The blocks read are kept in a TileCache. Longitude
+    and latitude are projected to the image with osr. Requires GDAL.
+    """
+    def __init__(self, url, cache=None):
+        if gdal is None:
+            raise RuntimeError("Reading windows of remote GeoTIFFs requires GDAL (osgeo).")
+        self.url = url
+        self.cache = TileCache() if cache is None else cache
+        self.path = "/vsicurl/{0:s}".format(url)
+        try:
+            self._ds = gdal.Open(self.path)
+        except RuntimeError as exc:
+            raise IOError("Could not open {0:s}: {1:s}".format(url, str(exc)))
+        # ETag, or size and time, of the file on the server.
+        self.version = self._version()
+
+        band = self._ds.GetRasterBand(1)
+        self.width = self._ds.RasterXSize
+        self.height = self._ds.RasterYSize
+        self.samples = self._ds.RasterCount
+        self.tile_width, self.tile_length = band.GetBlockSize()
+        self.tiles_across = (self.width + self.tile_width - 1) // self.tile_width
+        self.dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+        self.nodata = band.GetNoDataValue()
+
+        self.geotransform = None
+        self._to_image = None
+        wkt = self._ds.GetProjection()
+        if wkt:
+            self.geotransform = self._ds.GetGeoTransform()
+            srs = osr.SpatialReference(wkt=wkt)
+            lonlat = osr.SpatialReference()
+            lonlat.ImportFromEPSG(4326)
+            if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):
+                # GDAL 3 would otherwise take EPSG:4326 as lat/lon.
+                srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+                lonlat.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            self._to_image = osr.CoordinateTransformation(lonlat, srs)
+
+
+    def _version(self):
+        headers = None
+        if hasattr(gdal, "GetFileMetadata"):
+            headers = gdal.GetFileMetadata(self.path, "HEADERS")
+        if headers:
+            for name, value in headers.items():
+                if name.lower() == "etag":
+                    return value
+        stat = gdal.VSIStatL(self.path)
+        if stat is None:
+            return None
+        return "{0:d}-{1:d}".format(stat.size, stat.mtime)
+
+
+    def _readArray(self, xoff, yoff, xsize, ysize):
+        # Pixels of a window of the file as (ysize, xsize, samples).
+        arr = self._ds.ReadAsArray(xoff, yoff, xsize, ysize)
+        if arr is None:
+            raise IOError("Reading ({0:d}, {1:d}, {2:d}, {3:d}) of {4:s} failed".format(
+                xoff, yoff, xsize, ysize, self.url))
+        if arr.ndim == 2:
+            return arr[:, :, None]
+        return np.moveaxis(arr, 0, -1)
+
+
+    def _loadTiles(self, tile_indices):
+        # Blocks by index, from the cache, or else read together with
+        # one read of the file covering all the missing ones, which
+        # GDAL turns into range requests of their bytes.
+        tiles = dict()
+        missing = []
+        for t in tile_indices:
+            tile = self.cache.get((self.url, self.version, t))
+            if tile is not None:
+                tiles[t] = tile
+            else:
+                missing.append(t)
+        if len(missing) == 0:
+            return tiles
+
+        rows = [t // self.tiles_across for t in missing]
+        cols = [t % self.tiles_across for t in missing]
+        x0, y0 = min(cols) * self.tile_width, min(rows) * self.tile_length
+        x1 = min(self.width, (max(cols) + 1) * self.tile_width)
+        y1 = min(self.height, (max(rows) + 1) * self.tile_length)
+        arr = self._readArray(x0, y0, x1 - x0, y1 - y0)
+        for t, r, c in zip(missing, rows, cols):
+            tx, ty = c * self.tile_width - x0, r * self.tile_length - y0
+            tile = np.ascontiguousarray(arr[ty:ty + self.tile_length, tx:tx + self.tile_width])
+            self.cache.put((self.url, self.version, t), tile)
+            tiles[t] = tile
+        return tiles
+
+
+    def readWindow(self, xoff, yoff, xsize, ysize):
+        """ Pixels of a window of the image as an array of (ysize,
+        xsize), or (ysize, xsize, samples) for multi-band images.
+        The window must be inside the image. """
+        if xoff < 0 or yoff < 0 or xoff + xsize > self.width or yoff + ysize > self.height:
+            raise ValueError("Window ({0:d}, {1:d}, {2:d}, {3:d}) is outside the image of {4:d} x {5:d}".format(
+                xoff, yoff, xsize, ysize, self.width, self.height))
+        out = np.zeros((ysize, xsize, self.samples), dtype=self.dtype)
+        if xsize == 0 or ysize == 0:
+            return out if self.samples > 1 else out[:, :, 0]
+        c0, c1 = xoff // self.tile_width, (xoff + xsize - 1) // self.tile_width
+        r0, r1 = yoff // self.tile_length, (yoff + ysize - 1) // self.tile_length
+        tile_indices = [r * self.tiles_across + c for r in range(r0, r1 + 1) for c in range(c0, c1 + 1)]
+        tiles = self._loadTiles(tile_indices)
+        for t in tile_indices:
+            r, c = divmod(t, self.tiles_across)
+            tx, ty = c * self.tile_width, r * self.tile_length
+            x_a, x_b = max(xoff, tx), min(xoff + xsize, tx + self.tile_width)
+            y_a, y_b = max(yoff, ty), min(yoff + ysize, ty + self.tile_length)
+            out[y_a - yoff:y_b - yoff, x_a - xoff:x_b - xoff] = tiles[t][y_a - ty:y_b - ty, x_a - tx:x_b - tx]
+        return out if self.samples > 1 else out[:, :, 0]
+
+
+    def lonLatToPixel(self, lon, lat):
+        """ Fractional column and row of longitude and latitude. """
+        if self._to_image is None:
+            raise RuntimeError("No georeferencing found in {0:s}".format(self.url))
+        lon = np.atleast_1d(np.asarray(lon, dtype=float))
+        lat = np.atleast_1d(np.asarray(lat, dtype=float))
+        xy = np.array(self._to_image.TransformPoints(np.column_stack([lon, lat]).tolist()))
+        gt = self.geotransform
+        return (xy[:, 0] - gt[0]) / gt[1], (xy[:, 1] - gt[3]) / gt[5]
+
+
+    def lonLatWindow(self, west, south, east, north):
+        """ Pixel window (xoff, yoff, xsize, ysize) of the image that
+        covers a box of longitude and latitude, clipped to the image. """
+        # Edges of the box are curves in the projection, so sample them.
+        s = np.linspace(0, 1, 21)
+        lon = np.concatenate([west + (east - west) * s, np.full(s.size, east),
+                              west + (east - west) * s, np.full(s.size, west)])
+        lat = np.concatenate([np.full(s.size, south), south + (north - south) * s,
+                              np.full(s.size, north), south + (north - south) * s])
+        col, row = self.lonLatToPixel(lon, lat)
+        x0 = int(max(0, np.floor(col.min())))
+        x1 = int(min(self.width, np.ceil(col.max())))
+        y0 = int(max(0, np.floor(row.min())))
+        y1 = int(min(self.height, np.ceil(row.max())))
+        return x0, y0, max(0, x1 - x0), max(0, y1 - y0)
+
+
+    def readLonLatWindow(self, west, south, east, north):
+        """ Pixels of the image covering a box of longitude and
+        latitude.
+        :returns:
+            (array, geotransform) the pixels and the geotransform of
+            the window.
+        """
+        xoff, yoff, xsize, ysize = self.lonLatWindow(west, south, east, north)
+        gt = self.geotransform
+        window_gt = (gt[0] + xoff * gt[1], gt[1], 0.0, gt[3] + yoff * gt[5], 0.0, gt[5])
+        return self.readWindow(xoff, yoff, xsize, ysize), window_gt
+
+
+    def close(self):
+        self._ds = None
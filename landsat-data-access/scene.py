@@ -1,3 +1,8 @@
+try:
+    basestring
+except NameError:
+    basestring = str
+
 class Scene(object):
 
     def __init__(self, name, files=None):
@@ -0,0 +1,200 @@
+import os
+import time
+import errno
+import fcntl
+import shutil
+import sqlite3
+from contextlib import contextmanager
+
+import requests
+
+from common import get_session
+
+# Files in the cache directory.
+CACHE_DB_FNAME = "cache.db"
+CACHE_LOCK_FNAME = "cache.lock"
+CACHE_OBJECTS_DNAME = "objects"
+
+# ioctl of Linux to share the extents of one file with another
+# (reflink) on file systems that support it, e.g. XFS, Btrfs.
+FICLONE = 0x40049409
+
+def link_or_copy(src, dst, hard_link=True):
+    """ Make dst a file with the content of src, without copying data
+    if possible: a hard link, else a reflink, else a copy. Any file at
+    dst is replaced atomically.
+    :param hard_link:
+        False to never share the inode of src, so that dst has its own
+        mode and owner: only a reflink or a copy.
+    :returns:
+        (str) "link", "reflink" or "copy".
+    """
+    tmp = "{0:s}.{1:d}.tmp".format(dst, os.getpid())
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    how = None
+    if hard_link:
+        try:
+            os.link(src, tmp)
+            how = "link"
+        except OSError:
+            pass
+    if how is None:
+        try:
+            with open(src, "rb") as fsrc, open(tmp, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            how = "reflink"
+        except (OSError, IOError):
+            how = "copy"
+    try:
+        if how == "copy":
+            shutil.copyfile(src, tmp)
+        os.rename(tmp, dst)
+    except OSError:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+    return how
+
+
+class SceneCache(object):
+    """ A local cache of downloaded scene files shared by the download
+    jobs on a node or on shared storage.
+
+    Files are keyed by the product ID and the file name, i.e. the last
+    two parts of their url, and are valid as long as the size and the
+    ETag on the server match the ones recorded when they were cached.
+    Cached files are read-only and handed out as hard links (or
+    reflinks, or copies across file systems), so a job that needs a
+    scene another job already downloaded does not fetch it again. A
+    downloaded file is added as a reflink or a copy, so the file of the
+    job that downloaded it stays its own. The
+    least recently used files are evicted to keep the cache under a
+    quota of bytes. A lock file serializes the changes of the cache
+    between processes.
+    """
+    def __init__(self, cache_dir, quota=None):
+        self.cache_dir = cache_dir
+        self.quota = quota
+        self.objects_dir = os.path.join(cache_dir, CACHE_OBJECTS_DNAME)
+        if not os.path.exists(self.objects_dir):
+            os.makedirs(self.objects_dir)
+        self._lock_file = os.path.join(cache_dir, CACHE_LOCK_FNAME)
+        # The rollback journal works on network file systems where the
+        # shared memory of WAL does not.
+        self._conn = sqlite3.connect(os.path.join(cache_dir, CACHE_DB_FNAME), timeout=600,
+                                     isolation_level=None, check_same_thread=False)
+        with self._locked():
+            self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+             key TEXT PRIMARY KEY,
+             size INTEGER,
+             etag TEXT,
+             added REAL,
+             last_used REAL)""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS files_last_used ON files (last_used)")
+
+
+    @contextmanager
+    def _locked(self):
+        with open(self._lock_file, "a") as fobj:
+            fcntl.flock(fobj.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fobj.fileno(), fcntl.LOCK_UN)
+
+
+    def _key(self, url):
+        return "/".join(url.rstrip("/").split("/")[-2:])
+
+
+    def _path(self, key):
+        return os.path.join(self.objects_dir, *key.split("/"))
+
+
+    def remoteStat(self, url):
+        """ Returns (size, ETag) of `url` on the server; None for what
+        the server does not tell. """
+        try:
+            resp = get_session(url).head(url, allow_redirects=True, timeout=60)
+        except requests.RequestException:
+            return None, None
+        if resp.status_code != 200:
+            return None, None
+        size = resp.headers.get("content-length")
+        return (None if size is None else int(size)), resp.headers.get("ETag")
+
+
+    def linkTo(self, url, local_path, size, etag):
+        """ Put the cached file of `url` at `local_path` if it is in the
+        cache and matches the size and ETag on the server.
+        :returns:
+            (bool) whether the file came from the cache.
+        """
+        if size is None:
+            return False
+        key = self._key(url)
+        with self._locked():
+            rec = self._conn.execute("SELECT size, etag FROM files WHERE key = ?", (key, )).fetchone()
+            if rec is None:
+                return False
+            cached = self._path(key)
+            if (rec[0] != size or (etag is not None and rec[1] is not None and rec[1] != etag)
+                or not os.path.isfile(cached) or os.path.getsize(cached) != size):
+                # Stale or damaged, drop it.
+                self._drop(key)
+                return False
+            link_or_copy(cached, local_path)
+            self._conn.execute("UPDATE files SET last_used = ? WHERE key = ?", (time.time(), key))
+        return True
+
+
+    def store(self, url, local_path, size, etag):
+        """ Add the downloaded file at `local_path` of `url` to the
+        cache as a reflink or a copy, and evict the least recently used
+        files over the quota. """
+        if size is None or not os.path.isfile(local_path) or os.path.getsize(local_path) != size:
+            return
+        key = self._key(url)
+        cached = self._path(key)
+        with self._locked():
+            if not os.path.exists(os.path.dirname(cached)):
+                os.makedirs(os.path.dirname(cached))
+            # Not a hard link: making the cached file read-only would
+            # change the mode of the downloaded file too.
+            link_or_copy(local_path, cached, hard_link=False)
+            # Read-only, so the hard links out of the cache cannot be
+            # used to change the cached data in place.
+            os.chmod(cached, 0o444)
+            now = time.time()
+            self._conn.execute("""
+            INSERT OR REPLACE INTO files (key, size, etag, added, last_used)
+            VALUES (?, ?, ?, ?, ?)""", (key, size, etag, now, now))
+            self._evict()
+
+
+    def _drop(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        self._conn.execute("DELETE FROM files WHERE key = ?", (key, ))
+
+
+    def _evict(self):
+        if self.quota is None:
+            return
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+        if total <= self.quota:
+            return
+        for key, size in self._conn.execute("SELECT key, size FROM files ORDER BY last_used").fetchall():
+            if total <= self.quota:
+                break
+            self._drop(key)
+            total -= size
+
+
+    def close(self):
+        self._conn.close()
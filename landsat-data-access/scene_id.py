@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+
+# Characters of an ID that are decoded; longer IDs are cut.
+SCENE_ID_WIDTH = 25
+ASCII_ZERO = ord("0")
+
+# Columns from parse_scene_ids and their types.
+SCENE_ID_COLUMNS = [("spacecraft", np.int8),
+                    ("path", np.int16),
+                    ("row", np.int16),
+                    ("year", np.int16),
+                    ("doy", np.int16),
+                    ("date", "datetime64[ns]"),
+                    ("valid", np.bool_)]
+
+def _id_chars(scn_ids):
+    """ Scene IDs as a 2D array of ASCII codes, one row per character
+    position and one column per ID, so the operations over all the IDs
+    run on contiguous memory. """
+    scn_ids = pd.Series(scn_ids).fillna("").astype(str)
+    try:
+        buf = np.asarray(scn_ids.values, dtype="S{0:d}".format(SCENE_ID_WIDTH))
+    except UnicodeEncodeError:
+        buf = np.asarray([s.encode("ascii", "replace") for s in scn_ids.values],
+                         dtype="S{0:d}".format(SCENE_ID_WIDTH))
+    return np.ascontiguousarray(buf.view(np.uint8).reshape(len(buf), SCENE_ID_WIDTH).T)
+
+
+def _digits(chars, start, stop):
+    """ Integers of the decimal digits at positions [start, stop) of
+    the IDs, and whether they all were digits. """
+    val = np.zeros(chars.shape[1], dtype=np.int32)
+    ok = np.ones(chars.shape[1], dtype=np.bool_)
+    for i in range(start, stop):
+        d = chars[i] - np.uint8(ASCII_ZERO)
+        # Characters below "0" wrap around to large values.
+        ok &= d <= 9
+        val = val * 10 + d
+    return val, ok
+
+
+def decode_id_chars(chars):
+    """ Decode scene IDs given as ASCII codes, one row per character
+    position (at least SCENE_ID_WIDTH rows, 0 past the end of an ID)
+    and one column per ID.
+    :returns:
+        dict of the columns in SCENE_ID_COLUMNS as numpy arrays, 0 or
+        NaT where "valid" is False.
+    """
+    # Product IDs have "_" after the 4 characters of the sensor and
+    # spacecraft, e.g. LC08_.
+    is_prd = chars[4] == ord("_")
+
+    # Pre-collection: LXSPPPRRRYYYYDDD
+    scft_s, ok_s = _digits(chars, 2, 3)
+    path_s, ok_p = _digits(chars, 3, 6)
+    row_s, ok_r = _digits(chars, 6, 9)
+    year_s, ok_y = _digits(chars, 9, 13)
+    doy_s, ok_d = _digits(chars, 13, 16)
+    ok_scn = ok_s & ok_p & ok_r & ok_y & ok_d & (doy_s >= 1) & (doy_s <= 366)
+
+    # Collection: LXSS_LLLL_PPPRRR_YYYYMMDD
+    scft_c, ok_s = _digits(chars, 2, 4)
+    path_c, ok_p = _digits(chars, 10, 13)
+    row_c, ok_r = _digits(chars, 13, 16)
+    year_c, ok_y = _digits(chars, 17, 21)
+    month_c, ok_m = _digits(chars, 21, 23)
+    day_c, ok_d = _digits(chars, 23, 25)
+    ok_prd = (ok_s & ok_p & ok_r & ok_y & ok_m & ok_d & (chars[9] == ord("_")) & (chars[16] == ord("_"))
+              & (month_c >= 1) & (month_c <= 12) & (day_c >= 1) & (day_c <= 31))
+
+    valid = np.where(is_prd, ok_prd, ok_scn) & (chars[0] == ord("L"))
+    year = np.where(is_prd, year_c, year_s)
+    year_start = (np.where(valid, year, 1970) - 1970).astype("datetime64[Y]").astype("datetime64[D]")
+    month_start = (np.where(valid & is_prd, year_c, 1970) - 1970) * 12 + np.where(valid & is_prd, month_c, 1) - 1
+    date_c = month_start.astype("datetime64[M]").astype("datetime64[D]") + (day_c - 1).astype("timedelta64[D]")
+    date_s = year_start + (doy_s - 1).astype("timedelta64[D]")
+    date = np.where(is_prd, date_c, date_s)
+    # Days past the end of the month or the year, e.g. 20150231 or
+    # 2015366.
+    valid &= np.where(is_prd, date_c.astype("datetime64[M]") == month_start.astype("datetime64[M]"),
+                      date_s.astype("datetime64[Y]") == year_start.astype("datetime64[Y]"))
+    doy = (date - year_start).astype(np.int64) + 1
+    date = np.where(valid, date, np.datetime64("NaT"))
+
+    columns = dict(spacecraft=np.where(is_prd, scft_c, scft_s),
+                   path=np.where(is_prd, path_c, path_s),
+                   row=np.where(is_prd, row_c, row_s),
+                   year=year,
+                   doy=doy,
+                   date=date,
+                   valid=valid)
+    return dict((nm, np.where(valid, columns[nm], 0).astype(dt) if nm not in ("date", "valid")
+                 else columns[nm].astype(dt))
+                for nm, dt in SCENE_ID_COLUMNS)
+
+
+def parse_scene_ids(scn_ids, errors="raise"):
+    """ Decode Landsat pre-collection scene IDs (LC80180302015234LGN01)
+    and collection product IDs (LC08_L1TP_018030_20150822_...), mixed
+    in any order, with vectorized operations over all the IDs at once.
+    :param scn_ids:
+        Sequence of IDs, e.g. a column of a DataFrame.
+    :param errors:
+        "raise" to raise ValueError if some IDs cannot be decoded;
+        "mask" to flag them False in the column "valid".
+    :returns:
+        DataFrame of the columns in SCENE_ID_COLUMNS, with the index
+        of `scn_ids` if it is a Series.
+    """
+    columns = decode_id_chars(_id_chars(scn_ids))
+    valid = columns["valid"]
+    if errors == "raise" and not valid.all():
+        bad = np.flatnonzero(~valid)
+        raise ValueError("{0:d} of {1:d} scene IDs cannot be decoded, e.g. {2:s}".format(
+            len(bad), len(valid), str(pd.Series(scn_ids).iloc[bad[0]])))
+
+    out = pd.DataFrame(columns, columns=[nm for nm, _ in SCENE_ID_COLUMNS])
+    if isinstance(scn_ids, pd.Series):
+        out.index = scn_ids.index
+    return out
+
+
+def spacecraft_ids(scn_ids):
+    """ Landsat spacecraft IDs (e.g. LANDSAT_8) of scene IDs and product
+    IDs, None for the IDs that cannot be decoded or of spacecraft other
+    than Landsat 5, 7 and 8.
+    :returns:
+        Series, with the index of `scn_ids` if it is a Series.
+    """
+    ids = parse_scene_ids(scn_ids, errors="mask")
+    ok = ids["valid"] & ids["spacecraft"].isin([5, 7, 8])
+    return pd.Series(np.where(ok, "LANDSAT_" + ids["spacecraft"].astype(str), None), index=ids.index, dtype=object)
@@ -0,0 +1,182 @@
+import os
+import csv
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import pandas as pd
+
+from landsat import Landsat
+from scene_id import spacecraft_ids
+
+logger = logging.getLogger('landsat-downloader')
+
+def index_url_to_bucket_id(index_url):
+    """ Bucket (GOOGLE or AWS) of a scene index url, or None. """
+    if index_url[0:5] == "gs://" or index_url.find("googleapis.com") > -1:
+        return "GOOGLE"
+    elif index_url.find("amazonaws.com") > -1:
+        return "AWS"
+    return None
+
+
+def scene_batches(scn_csv, batch_size=50, chunksize=int(1e3)):
+    """ Read a CSV of scene IDs and index urls (first and second
+    columns) in chunks and group the scenes into batches of the same
+    bucket and spacecraft.
+    :returns:
+        generator of (bucket, spacecraft, DataFrame of the rows of the
+        CSV); bucket and spacecraft are None for a batch of rows that
+        cannot be parsed.
+    """
+    pending = dict()
+    for scn_df in pd.read_csv(scn_csv, chunksize=chunksize, dtype=str):
+        scft = spacecraft_ids(scn_df.iloc[:, 0])
+        repo = scn_df.iloc[:, 1].fillna("").map(index_url_to_bucket_id)
+        bad = scft.isnull() | repo.isnull()
+        if bad.any():
+            yield None, None, scn_df.loc[bad, :]
+        for (r, s), df in scn_df.loc[~bad, :].groupby([repo[~bad], scft[~bad]], sort=False):
+            df = df if (r, s) not in pending else pd.concat([pending.pop((r, s)), df])
+            while len(df) >= batch_size:
+                yield r, s, df.iloc[0:batch_size, :]
+                df = df.iloc[batch_size:, :]
+            if len(df) > 0:
+                pending[(r, s)] = df
+    for (r, s), df in pending.items():
+        yield r, s, df
+
+
+def download_batch(repo, scft, scn_df, outdir, bands="all", save_kwargs=None):
+    """ Download the scenes of one batch of the same bucket and
+    spacecraft. Runs in a worker of DownloadScheduler.
+    :returns:
+        (list) index labels of the rows of scn_df that failed.
+    """
+    landsat_obj = Landsat(scft, repo, bands=bands)
+    bad = []
+    for label, scn_id, index_url in zip(scn_df.index, scn_df.iloc[:, 0], scn_df.iloc[:, 1]):
+        if landsat_obj.addScene(scn_id, index_url) is None:
+            logger.error("Adding scene {0:s} to the download queue failed, and will be skipped.".format(scn_id))
+            bad.append(label)
+    failed = set(landsat_obj.saveToDir(outdir, **(save_kwargs or dict())))
+    for scn_name in failed:
+        logger.error("Saving scene {0:s} failed.".format(scn_name))
+    bad.extend([label for label, scn_id in zip(scn_df.index, scn_df.iloc[:, 0]) if scn_id in failed])
+    return bad
+
+
+class DownloadScheduler(object):
+    """ Download the scenes of a scene list CSV with a pool of workers,
+    each downloading one batch of scenes of the same bucket and
+    spacecraft at a time.
+
+    The list is read in chunks and only a few batches per worker are
+    queued at any time, so long lists do not have to fit in memory.
+    Failed scenes do not stop the others; their rows of the list are
+    written to a CSV of the same format, to feed back in to retry.
+    """
+    def __init__(self, outdir, jobs=1, batch_size=50, pool="process",
+                 bands="all", save_kwargs=None, failed_csv=None):
+        self.outdir = outdir
+        self.jobs = max(1, int(jobs))
+        self.batch_size = max(1, int(batch_size))
+        self.pool = pool
+        self.bands = bands
+        self.save_kwargs = save_kwargs
+        self.failed_csv = failed_csv
+
+
+    def run(self, scn_csv, chunksize=int(1e3)):
+        """ Download all the scenes of the list.
+        :returns:
+            (int, int) numbers of scenes saved and failed.
+        """
+        n_total = sum([len(df) for df in pd.read_csv(scn_csv, usecols=[0], chunksize=chunksize)])
+        header = list(pd.read_csv(scn_csv, nrows=0).columns)
+        n_good = 0
+        n_bad = 0
+        t0 = time.time()
+
+        # The failed scenes are written aside and moved in place at the
+        # end, as the list may be the failed list of an earlier run.
+        failed_fobj = None
+        if self.failed_csv is not None:
+            failed_tmp = "{0:s}.{1:d}.tmp".format(self.failed_csv, os.getpid())
+            failed_fobj = open(failed_tmp, "w", newline="")
+            csv.writer(failed_fobj).writerow(header)
+
+        def report_failed(scn_df):
+            if failed_fobj is not None and len(scn_df) > 0:
+                scn_df.to_csv(failed_fobj, index=False, header=False)
+                failed_fobj.flush()
+
+        if self.pool == "process":
+            executor = ProcessPoolExecutor(max_workers=self.jobs)
+        elif self.pool == "thread":
+            executor = ThreadPoolExecutor(max_workers=self.jobs)
+        else:
+            raise RuntimeError("Unknown worker pool {0:s}".format(self.pool))
+
+        in_flight = dict()
+        batches = scene_batches(scn_csv, batch_size=self.batch_size, chunksize=chunksize)
+        try:
+            exhausted = False
+            while not exhausted or len(in_flight) > 0:
+                while not exhausted and len(in_flight) < 2 * self.jobs:
+                    try:
+                        repo, scft, scn_df = next(batches)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if repo is None:
+                        for scn_id, index_url in zip(scn_df.iloc[:, 0], scn_df.iloc[:, 1]):
+                            logger.error(("Scene {0:s} with index url {1:s} cannot be parsed to "
+                                          + "a Landsat spacecraft and data repository, and will be skipped.").format(
+                                              str(scn_id), str(index_url)))
+                        n_bad += len(scn_df)
+                        report_failed(scn_df)
+                        continue
+                    fut = executor.submit(download_batch, repo, scft, scn_df, self.outdir,
+                                          self.bands, self.save_kwargs)
+                    in_flight[fut] = scn_df
+                if len(in_flight) == 0:
+                    continue
+
+                done, _ = wait(list(in_flight.keys()), return_when=FIRST_COMPLETED)
+                for fut in done:
+                    scn_df = in_flight.pop(fut)
+                    exc = fut.exception()
+                    if exc is not None:
+                        logger.error("A batch of {0:d} scenes failed: {1:s}".format(len(scn_df), str(exc)))
+                        bad = list(scn_df.index)
+                    else:
+                        bad = fut.result()
+                    n_bad += len(bad)
+                    n_good += len(scn_df) - len(bad)
+                    report_failed(scn_df.loc[bad, :])
+
+                n_done = n_good + n_bad
+                elapsed = time.time() - t0
+                eta = elapsed / n_done * (n_total - n_done) if n_done > 0 else float("nan")
+                logger.info("Progress: {0:d} of {1:d} scenes done, {2:d} failed, {3:.1f} min elapsed, {4:.1f} min left.".format(
+                    n_done, n_total, n_bad, elapsed / 60., eta / 60.))
+        except:
+            # Keep the failed list of an earlier run if this one is
+            # interrupted.
+            if failed_fobj is not None:
+                failed_fobj.close()
+                os.remove(failed_tmp)
+            raise
+        finally:
+            executor.shutdown(wait=True)
+
+        if failed_fobj is not None:
+            failed_fobj.close()
+            if n_bad > 0:
+                os.replace(failed_tmp, self.failed_csv)
+            else:
+                os.remove(failed_tmp)
+                if os.path.isfile(self.failed_csv):
+                    os.remove(self.failed_csv)
+        return n_good, n_bad
@@ -0,0 +1,247 @@
+import os
+import json
+import shutil
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from index_db import INDEX_DATETIME_FORMAT, get_meta
+
+# Columns of the index kept in a snapshot and how each one is stored:
+# "int16"/"float64": numeric arrays; "time": datetime64[us];
+# "category": uint8 codes into a list of values; "bytes": fixed-width
+# byte strings. The first three columns are the path, row and
+# acquisition time that the records are sorted by.
+SNAPSHOT_COLUMNS = dict(
+    google=[("WRS_PATH", "int16"),
+            ("WRS_ROW", "int16"),
+            ("SENSING_TIME", "time"),
+            ("CLOUD_COVER", "float64"),
+            ("SPACECRAFT_ID", "category"),
+            ("COLLECTION_NUMBER", "category"),
+            ("COLLECTION_CATEGORY", "category"),
+            ("DATA_TYPE", "category"),
+            ("SCENE_ID", "bytes"),
+            ("PRODUCT_ID", "bytes"),
+            ("BASE_URL", "bytes")],
+    aws=[("path", "int16"),
+         ("row", "int16"),
+         ("acquisitionDate", "time"),
+         ("cloudCover", "float64"),
+         ("processingLevel", "category"),
+         ("entityId", "bytes"),
+         ("productId", "bytes"),
+         ("download_url", "bytes")])
+
+# WRS-2 has paths 1-233 and rows 1-248.
+MAX_WRS_PATH = 233
+MAX_WRS_ROW = 248
+
+SNAPSHOT_META_FNAME = "snapshot.json"
+SNAPSHOT_OFFSETS_FNAME = "path_row_offsets.npy"
+
+def _path_row_key(path, row):
+    return np.asarray(path, dtype=np.int64) * (MAX_WRS_ROW + 1) + np.asarray(row, dtype=np.int64)
+
+
+def index_state(conn, tname):
+    """ Number of records of an index table and the time of the last
+    update of the database, which a snapshot is checked against. """
+    n = conn.execute('SELECT COUNT(*) FROM "{0:s}"'.format(tname)).fetchone()[0]
+    return n, get_meta(conn, "updated")
+
+
+def build_snapshot(db_file, tname, channel, out_dir, chunksize=int(1e5)):
+    """ Write the columnar snapshot of an index table to the directory
+    out_dir, replacing any snapshot there. The records are sorted by
+    path, row and acquisition time, and an offset table gives the
+    range of records of each path/row.
+    :returns:
+        (int) number of records in the snapshot.
+    """
+    spec = SNAPSHOT_COLUMNS[channel]
+    cols = [c for c, _ in spec]
+    conn = sqlite3.connect(db_file)
+    n, updated = index_state(conn, tname)
+    widths = dict()
+    for col, kind in spec:
+        if kind == "bytes":
+            w = conn.execute('SELECT MAX(LENGTH({0:s})) FROM "{1:s}"'.format(col, tname)).fetchone()[0]
+            widths[col] = max(1, 0 if w is None else w)
+
+    tmp_dir = "{0:s}.tmp".format(out_dir.rstrip(os.sep))
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    meta = dict(channel=channel, table=tname, n=n, updated=updated, columns=[])
+    arrays = dict()
+    for col, kind in spec:
+        if kind == "time":
+            dtype = np.dtype("datetime64[us]")
+        elif kind == "category":
+            dtype = np.dtype(np.uint8)
+        elif kind == "bytes":
+            dtype = np.dtype("S{0:d}".format(widths[col]))
+        else:
+            dtype = np.dtype(kind)
+        arrays[col] = np.lib.format.open_memmap(os.path.join(tmp_dir, "{0:s}.npy".format(col)),
+                                                mode="w+", dtype=dtype, shape=(n, ))
+        meta["columns"].append(dict(name=col, kind=kind, categories=[]))
+    categories = dict((c["name"], c["categories"]) for c in meta["columns"])
+
+    sql = 'SELECT {0:s} FROM "{1:s}" ORDER BY {2:s}, {3:s}, {4:s}'.format(", ".join(cols), tname, *cols[0:3])
+    i = 0
+    for df in pd.read_sql_query(sql, conn, chunksize=chunksize):
+        j = i + len(df)
+        for col, kind in spec:
+            if kind == "time":
+                arrays[col][i:j] = pd.to_datetime(df[col]).values.astype("datetime64[us]")
+            elif kind == "category":
+                values = df[col].fillna("").astype(str)
+                cats = categories[col]
+                for v in values.unique():
+                    if v not in cats:
+                        cats.append(v)
+                if len(cats) > 255:
+                    raise RuntimeError("Too many values of {0:s} to store as a category".format(col))
+                arrays[col][i:j] = pd.Categorical(values, categories=cats).codes
+            elif kind == "bytes":
+                arrays[col][i:j] = df[col].fillna("").astype(str).str.encode("ascii").values
+            else:
+                arrays[col][i:j] = df[col].values
+        i = j
+    conn.close()
+
+    keys = _path_row_key(arrays[cols[0]], arrays[cols[1]])
+    bins = np.arange((MAX_WRS_PATH + 1) * (MAX_WRS_ROW + 1) + 1)
+    np.save(os.path.join(tmp_dir, SNAPSHOT_OFFSETS_FNAME), np.searchsorted(keys, bins).astype(np.int64))
+    for arr in arrays.values():
+        arr.flush()
+    del arrays
+    with open(os.path.join(tmp_dir, SNAPSHOT_META_FNAME), "w") as fobj:
+        json.dump(meta, fobj, indent=1)
+
+    # Swap the new snapshot in. Processes that still map the old files
+    # keep reading them until they reopen the snapshot.
+    old_dir = "{0:s}.old".format(out_dir.rstrip(os.sep))
+    if os.path.exists(out_dir):
+        if os.path.exists(old_dir):
+            shutil.rmtree(old_dir)
+        os.rename(out_dir, old_dir)
+    os.rename(tmp_dir, out_dir)
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+    return n
+
+
+class IndexSnapshot(object):
+    """ Read-only columnar snapshot of an index table written by
+    build_snapshot. The arrays are memory-mapped, so the processes on
+    one node that open the same snapshot share its pages in the page
+    cache instead of each loading a copy.
+    """
+    def __init__(self, snapshot_dir):
+        self.snapshot_dir = snapshot_dir
+        with open(os.path.join(snapshot_dir, SNAPSHOT_META_FNAME), "r") as fobj:
+            meta = json.load(fobj)
+        self.channel = meta["channel"]
+        self.table = meta["table"]
+        self.n = meta["n"]
+        self.updated = meta.get("updated")
+        self.kinds = dict((c["name"], c["kind"]) for c in meta["columns"])
+        self.categories = dict((c["name"], c["categories"]) for c in meta["columns"])
+        self.columns = [c["name"] for c in meta["columns"]]
+        self.arrays = dict((c, np.load(os.path.join(snapshot_dir, "{0:s}.npy".format(c)), mmap_mode="r"))
+                           for c in self.columns)
+        self.offsets = np.load(os.path.join(snapshot_dir, SNAPSHOT_OFFSETS_FNAME), mmap_mode="r")
+        self.time_col = self.columns[2]
+
+
+    def checkIndex(self, db_file):
+        """ Raise RuntimeError if the index database db_file has changed
+        since the snapshot was written from it, as the snapshot would
+        then miss its new and changed records. """
+        conn = sqlite3.connect(db_file)
+        try:
+            n, updated = index_state(conn, self.table)
+        finally:
+            conn.close()
+        if n != self.n or updated != self.updated:
+            raise RuntimeError(("Index snapshot {0:s} ({1:d} records, updated {2}) is out of date with the "
+                                + "index database {3:s} ({4:d} records, updated {5}), rewrite it with "
+                                + "update_landsat_index.py --snapshot").format(
+                                    self.snapshot_dir, self.n, self.updated, db_file, n, updated))
+
+
+    def categoryCode(self, col, value):
+        """ Code of a value of a category column, or -1 if the value
+        does not occur. """
+        cats = self.categories[col]
+        return cats.index(value) if value in cats else -1
+
+
+    def pathRowIndices(self, path, row, start_time=None, end_time=None):
+        """ Positions of the records of a path/row between two times
+        (str, YYYY-MM-DD HH:MM:SS, inclusive). """
+        if path < 0 or path > MAX_WRS_PATH or row < 0 or row > MAX_WRS_ROW:
+            return np.arange(0)
+        k = _path_row_key(path, row)
+        b, e = int(self.offsets[k]), int(self.offsets[k + 1])
+        # Records of a path/row are sorted by time.
+        times = self.arrays[self.time_col][b:e]
+        if start_time is not None:
+            b = b + int(np.searchsorted(times, np.datetime64(start_time.replace(" ", "T"), "us"), side="left"))
+        if end_time is not None:
+            e = e - len(times) + int(np.searchsorted(times, np.datetime64(end_time.replace(" ", "T"), "us"),
+                                                     side="right"))
+        return np.arange(b, max(b, e))
+
+
+    def isCategory(self, idx, col, values):
+        """ Mask of the records at positions idx whose category column
+        equals a value, or one of a list of values. """
+        if isinstance(values, (list, tuple)):
+            codes = [self.categoryCode(col, v) for v in values]
+            return np.isin(self.arrays[col][idx], codes)
+        return self.arrays[col][idx] == self.categoryCode(col, values)
+
+
+    def endsWith(self, idx, col, suffixes):
+        """ Mask of the records at positions idx whose bytes column ends
+        with one of a list of suffixes. """
+        values = self.arrays[col][idx]
+        mask = np.zeros(len(values), dtype=bool)
+        for suffix in suffixes:
+            mask |= np.char.endswith(values, suffix.encode("ascii"))
+        return mask
+
+
+    def toDataFrame(self, idx, columns=None):
+        """ Records at positions idx as a DataFrame with the same values
+        as a query of the index database gives. """
+        if columns is None:
+            columns = self.columns
+        data = dict()
+        for col in columns:
+            if col not in self.kinds:
+                raise KeyError("Column {0:s} is not in the index snapshot {1:s}".format(col, self.snapshot_dir))
+            kind = self.kinds[col]
+            values = self.arrays[col][idx]
+            if kind == "time":
+                data[col] = pd.to_datetime(values).strftime(INDEX_DATETIME_FORMAT)
+            elif kind == "category":
+                data[col] = np.asarray(self.categories[col], dtype=object)[values]
+            elif kind == "bytes":
+                data[col] = np.char.decode(values, "ascii").astype(object)
+            elif kind == "float64":
+                data[col] = np.array(values, dtype=np.float64)
+            elif kind == "float32":
+                # Snapshots written before the cloud cover was kept as
+                # float64: the shortest repr of a float32 is the value
+                # the database has, e.g. 39.12 rather than 39.119998...
+                data[col] = values.astype(str).astype(np.float64)
+            else:
+                data[col] = values.astype(np.int64)
+        return pd.DataFrame(data, columns=list(columns))
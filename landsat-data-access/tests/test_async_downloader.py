@@ -0,0 +1,171 @@
+import os
+import sys
+import base64
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from async_downloader import AsyncDownloader, aiohttp
+from manifest import DownloadManifest
+from throttle import Throttle
+
+
+class StandInServer(object):
+    """ A local HTTP server standing in for Google Storage: HEAD and GET
+    with byte ranges of files held in memory, with their MD5 digest in
+    x-goog-hash, and errors to answer a number of times for a path. """
+    def __init__(self):
+        self.files = dict()
+        self.errors = dict()
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def answer(self, with_body):
+                server.requests.append((self.command, self.path, self.headers.get("Range")))
+                errors = server.errors.get((self.command, self.path))
+                if errors:
+                    status = errors.pop(0)
+                    self.send_response(status)
+                    self.send_header("Retry-After", "0")
+                    self.send_header("Content-Length", "5")
+                    self.end_headers()
+                    if with_body:
+                        self.wfile.write(b"error")
+                    return
+                if self.path not in server.files:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                data, md5 = server.files[self.path]
+                start = 0
+                rng = self.headers.get("Range")
+                if rng is not None and with_body:
+                    start = int(rng.split("=")[1].rstrip("-"))
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes {0:d}-{1:d}/{2:d}".format(start, len(data) - 1, len(data)))
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", str(len(data) - start))
+                self.send_header("x-goog-hash", "crc32c=AAAAAA==,md5={0:s}".format(md5))
+                self.end_headers()
+                if with_body:
+                    self.wfile.write(data[start:])
+
+            def do_HEAD(self):
+                self.answer(False)
+
+            def do_GET(self):
+                self.answer(True)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{0:d}".format(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+
+    def add(self, path, data, md5=None):
+        if md5 is None:
+            md5 = hashlib.md5(data).digest()
+        self.files[path] = (data, base64.b64encode(md5).decode("ascii"))
+        return self.url + path
+
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@unittest.skipIf(aiohttp is None, "the async backend requires aiohttp")
+class AsyncDownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.manifest = DownloadManifest.forDir(self.tmp_dir)
+        self.n_scenes = 0
+
+
+    def tearDown(self):
+        self.manifest.close()
+        self.server.close()
+        shutil.rmtree(self.tmp_dir)
+
+
+    def sceneJobs(self, n_scenes, n_files, size):
+        jobs = []
+        for i in range(self.n_scenes, self.n_scenes + n_scenes):
+            scn_name = "LC08_SCENE_{0:d}".format(i)
+            urls = [self.server.add("/{0:s}/{0:s}_B{1:d}.TIF".format(scn_name, j), os.urandom(size))
+                    for j in range(n_files)]
+            jobs.append((scn_name, urls, os.path.join(self.tmp_dir, scn_name)))
+            os.makedirs(jobs[-1][2])
+        self.n_scenes += n_scenes
+        return jobs
+
+
+    def assertDownloaded(self, jobs):
+        for _, urls, dest_dir in jobs:
+            for url in urls:
+                path = url[len(self.server.url):]
+                with open(os.path.join(dest_dir, url.split("/")[-1]), "rb") as fobj:
+                    self.assertEqual(fobj.read(), self.server.files[path][0])
+                self.assertTrue(self.manifest.isComplete(url, os.path.join(dest_dir, url.split("/")[-1])))
+
+
+    def testDownloadScenes(self):
+        # Files of several blocks and of less than one.
+        jobs = self.sceneJobs(3, 4, 2500000) + self.sceneJobs(1, 3, 100)
+        downloader = AsyncDownloader(workers=4, scene_workers=2, host_connections=2, manifest=self.manifest)
+        self.assertEqual(downloader.run(jobs), dict())
+        self.assertDownloaded(jobs)
+
+        # Complete files are not asked for again.
+        n_requests = len(self.server.requests)
+        self.assertEqual(downloader.run(jobs), dict())
+        self.assertEqual(len(self.server.requests), n_requests)
+
+
+    def testResume(self):
+        jobs = self.sceneJobs(1, 1, 3000000)
+        url = jobs[0][1][0]
+        local_path = os.path.join(jobs[0][2], url.split("/")[-1])
+        with open(local_path, "wb") as fobj:
+            fobj.write(self.server.files[url[len(self.server.url):]][0][0:1000000])
+        self.assertEqual(AsyncDownloader(manifest=self.manifest).run(jobs), dict())
+        self.assertDownloaded(jobs)
+        self.assertIn(("GET", url[len(self.server.url):], "bytes=1000000-"), self.server.requests)
+
+
+    def testRetryThrottled(self):
+        jobs = self.sceneJobs(1, 2, 1000)
+        path = jobs[0][1][0][len(self.server.url):]
+        self.server.errors[("HEAD", path)] = [503]
+        self.server.errors[("GET", path)] = [429]
+        throttle = Throttle(bandwidth=1e9, host_connections=2, retries=3, backoff=0.01,
+                            lock_dir=os.path.join(self.tmp_dir, "throttle"))
+        self.assertEqual(AsyncDownloader(manifest=self.manifest, throttle=throttle).run(jobs), dict())
+        self.assertDownloaded(jobs)
+
+
+    def testErrors(self):
+        jobs = self.sceneJobs(1, 1, 1000)
+        # A missing file, and a file that does not match its digest.
+        missing = self.server.url + "/LC08_SCENE_0/LC08_SCENE_0_B9.TIF"
+        corrupt = self.server.add("/LC08_SCENE_0/LC08_SCENE_0_B8.TIF", b"x" * 1000, md5=b"\0" * 16)
+        jobs[0][1].extend([missing, corrupt])
+        failed = AsyncDownloader(manifest=self.manifest).run(jobs)
+        self.assertEqual(sorted([url for url, _ in failed["LC08_SCENE_0"]]), sorted([missing, corrupt]))
+        self.assertFalse(os.path.exists(os.path.join(jobs[0][2], "LC08_SCENE_0_B8.TIF")))
+        self.assertDownloaded([(jobs[0][0], jobs[0][1][0:1], jobs[0][2])])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,212 @@
+import os
+import re
+import time
+import fcntl
+import random
+import struct
+import logging
+import asyncio
+import tempfile
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+import requests
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from common import HTTPStatusError, IncompleteDownload
+from verify import ChecksumMismatch
+
+logger = logging.getLogger('landsat-downloader')
+
+# Default directory of the lock and state files shared by the download
+# processes on a node.
+THROTTLE_DIR = os.path.join(tempfile.gettempdir(), "landsat-throttle")
+BUCKET_FNAME = "bandwidth.bucket"
+# State of the token bucket: tokens (bytes) and time of the last refill.
+BUCKET_STATE = struct.Struct("dd")
+
+# HTTP status codes worth asking again for: timeouts, throttling
+# (429, 503) and transient server errors.
+RETRY_HTTP_STATUS = (408, 429, 500, 502, 503, 504)
+
+# Seconds between the attempts to take a busy connection slot.
+SLOT_POLL = 0.2
+
+def parse_retry_after(value):
+    """ Seconds to wait given by a Retry-After header, either a number
+    of seconds or an HTTP date; None if it cannot be read. """
+    if value is None:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0., parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def is_retryable(exc):
+    """ Whether a failed request may succeed if made again. """
+    if isinstance(exc, HTTPStatusError):
+        return exc.status in RETRY_HTTP_STATUS
+    if isinstance(exc, (IncompleteDownload, ChecksumMismatch, requests.ConnectionError, requests.Timeout,
+                        requests.exceptions.ChunkedEncodingError, asyncio.TimeoutError)):
+        return True
+    if aiohttp is not None and isinstance(exc, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)):
+        return True
+    return False
+
+
+class Throttle(object):
+    """ Limits on the downloads of all the processes on a node, shared
+    through lock and state files in a local directory.
+
+    A token bucket caps the total bandwidth: a process takes tokens for
+    the bytes it receives and waits when the bucket runs dry. Each host
+    has `host_connections` connection slots, lock files that a process
+    holds for the time of a transfer. Requests that fail with a
+    throttling status or a dropped connection are retried up to
+    `retries` times, after an exponentially growing delay with random
+    jitter, or after the delay the server asks for with Retry-After.
+
+    Only settings are kept in the object, so it can be passed to worker
+    processes.
+    """
+    def __init__(self, bandwidth=None, host_connections=None, retries=5,
+                 backoff=1., max_backoff=120., lock_dir=None):
+        # bandwidth: bytes per second over the node; None, no limit.
+        # host_connections: transfers in flight to one host over the
+        # node; None, no limit.
+        # backoff: delay of the first retry, doubled for every further
+        # retry, up to max_backoff.
+        self.bandwidth = None if bandwidth is None else float(bandwidth)
+        self.host_connections = None if host_connections is None else max(1, int(host_connections))
+        self.retries = max(0, int(retries))
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.lock_dir = THROTTLE_DIR if lock_dir is None else lock_dir
+        if (self.bandwidth is not None or self.host_connections is not None) and not os.path.exists(self.lock_dir):
+            try:
+                os.makedirs(self.lock_dir)
+            except OSError:
+                if not os.path.isdir(self.lock_dir):
+                    raise
+
+
+    def reserve(self, nbytes):
+        """ Take tokens for `nbytes` from the bucket of the node.
+        :returns:
+            (float) seconds to wait before receiving more data.
+        """
+        if self.bandwidth is None or nbytes <= 0:
+            return 0.
+        # Allow a burst of one second of data.
+        capacity = self.bandwidth
+        fd = os.open(os.path.join(self.lock_dir, BUCKET_FNAME), os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            now = time.time()
+            state = os.pread(fd, BUCKET_STATE.size, 0)
+            if len(state) == BUCKET_STATE.size:
+                tokens, stamp = BUCKET_STATE.unpack(state)
+                tokens = min(capacity, tokens + max(0., now - stamp) * self.bandwidth)
+            else:
+                tokens = capacity
+            # Tokens may go negative; the debt is paid by waiting.
+            tokens -= nbytes
+            os.pwrite(fd, BUCKET_STATE.pack(tokens, now), 0)
+        finally:
+            os.close(fd)
+        return 0. if tokens >= 0 else -tokens / self.bandwidth
+
+
+    def consume(self, nbytes):
+        """ Take tokens for `nbytes` and wait as long as the bandwidth
+        cap requires. """
+        delay = self.reserve(nbytes)
+        if delay > 0:
+            time.sleep(delay)
+
+
+    def _slotPrefix(self, url):
+        host = url.split("/")[2] if url.count("/") >= 2 else url
+        return os.path.join(self.lock_dir, "host-{0:s}".format(re.sub(r"[^A-Za-z0-9.-]", "_", host)))
+
+
+    def tryHostSlot(self, url):
+        """ Take a free connection slot of the host of `url`.
+        :returns:
+            A slot to give back with releaseHostSlot, or None if all
+            the slots are taken.
+        """
+        if self.host_connections is None:
+            return -1
+        prefix = self._slotPrefix(url)
+        for i in random.sample(range(self.host_connections), self.host_connections):
+            fd = os.open("{0:s}.{1:d}.lock".format(prefix, i), os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (OSError, IOError):
+                os.close(fd)
+                continue
+            return fd
+        return None
+
+
+    def releaseHostSlot(self, slot):
+        if slot is not None and slot >= 0:
+            # Closing the file releases the lock.
+            os.close(slot)
+
+
+    @contextmanager
+    def hostSlot(self, url):
+        """ Hold a connection slot of the host of `url`, waiting for one
+        to be free. """
+        slot = self.tryHostSlot(url)
+        while slot is None:
+            time.sleep(SLOT_POLL * random.uniform(0.5, 1.5))
+            slot = self.tryHostSlot(url)
+        try:
+            yield
+        finally:
+            self.releaseHostSlot(slot)
+
+
+    def retryDelay(self, attempt, exc):
+        """ Seconds to wait before retrying a request that failed with
+        `exc` after `attempt` retries, or None not to retry it. """
+        if attempt >= self.retries or not is_retryable(exc):
+            return None
+        # Full jitter, so the processes throttled at the same time do
+        # not all come back at the same time.
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+        retry_after = parse_retry_after(getattr(exc, "retry_after", None))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_backoff))
+        return delay
+
+
+    def call(self, url, func, *args, **kwargs):
+        """ Call func(*args, **kwargs), a request to `url`, holding a
+        connection slot of its host and retrying it on retryable
+        errors. """
+        attempt = 0
+        while True:
+            try:
+                with self.hostSlot(url):
+                    return func(*args, **kwargs)
+            except Exception as exc:
+                delay = self.retryDelay(attempt, exc)
+                if delay is None:
+                    raise
+                attempt += 1
+                logger.warning("Request of {0:s} failed ({1:s}), retry {2:d} of {3:d} in {4:.1f} s.".format(
+                    url, str(exc), attempt, self.retries, delay))
+                time.sleep(delay)
@@ -9,21 +9,24 @@
 import argparse
 import os
 import sys
-import tempfile
-import subprocess
-import shutil
+import time
+import io
+import gzip
+import sqlite3
 import logging, logging.config
 
 import requests
-from homura import download
-import sqlalchemy as sa
-import pandas as pd
 
-from common import (GOOGLE_LANDSAT_INDEX, GOOGLE_LANDSAT_DTYPE,
-                    S3_LANDSAT_INDEX, S3_LANDSAT_DTYPE)
+from index_db import (INDEX_CHANNELS, tune_bulk_load, create_index_table, 
+                      create_indexes, create_rtree, create_meta_table, 
+                      get_meta, set_meta, 
+                      read_index_csv, df_to_rows, df_to_keyed_rows, 
+                      insert_rows, upsert_rows, TeeReader)
+from snapshot import build_snapshot, IndexSnapshot
 
 LOGGING = {
     "version" : 1, 
+    "disable_existing_loggers" : False, 
     "formatters" : {
         "default" : {
             "format" : "%(asctime)s %(levelname)s %(message)s", 
@@ -50,13 +53,49 @@ def getCmdArgs():
     p = argparse.ArgumentParser(description="Create or update (if exists) a database of index to Landsat images on public available servers including Google Cloud Storage and Amazon AWS S3.")
 
     p.add_argument("-d", "--dir", dest="index_dir", default=None,
-                   required=True, help="Local directory to save CSV file of index from the server and the generated SQLite database file.")
+                   required=True, help="Local directory to save the generated SQLite database file, and the CSV file of index from the server if --keep_csv.")
     p.add_argument("-c", "--channel", dest="channel", choices=("google", "aws"), default=None, required=True, help="Server channel to download index files.")
+    p.add_argument("--keep_csv", dest="keep_csv", action="store_true", help="Also save the decompressed CSV file of index from the server as index.csv in the directory. The index is loaded to the database as it streams from the server either way.")
+    p.add_argument("--incremental", dest="incremental", action="store_true", help="Update the existing database in place: skip the download if the index on the server has not changed since the last update, and otherwise only insert new records and update changed ones. The database stays searchable during the update. Without an existing database, a new one is built.")
+
+    p.add_argument("--snapshot", dest="snapshot", action="store_true", help="Also write a columnar snapshot of the index as memory-mapped NumPy arrays to the directory index_snapshot in the index directory, for fast repeated path/row searches with query_landsat_cloud.py --snapshot. It is only written by the updates run with --snapshot; the searches refuse a snapshot older than the database, so run every update of a database that has a snapshot with it. If the index on the server has not changed, an out-of-date or missing snapshot is still rewritten.")
 
     cmdargs = p.parse_args()
 
     return cmdargs
 
+def openIndex(index_url, etag=None, last_modified=None):
+    # Returns the streaming response, or None if the server says the
+    # index has not been modified since the given ETag/Last-Modified.
+    headers = dict()
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    if last_modified is not None:
+        headers["If-Modified-Since"] = last_modified
+    resp = requests.get(index_url, headers=headers, stream=True, timeout=60)
+    if resp.status_code == 304:
+        resp.close()
+        return None
+    resp.raise_for_status()
+    # Let urllib3 undo any transfer encoding; the body is the .gz file.
+    resp.raw.decode_content = True
+    return resp
+
+
+def snapshotIsCurrent(snapshot_dir, db_file):
+    # Whether the snapshot in snapshot_dir was written from the current
+    # content of the database.
+    try:
+        IndexSnapshot(snapshot_dir).checkIndex(db_file)
+    except (IOError, OSError, ValueError, KeyError, RuntimeError):
+        return False
+    return True
+
+def writeSnapshot(db_file, tname, channel, snapshot_dir):
+    logger.info("Writing columnar snapshot of the index started.")
+    n_snapshot = build_snapshot(db_file, tname, channel, snapshot_dir)
+    logger.info("Writing columnar snapshot of {0:d} records finished.".format(n_snapshot))
+
 def main(cmdargs):
     index_dir = os.path.abspath(cmdargs.index_dir)
     if not os.path.exists(index_dir):
@@ -65,54 +104,110 @@ def main(cmdargs):
     dl_index_fname = "index.csv"
     index_db_fname = "index.db"
     index_db_tname = "landsat"
+    index_snapshot_dname = "index_snapshot"
     temp_index_fname = "tmpindex"
     temp_index_db_fname = "tmpindex.db"
 
-    tmpdir = tempfile.mkdtemp()
-    zip_file = os.path.join(tmpdir, "{0:s}.gz".format(temp_index_fname))
-
-    if cmdargs.channel == "google":
-        index_url = GOOGLE_LANDSAT_INDEX
-        index_dtype = GOOGLE_LANDSAT_DTYPE
-        index_parse_dates = ["DATE_ACQUIRED", "SENSING_TIME"]
-        unzip_cmd = ["gzip", "-d", zip_file]
-    elif cmdargs.channel == "aws":
-        index_url = S3_LANDSAT_INDEX
-        index_dtype = S3_LANDSAT_DTYPE
-        index_parse_dates = ["acquisitionDate"]
-        unzip_cmd = ["gzip", "-d", zip_file]
+    if cmdargs.channel in INDEX_CHANNELS:
+        index_url = INDEX_CHANNELS[cmdargs.channel]["url"]
     else:
         raise RuntimeError("Channel is not implemented yet!")
 
-
-    logger.info("Downloading zipped index file started.")
-    download(index_url, path=zip_file)
-    logger.info("Downloading zipped index file finished.")
-
-    logger.info("Unzipping index file started.")
-    if ( 0 != subprocess.call(unzip_cmd) ):
-        raise RuntimeError("Unzip the file of Google Landsat index failed!")
-    logger.info("Unzipping index file finished.")
-
+    csv_db_file = os.path.join(index_dir, index_db_fname)
+    snapshot_dir = os.path.join(index_dir, index_snapshot_dname)
+    incremental = cmdargs.incremental and os.path.isfile(csv_db_file)
+    etag = None
+    last_modified = None
+    if incremental:
+        csv_db = sqlite3.connect(csv_db_file, isolation_level=None)
+        etag = get_meta(csv_db, "etag")
+        last_modified = get_meta(csv_db, "last_modified")
+        csv_db.close()
+
+    resp = openIndex(index_url, etag=etag, last_modified=last_modified)
+    if resp is None:
+        logger.info("Index on the server not modified since the last update, nothing to do.")
+        if cmdargs.snapshot and not snapshotIsCurrent(snapshot_dir, csv_db_file):
+            writeSnapshot(csv_db_file, index_db_tname, cmdargs.channel, snapshot_dir)
+        return
+
+    # The index is decompressed and parsed as it arrives, one chunk
+    # of records at a time, so neither the compressed nor the
+    # decompressed file has to be on disk or in memory as a whole.
+    csv_stream = gzip.GzipFile(fileobj=resp.raw, mode="rb")
     csv_file = os.path.join(index_dir, dl_index_fname)
-    shutil.move(os.path.join(tmpdir, temp_index_fname), os.path.join(index_dir, temp_index_fname))
-    os.rename(os.path.join(index_dir, temp_index_fname), csv_file)
+    tmp_csv_file = os.path.join(index_dir, temp_index_fname)
+    csv_fobj = None
+    if cmdargs.keep_csv:
+        csv_fobj = open(tmp_csv_file, "wb")
+        csv_stream = io.BufferedReader(TeeReader(csv_stream, csv_fobj))
 
-    tmp_db_file = os.path.join(tmpdir, temp_index_db_fname)
-    csv_db = sa.create_engine("sqlite:///{0:s}".format(tmp_db_file))
     chunksize = int(1e5)
-    j = 1
-    logger.info("Updating SQLite database started.")
-    for df in pd.read_csv(csv_file, chunksize=chunksize, iterator=True, 
-                          dtype=index_dtype, parse_dates=index_parse_dates):
-        df = df.rename(columns={c: c.replace(' ', '_') for c in df.columns}) 
-        df.index += j
-        df.to_sql(index_db_tname, csv_db, if_exists='append')
-        j = df.index[-1] + 1
-    csv_db_file = os.path.join(index_dir, index_db_fname)
-    shutil.move(tmp_db_file, csv_db_file)
+    n_rows = 0
+    logger.info("Streaming index file to SQLite database started.")
+    try:
+        if incremental:
+            # Update the database in place. In WAL mode searches keep
+            # reading the last committed state while the update is written.
+            csv_db = sqlite3.connect(csv_db_file, isolation_level=None)
+            csv_db.execute("PRAGMA journal_mode=WAL")
+            csv_db.execute("PRAGMA synchronous=NORMAL")
+            # Databases built before the key and spatial indexes
+            # existed get them here; afterwards triggers keep the
+            # spatial index in sync with the upserts.
+            create_indexes(csv_db, index_db_tname, cmdargs.channel)
+            create_rtree(csv_db, index_db_tname, cmdargs.channel)
+            create_meta_table(csv_db)
+            n_changed = 0
+            csv_db.execute("BEGIN")
+            for df in read_index_csv(csv_stream, cmdargs.channel, chunksize=chunksize):
+                n_changed += upsert_rows(csv_db, index_db_tname, cmdargs.channel, 
+                                         df_to_keyed_rows(df, cmdargs.channel))
+                n_rows += len(df)
+            csv_db.execute("COMMIT")
+            logger.info("{0:d} of {1:d} records new or changed.".format(n_changed, n_rows))
+        else:
+            # Build a new database beside the old one and swap it in at
+            # the end, so searches never see a partial database.
+            tmp_db_file = os.path.join(index_dir, temp_index_db_fname)
+            if os.path.exists(tmp_db_file):
+                os.remove(tmp_db_file)
+            csv_db = sqlite3.connect(tmp_db_file, isolation_level=None)
+            tune_bulk_load(csv_db)
+            create_index_table(csv_db, index_db_tname, cmdargs.channel)
+            create_meta_table(csv_db)
+            csv_db.execute("BEGIN")
+            for df in read_index_csv(csv_stream, cmdargs.channel, chunksize=chunksize):
+                insert_rows(csv_db, index_db_tname, cmdargs.channel, df_to_rows(df, cmdargs.channel))
+                n_rows += len(df)
+            csv_db.execute("COMMIT")
+            logger.info("{0:d} records loaded, creating indexes.".format(n_rows))
+            create_indexes(csv_db, index_db_tname, cmdargs.channel)
+            create_rtree(csv_db, index_db_tname, cmdargs.channel)
+    finally:
+        resp.close()
+        if csv_fobj is not None:
+            csv_fobj.close()
+    logger.info("Streaming index file to SQLite database finished.")
+
+    set_meta(csv_db, "etag", resp.headers.get("ETag"))
+    set_meta(csv_db, "last_modified", resp.headers.get("Last-Modified"))
+    # Time of this update, checked by the readers of the snapshot.
+    set_meta(csv_db, "updated", time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()))
+    if incremental:
+        csv_db.execute("PRAGMA optimize")
+    else:
+        csv_db.execute("ANALYZE")
+    csv_db.close()
+    if not incremental:
+        os.rename(tmp_db_file, csv_db_file)
+    if csv_fobj is not None:
+        os.rename(tmp_csv_file, csv_file)
     logger.info("Updating SQLit database finished.")
 
+    if cmdargs.snapshot:
+        writeSnapshot(csv_db_file, index_db_tname, cmdargs.channel, snapshot_dir)
+
 if __name__ == "__main__":
     cmdargs = getCmdArgs()
     main(cmdargs)
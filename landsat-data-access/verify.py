@@ -0,0 +1,118 @@
+import os
+import re
+import gzip
+import base64
+import hashlib
+import binascii
+import tarfile
+
+# Size of the blocks read from local files.
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+
+class ChecksumMismatch(IOError):
+    """ Exception raised when the digest of a file does not match the
+    one given by the server or by a checksum file. """
+    pass
+
+
+def md5_from_headers(headers):
+    """ MD5 digest (hex) of a remote file given by the headers of an
+    answer of the server, or None: the x-goog-hash header of Google
+    Storage, or the ETag of AWS S3 of a file not uploaded in parts. """
+    goog_hash = headers.get("x-goog-hash")
+    if goog_hash is not None:
+        for item in goog_hash.split(","):
+            algo, _, value = item.strip().partition("=")
+            if algo == "md5":
+                try:
+                    return binascii.hexlify(base64.b64decode(value)).decode("ascii")
+                except (binascii.Error, ValueError):
+                    return None
+    if headers.get("x-amz-request-id") is not None or headers.get("x-amz-id-2") is not None:
+        etag = headers.get("ETag", "").strip('"')
+        if re.match(r"^[0-9a-fA-F]{32}$", etag):
+            return etag.lower()
+    return None
+
+
+def file_md5(path, nbytes=None):
+    """ MD5 hash object of the first `nbytes` (default, all) of a
+    local file. """
+    md5 = hashlib.md5()
+    left = nbytes
+    with open(path, "rb") as fobj:
+        while left is None or left > 0:
+            block = fobj.read(READ_BLOCK_SIZE if left is None else min(READ_BLOCK_SIZE, left))
+            if len(block) == 0:
+                break
+            md5.update(block)
+            if left is not None:
+                left -= len(block)
+    return md5
+
+
+def read_md5_file(md5_path):
+    """ Read a checksum file of the format of md5sum, one line of
+    "digest  file name".
+    :returns:
+        (str, str) digest (lower-case hex) and file name.
+    """
+    with open(md5_path, "r") as fobj:
+        fields = fobj.read().split()
+    if len(fields) < 2:
+        raise ValueError("Not a checksum file: {0:s}".format(md5_path))
+    return fields[0].lower(), os.path.basename(fields[1].lstrip("*"))
+
+
+class HashingReader(object):
+    """ A read-only file object that hashes the bytes read through it,
+    so a file can be checked while it is being read for something
+    else. """
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self.md5 = hashlib.md5()
+        self.nbytes = 0
+
+
+    def read(self, size=-1):
+        block = self.fobj.read(size)
+        self.md5.update(block)
+        self.nbytes += len(block)
+        return block
+
+
+    def drain(self):
+        """ Read and hash the rest of the file. """
+        while len(self.read(READ_BLOCK_SIZE)) > 0:
+            pass
+        return self.md5.hexdigest()
+
+
+def validate_archive(tar_path, expected_md5=None, check_tar=True):
+    """ Check a Landsat .tar.gz archive in one pass over the file: its
+    MD5 against `expected_md5` and, if `check_tar`, that it
+    decompresses (gzip CRC) and that all its members are complete.
+    :returns:
+        (str) MD5 digest of the archive.
+    """
+    with open(tar_path, "rb") as fobj:
+        reader = HashingReader(fobj)
+        if check_tar:
+            try:
+                gz = gzip.GzipFile(fileobj=reader, mode="rb")
+                with tarfile.open(fileobj=gz, mode="r|") as tar:
+                    for member in tar:
+                        if member.isfile():
+                            data = tar.extractfile(member)
+                            while len(data.read(READ_BLOCK_SIZE)) > 0:
+                                pass
+                # Read the padding after the end of the tar to the end
+                # of the gzip stream, where its CRC is checked.
+                while len(gz.read(READ_BLOCK_SIZE)) > 0:
+                    pass
+            except (tarfile.TarError, EOFError, OSError, IOError) as exc:
+                raise ChecksumMismatch("Corrupted archive {0:s}: {1:s}".format(tar_path, str(exc)))
+        digest = reader.drain()
+    if expected_md5 is not None and digest != expected_md5.lower():
+        raise ChecksumMismatch("MD5 of {0:s} is {1:s}, expected {2:s}".format(tar_path, digest, expected_md5.lower()))
+    return digest
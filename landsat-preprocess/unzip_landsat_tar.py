@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import glob
+import gzip
+import shutil
+import fnmatch
+import tarfile
+import argparse
+import textwrap
+import threading
+import subprocess
+import logging, logging.config
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "landsat-data-access"))
+from verify import HashingReader, READ_BLOCK_SIZE, read_md5_file
+
+LOGGING = {
+    "version" : 1,
+    "disable_existing_loggers" : False,
+    "formatters" : {
+        "default" : {
+            "format" : "%(asctime)s %(levelname)s %(message)s",
+        },
+    },
+    "handlers" : {
+        "console" : {
+            "class" : "logging.StreamHandler",
+            "level" : "DEBUG",
+            "formatter" : "default",
+            "stream" : "ext://sys.stdout",
+        },
+    },
+    "root" : {
+        "handlers" : ["console"],
+        "level" : "DEBUG",
+    },
+}
+logging.config.dictConfig(LOGGING)
+logger = logging.getLogger('landsat-preprocess')
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description=textwrap.fill("Unzip all the Landsat .tar.gz files DIRECTLY stored in a directory, but NOT in any subdirectories, many at the same time, each to a folder named after the scene ID of its .xml file. Each archive is decompressed in one streaming read into its own temporary folder, which is renamed to the scene folder when complete, so an interrupted run leaves no partial scene folders and several runs can share an output directory."), formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument("tardir", metavar="DATA_DIR", help=textwrap.fill("Directory of the Landsat .tar.gz files."))
+
+    p.add_argument("-C", "--out_directory", dest="outdir", required=False, default=None, metavar="DIR", help=textwrap.fill("Output directory. Default: the directory of the Landsat archive .tar.gz files."))
+    p.add_argument("-m", "--move_archive", dest="move", required=False, action="store_true", help=textwrap.fill("Move the Landsat archive .tar.gz file into the folder of the unzipped files."))
+    p.add_argument("-j", "--jobs", dest="jobs", required=False, type=int, metavar="NUM_OF_JOBS", default=4, help=textwrap.fill("Number of archives to unzip at the same time. Default: 4."))
+    p.add_argument("--members", dest="members", required=False, nargs="+", metavar="PATTERN", default=None, help=textwrap.fill("Extract only the files of an archive whose names match one of these shell patterns, e.g. '*_sr_band*' '*_pixel_qa*'. The .xml file is always extracted. Default: all files."))
+    p.add_argument("--pigz", dest="pigz", required=False, type=int, metavar="NUM_OF_THREADS", default=None, help=textwrap.fill("Decompress with pigz, which reads, decompresses and writes in separate threads, using this many threads, instead of the gzip module of Python. Default: not used."))
+    p.add_argument("--verify", dest="verify", required=False, action="store_true", help=textwrap.fill("Check the MD5 of each archive against its .md5 file in the same read as the extraction, and do not keep the files of a corrupted archive."))
+
+    cmdargs = p.parse_args()
+
+    return cmdargs
+
+
+def isSafeMember(member):
+    # Only plain files and folders inside the output folder.
+    if not (member.isfile() or member.isdir()):
+        return False
+    name = os.path.normpath(member.name)
+    return not (os.path.isabs(name) or name == ".." or name.startswith("..{0:s}".format(os.sep)))
+
+
+def wantMember(member, patterns):
+    if patterns is None or member.isdir():
+        return True
+    fname = os.path.basename(member.name)
+    if fnmatch.fnmatch(fname, "L*.xml"):
+        return True
+    return any([fnmatch.fnmatch(fname, pat) for pat in patterns])
+
+
+def extractStream(fobj, tmpdir, patterns):
+    # Extract the wanted members of a tar stream, returns their names.
+    names = []
+    with tarfile.open(fileobj=fobj, mode="r|") as tar:
+        for member in tar:
+            if not isSafeMember(member) or not wantMember(member, patterns):
+                continue
+            tar.extract(member, tmpdir, set_attrs=False)
+            if member.isfile():
+                names.append(member.name)
+    # Read to the end of the compressed stream, where its CRC is
+    # checked.
+    while len(fobj.read(READ_BLOCK_SIZE)) > 0:
+        pass
+    return names
+
+
+def extractArchive(archive, outdir, patterns=None, pigz=None, verify=False, move=False):
+    # Returns (scene ID or None, message).
+    base = os.path.basename(archive)[:-len(".tar.gz")]
+    tmpdir = os.path.join(outdir, ".tmp-{0:s}-{1:d}".format(base, os.getpid()))
+    if os.path.isdir(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+    try:
+        with open(archive, "rb") as fobj:
+            reader = HashingReader(fobj)
+            if pigz is None:
+                names = extractStream(gzip.GzipFile(fileobj=reader, mode="rb"), tmpdir, patterns)
+            else:
+                proc = subprocess.Popen(["pigz", "-dc", "-p", str(pigz)],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+                def feed():
+                    # Feed pigz from the hashing reader, so the archive
+                    # is still read only once.
+                    try:
+                        while True:
+                            block = reader.read(READ_BLOCK_SIZE)
+                            if len(block) == 0:
+                                break
+                            proc.stdin.write(block)
+                    except (IOError, OSError):
+                        pass
+                    finally:
+                        proc.stdin.close()
+
+                feeder = threading.Thread(target=feed)
+                feeder.start()
+                try:
+                    names = extractStream(proc.stdout, tmpdir, patterns)
+                finally:
+                    proc.stdout.close()
+                    feeder.join()
+                    proc.wait()
+                if proc.returncode != 0:
+                    raise IOError("pigz failed with exit code {0:d}".format(proc.returncode))
+            digest = reader.drain()
+
+        if verify:
+            md5f = os.path.join(os.path.dirname(archive), "{0:s}.md5".format(base))
+            if not os.path.isfile(md5f):
+                logger.warning("MD5 file not found: {0:s}.md5, {1:s} not verified".format(base, archive))
+            elif read_md5_file(md5f)[0] != digest:
+                return None, "Corrupted archive, MD5 {0:s} does not match {1:s}".format(digest, md5f)
+
+        xml = [name for name in names if fnmatch.fnmatch(os.path.basename(name), "L*.xml")]
+        if len(xml) == 0:
+            return None, "Could not find xml file for {0:s}".format(archive)
+        scn_id = os.path.basename(xml[0])[:-len(".xml")]
+        src = os.path.normpath(os.path.join(tmpdir, os.path.dirname(xml[0])))
+
+        # Swap the complete folder in with renames, replacing the one of
+        # an earlier run.
+        scn_dir = os.path.join(outdir, scn_id)
+        old_dir = "{0:s}.old-{1:d}".format(scn_dir, os.getpid())
+        if os.path.isdir(scn_dir):
+            os.rename(scn_dir, old_dir)
+        os.rename(src, scn_dir)
+        if os.path.isdir(old_dir):
+            shutil.rmtree(old_dir)
+        if move:
+            # The archive directory may be on another file system.
+            shutil.move(archive, os.path.join(scn_dir, os.path.basename(archive)))
+        return scn_id, "{0:d} files".format(len(names))
+    except (tarfile.TarError, EOFError, IOError, OSError) as exc:
+        return None, "Unzipping {0:s} failed: {1:s}".format(archive, str(exc))
+    finally:
+        if os.path.isdir(tmpdir):
+            shutil.rmtree(tmpdir)
+
+
+def main(cmdargs):
+    tardir = cmdargs.tardir
+    outdir = tardir if cmdargs.outdir is None else cmdargs.outdir
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    if cmdargs.pigz is not None and shutil.which("pigz") is None:
+        raise RuntimeError("pigz is not found in PATH.")
+
+    archives = sorted(glob.glob(os.path.join(tardir, "*tar.gz")))
+    n_bad = 0
+    with ProcessPoolExecutor(max_workers=max(1, cmdargs.jobs)) as executor:
+        futures = [executor.submit(extractArchive, archive, outdir, cmdargs.members,
+                                   cmdargs.pigz, cmdargs.verify, cmdargs.move)
+                   for archive in archives]
+        for i, (archive, fut) in enumerate(zip(archives, futures)):
+            scn_id, msg = fut.result()
+            if scn_id is None:
+                n_bad += 1
+                logger.error("<-- {0:d} / {1:d}: {2:s}: {3:s}".format(i+1, len(archives), os.path.basename(archive), msg))
+            else:
+                logger.info("<-- {0:d} / {1:d}: {2:s} to {3:s}, {4:s}".format(i+1, len(archives), os.path.basename(archive), scn_id, msg))
+
+    logger.info("Unzip Landsat archive done! {0:d} of {1:d} archives failed.".format(n_bad, len(archives)))
+
+if __name__ == "__main__":
+    cmdargs = getCmdArgs()
+    main(cmdargs)
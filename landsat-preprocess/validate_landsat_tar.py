@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import glob
+import argparse
+import textwrap
+import logging, logging.config
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "landsat-data-access"))
+from manifest import DownloadManifest, MANIFEST_FNAME
+from verify import ChecksumMismatch, read_md5_file, validate_archive
+
+LOGGING = {
+    "version" : 1,
+    "disable_existing_loggers" : False,
+    "formatters" : {
+        "default" : {
+            "format" : "%(asctime)s %(levelname)s %(message)s",
+        },
+    },
+    "handlers" : {
+        "console" : {
+            "class" : "logging.StreamHandler",
+            "level" : "DEBUG",
+            "formatter" : "default",
+            "stream" : "ext://sys.stdout",
+        },
+    },
+    "root" : {
+        "handlers" : ["console"],
+        "level" : "DEBUG",
+    },
+}
+logging.config.dictConfig(LOGGING)
+logger = logging.getLogger('landsat-preprocess')
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description=textwrap.fill("Validate the checksum of downloaded Landsat .tar.gz files directly stored in a directory, many at the same time. The checksum files from the data server, .md5 files, must be in the same directory and have the same file names as the .tar.gz files. Each archive is read at most once, and not at all if its MD5 digest was recorded while it was downloaded, in the download manifest {0:s} of the directory. Directories without a manifest are validated without one, and none is created in them.".format(MANIFEST_FNAME)), formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument("tardir", metavar="DATA_DIR", help=textwrap.fill("Directory of the Landsat .tar.gz files and their .md5 files."))
+
+    p.add_argument("-o", "--output", dest="output", required=False, default=None, metavar="FILE_OF_CORRUPTED_FILES", help=textwrap.fill("A file to store the list of the corrupted files. Default: listed to the terminal only."))
+    p.add_argument("-c", "--clean", dest="clean", required=False, action="store_true", help=textwrap.fill("Remove the corrupted files and their .md5 files."))
+    p.add_argument("-q", "--quiet", dest="quiet", required=False, action="store_true", help=textwrap.fill("Do not ask for confirmation before removing corrupted files with --clean, for batch calls."))
+    p.add_argument("-j", "--jobs", dest="jobs", required=False, type=int, metavar="NUM_OF_JOBS", default=4, help=textwrap.fill("Number of archives to validate at the same time. Default: 4."))
+    p.add_argument("--check_tar", dest="check_tar", required=False, action="store_true", help=textwrap.fill("Also decompress each archive in the same read to check its gzip CRC and that all its members are complete. Archives with a recorded digest are read for it."))
+    p.add_argument("--rehash", dest="rehash", required=False, action="store_true", help=textwrap.fill("Hash every archive again even if its digest was recorded in the download manifest."))
+
+    cmdargs = p.parse_args()
+
+    return cmdargs
+
+
+def validateOne(tarf, md5f, recorded_md5, check_tar):
+    # Returns (status, digest, message); status is "valid", "corrupted"
+    # or "unknown" when it cannot be told.
+    md5fbase = os.path.basename(tarf)[:-len(".tar.gz")]
+    if not os.path.isfile(md5f):
+        return "unknown", None, "MD5 file not found: {0:s}.md5".format(md5fbase)
+    try:
+        true_md5, fname = read_md5_file(md5f)
+    except (ValueError, IOError) as exc:
+        return "unknown", None, str(exc)
+    if fname != "{0:s}.tar.gz".format(md5fbase):
+        return "unknown", None, "MD5 file content does not match file name: {0:s}.md5".format(md5fbase)
+
+    if recorded_md5 is not None and not check_tar:
+        digest = recorded_md5
+    else:
+        try:
+            digest = validate_archive(tarf, check_tar=check_tar)
+        except ChecksumMismatch as exc:
+            return "corrupted", None, str(exc)
+    if digest != true_md5:
+        return "corrupted", digest, "MD5 {0:s}, expected {1:s}".format(digest, true_md5)
+    return "valid", digest, ""
+
+
+def main(cmdargs):
+    tardir = cmdargs.tardir
+    tarfiles = sorted(glob.glob(os.path.join(tardir, "*.tar.gz")))
+    logger.info("{0:d} files to validate in {1:s}".format(len(tarfiles), tardir))
+
+    if cmdargs.clean and not cmdargs.quiet:
+        yn = input("Are you sure to remove corrupted files? Y/n\n")
+        if yn != "Y":
+            return
+
+    # Only use the manifest of a download directory, do not create one
+    # in a directory that was delivered or is read-only.
+    manifest = None
+    if os.path.isfile(os.path.join(tardir, MANIFEST_FNAME)):
+        manifest = DownloadManifest.forDir(tardir)
+    recorded = dict()
+    if manifest is not None and not cmdargs.rehash:
+        recorded = dict((tarf, manifest.digestOf(tarf)) for tarf in tarfiles)
+    n_skip = len([d for d in recorded.values() if d is not None])
+    if n_skip > 0:
+        logger.info("{0:d} files have their digest recorded in {1:s} and are not read again".format(
+            n_skip, os.path.join(tardir, MANIFEST_FNAME)))
+
+    out_fobj = None if cmdargs.output is None else open(cmdargs.output, "w")
+    n_bad = 0
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, cmdargs.jobs)) as executor:
+            futures = [executor.submit(validateOne, tarf, "{0:s}.md5".format(tarf[:-len(".tar.gz")]),
+                                       recorded.get(tarf), cmdargs.check_tar)
+                       for tarf in tarfiles]
+            for i, (tarf, fut) in enumerate(zip(tarfiles, futures)):
+                status, digest, msg = fut.result()
+                logger.info("<-- {0:d} / {1:d}, {2:s}: {3:s}. {4:s}".format(i+1, len(tarfiles), tarf, status, msg))
+                if (manifest is not None and digest is not None and status == "valid"
+                    and recorded.get(tarf) is None):
+                    manifest.recordDigest(tarf, digest)
+                if status != "corrupted":
+                    continue
+                n_bad += 1
+                if out_fobj is not None:
+                    out_fobj.write("{0:s}\n".format(os.path.basename(tarf).split("-")[0]))
+                    out_fobj.flush()
+                if cmdargs.clean:
+                    os.remove(tarf)
+                    md5f = "{0:s}.md5".format(tarf[:-len(".tar.gz")])
+                    if os.path.isfile(md5f):
+                        os.remove(md5f)
+    finally:
+        if manifest is not None:
+            manifest.close()
+        if out_fobj is not None:
+            out_fobj.close()
+
+    logger.info("Finished validation! {0:d} of {1:d} files corrupted.".format(n_bad, len(tarfiles)))
+
+if __name__ == "__main__":
+    cmdargs = getCmdArgs()
+    main(cmdargs)